@@ -16,6 +16,11 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# Use the same database as the app when DATABASE_URL is set (unless the caller,
+# e.g. app.shards init, passed a URL explicitly)
+if os.getenv("DATABASE_URL") and not config.attributes.get("explicit_url"):
+    config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"].replace("%", "%%"))
+
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
 from app.models import Base
 
@@ -0,0 +1,31 @@
+"""unique service name
+
+Revision ID: 5b1e2c9d7a40
+Revises: 360177d47097
+Create Date: 2026-10-19 09:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e2c9d7a40'
+down_revision: Union[str, None] = '360177d47097'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Service names are the natural key for bulk upserts (INSERT ... ON CONFLICT (name))
+    with op.batch_alter_table('services') as batch_op:
+        batch_op.create_unique_constraint('uq_services_name', ['name'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('services') as batch_op:
+        batch_op.drop_constraint('uq_services_name', type_='unique')
@@ -0,0 +1,114 @@
+"""compact uuid keys
+
+Revision ID: a6c1e7d93f52
+Revises: f3b8d2e6a914
+Create Date: 2026-10-19 17:32:10.406218
+
+"""
+import hashlib
+import uuid
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6c1e7d93f52'
+down_revision: Union[str, None] = 'f3b8d2e6a914'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Key and reference columns that move from 36-character text to 16-byte ids
+ID_COLUMNS = {
+    'patients': ['id'],
+    'consultation_requests': ['id', 'patient_id'],
+    'assignments': ['id', 'request_id', 'head_doctor_id', 'assigned_doctor_id'],
+    'users': ['id'],
+    'otps': ['id', 'user_id'],
+    'services': ['id'],
+    'doctors': ['id'],
+    'appointments': ['id', 'user_id', 'doctor_id', 'service_id'],
+    'doctor_certificates': ['id', 'doctor_id'],
+    'notifications': ['id', 'user_id'],
+}
+
+# Matches the uuid-shaped check used for the PostgreSQL conversion
+_PG_UUID_RE = "'^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$'"
+
+
+def _to_bytes(value):
+    # Existing keys are uuid4 strings. Anything else maps to its md5, the same
+    # value PostgreSQL's md5(text)::uuid gives, so keys and references still match.
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        if len(value) == 16:
+            return value
+        value = value.decode()
+    try:
+        return uuid.UUID(value).bytes
+    except ValueError:
+        return hashlib.md5(value.encode()).digest()
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(uuid.UUID(bytes=bytes(value)))
+
+
+def _rewrite_sqlite(bind, convert):
+    for table, columns in ID_COLUMNS.items():
+        rows = bind.execute(sa.text(f"SELECT rowid, {', '.join(columns)} FROM {table}")).fetchall()
+        if not rows:
+            continue
+        assignments = ', '.join(f"{c} = :{c}" for c in columns)
+        bind.execute(
+            sa.text(f"UPDATE {table} SET {assignments} WHERE rowid = :rowid"),
+            [dict({c: convert(v) for c, v in zip(columns, row[1:])}, rowid=row[0]) for row in rows],
+        )
+
+
+def _alter_sqlite(id_type):
+    for table, columns in ID_COLUMNS.items():
+        with op.batch_alter_table(table, recreate='always') as batch_op:
+            for column in columns:
+                batch_op.alter_column(column, type_=id_type, existing_nullable=column != 'id')
+
+
+def _alter_postgresql(bind, to_uuid):
+    inspector = sa.inspect(bind)
+    foreign_keys = [(table, fk) for table in ID_COLUMNS for fk in inspector.get_foreign_keys(table)]
+    for table, fk in foreign_keys:
+        op.drop_constraint(fk['name'], table, type_='foreignkey')
+    for table, columns in ID_COLUMNS.items():
+        for column in columns:
+            if to_uuid:
+                using = f"CASE WHEN {column} ~ {_PG_UUID_RE} THEN {column}::uuid ELSE md5({column})::uuid END"
+                op.alter_column(table, column, type_=postgresql.UUID(), postgresql_using=using)
+            else:
+                op.alter_column(table, column, type_=sa.String(), postgresql_using=f"{column}::text")
+    for table, fk in foreign_keys:
+        op.create_foreign_key(fk['name'], table, fk['referred_table'], fk['constrained_columns'], fk['referred_columns'])
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        _alter_postgresql(bind, to_uuid=True)
+        return
+    _alter_sqlite(sa.LargeBinary(16))
+    _rewrite_sqlite(bind, _to_bytes)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        _alter_postgresql(bind, to_uuid=False)
+        return
+    _rewrite_sqlite(bind, _to_text)
+    _alter_sqlite(sa.String())
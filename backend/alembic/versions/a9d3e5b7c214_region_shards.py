@@ -0,0 +1,46 @@
+"""region shards
+
+Revision ID: a9d3e5b7c214
+Revises: e7c4a2d9b613
+Create Date: 2026-10-20 16:02:37.418920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9d3e5b7c214'
+down_revision: Union[str, None] = 'e7c4a2d9b613'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    id_type = postgresql.UUID() if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('region', sa.String(), nullable=True))
+        batch_op.create_index('ix_users_region', ['region'], unique=False)
+    op.create_table(
+        'shard_directory',
+        sa.Column('user_id', id_type, nullable=False),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('phone', sa.String(), nullable=False),
+        sa.Column('shard', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('user_id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('phone'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('shard_directory')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_index('ix_users_region')
+        batch_op.drop_column('region')
@@ -0,0 +1,36 @@
+"""daily rollups
+
+Revision ID: b2d84f6e0c17
+Revises: a6c1e7d93f52
+Create Date: 2026-10-19 18:20:37.551902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2d84f6e0c17'
+down_revision: Union[str, None] = 'a6c1e7d93f52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('daily_rollups',
+    sa.Column('metric', sa.String(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('dim1', sa.String(), nullable=False),
+    sa.Column('dim2', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('metric', 'day', 'dim1', 'dim2')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_rollups')
@@ -0,0 +1,69 @@
+"""audit log
+
+Revision ID: b4f81c2e9a57
+Revises: a9d3e5b7c214
+Create Date: 2026-10-21 09:37:12.506314
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4f81c2e9a57'
+down_revision: Union[str, None] = 'a9d3e5b7c214'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('audit_log',
+    sa.Column('seq', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('actor_id', sa.String(), nullable=True),
+    sa.Column('action', sa.String(), nullable=False),
+    sa.Column('subject_type', sa.String(), nullable=True),
+    sa.Column('subject_id', sa.String(), nullable=True),
+    sa.Column('details', sa.Text(), nullable=True),
+    sa.Column('prev_hash', sa.String(length=64), nullable=False),
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index('ix_audit_log_actor', 'audit_log', ['actor_id', 'created_at'], unique=False)
+    op.create_index('ix_audit_log_subject', 'audit_log', ['subject_type', 'subject_id', 'created_at'], unique=False)
+    op.create_index('ix_audit_log_created_at', 'audit_log', ['created_at'], unique=False)
+    # Append-only: reject edits and deletes at the database level
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for operation in ('UPDATE', 'DELETE'):
+            op.execute(
+                f"CREATE TRIGGER audit_log_no_{operation.lower()} BEFORE {operation} ON audit_log "
+                "BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END"
+            )
+    elif dialect == 'postgresql':
+        op.execute(
+            "CREATE FUNCTION audit_log_append_only() RETURNS trigger AS $$ "
+            "BEGIN RAISE EXCEPTION 'audit_log is append-only'; END $$ LANGUAGE plpgsql"
+        )
+        op.execute(
+            "CREATE TRIGGER audit_log_append_only BEFORE UPDATE OR DELETE ON audit_log "
+            "FOR EACH ROW EXECUTE FUNCTION audit_log_append_only()"
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS audit_log_no_update")
+        op.execute("DROP TRIGGER IF EXISTS audit_log_no_delete")
+    elif dialect == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS audit_log_append_only ON audit_log")
+        op.execute("DROP FUNCTION IF EXISTS audit_log_append_only()")
+    op.drop_index('ix_audit_log_created_at', table_name='audit_log')
+    op.drop_index('ix_audit_log_subject', table_name='audit_log')
+    op.drop_index('ix_audit_log_actor', table_name='audit_log')
+    op.drop_table('audit_log')
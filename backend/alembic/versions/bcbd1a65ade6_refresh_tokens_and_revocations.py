@@ -0,0 +1,65 @@
+"""refresh tokens and revocations
+
+Revision ID: bcbd1a65ade6
+Revises: d3a7f9c1e482
+Create Date: 2026-10-23 09:41:18.530914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bcbd1a65ade6'
+down_revision: Union[str, None] = 'd3a7f9c1e482'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    id_type = postgresql.UUID() if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    op.create_table('refresh_tokens',
+    sa.Column('id', id_type, nullable=False),
+    sa.Column('user_id', id_type, nullable=False),
+    sa.Column('family_id', id_type, nullable=False),
+    sa.Column('token_hash', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('used_at', sa.DateTime(), nullable=True),
+    sa.Column('revoked_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('token_hash')
+    )
+    op.create_index('ix_refresh_tokens_user_id', 'refresh_tokens', ['user_id'], unique=False)
+    op.create_index('ix_refresh_tokens_family_id', 'refresh_tokens', ['family_id'], unique=False)
+    op.create_index('ix_refresh_tokens_expires_at', 'refresh_tokens', ['expires_at'], unique=False)
+    op.create_table('token_revocations',
+    sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('jti', sa.String(), nullable=True),
+    sa.Column('user_id', id_type, nullable=True),
+    sa.Column('revoked_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+    op.create_index('ix_token_revocations_jti', 'token_revocations', ['jti'], unique=False)
+    op.create_index('ix_token_revocations_user', 'token_revocations', ['user_id', 'revoked_at'], unique=False)
+    op.create_index('ix_token_revocations_expires_at', 'token_revocations', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_token_revocations_expires_at', table_name='token_revocations')
+    op.drop_index('ix_token_revocations_user', table_name='token_revocations')
+    op.drop_index('ix_token_revocations_jti', table_name='token_revocations')
+    op.drop_table('token_revocations')
+    op.drop_index('ix_refresh_tokens_expires_at', table_name='refresh_tokens')
+    op.drop_index('ix_refresh_tokens_family_id', table_name='refresh_tokens')
+    op.drop_index('ix_refresh_tokens_user_id', table_name='refresh_tokens')
+    op.drop_table('refresh_tokens')
@@ -0,0 +1,41 @@
+"""notifications table
+
+Revision ID: c47e0b9f1d23
+Revises: 8d3f6a1c2e95
+Create Date: 2026-10-19 13:05:44.930217
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c47e0b9f1d23'
+down_revision: Union[str, None] = '8d3f6a1c2e95'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The initial migration predates notifications; databases that were built
+    # with create_all already have the table.
+    if 'notifications' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('notifications',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('user_id', sa.String(), nullable=True),
+    sa.Column('message', sa.String(), nullable=False),
+    sa.Column('type', sa.String(), nullable=True),
+    sa.Column('is_read', sa.Boolean(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('notifications')
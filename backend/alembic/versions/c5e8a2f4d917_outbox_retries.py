@@ -0,0 +1,48 @@
+"""outbox retries and dead letters
+
+Revision ID: c5e8a2f4d917
+Revises: bcbd1a65ade6
+Create Date: 2026-10-24 10:12:40.118206
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5e8a2f4d917'
+down_revision: Union[str, None] = 'bcbd1a65ade6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('event_checkpoints') as batch_op:
+        batch_op.add_column(sa.Column('failed_event_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('retry_at', sa.DateTime(), nullable=True))
+    op.create_table('dead_letters',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('consumer', sa.String(), nullable=False),
+    sa.Column('event_id', sa.Integer(), nullable=False),
+    sa.Column('event_type', sa.String(), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_dead_letters_consumer_event', 'dead_letters', ['consumer', 'event_id'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_dead_letters_consumer_event', table_name='dead_letters')
+    op.drop_table('dead_letters')
+    with op.batch_alter_table('event_checkpoints') as batch_op:
+        batch_op.drop_column('retry_at')
+        batch_op.drop_column('attempts')
+        batch_op.drop_column('failed_event_id')
@@ -0,0 +1,71 @@
+"""messaging
+
+Revision ID: c8e2f4a61d39
+Revises: b4f81c2e9a57
+Create Date: 2026-10-21 15:48:03.271955
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c8e2f4a61d39'
+down_revision: Union[str, None] = 'b4f81c2e9a57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    id_type = postgresql.UUID() if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    op.create_table('message_threads',
+    sa.Column('id', id_type, nullable=False),
+    sa.Column('appointment_id', id_type, nullable=True),
+    sa.Column('assignment_id', id_type, nullable=True),
+    sa.Column('last_seq', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('appointment_id'),
+    sa.UniqueConstraint('assignment_id')
+    )
+    op.create_table('thread_members',
+    sa.Column('thread_id', id_type, nullable=False),
+    sa.Column('user_id', id_type, nullable=False),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('delivered_seq', sa.Integer(), nullable=False),
+    sa.Column('read_seq', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['thread_id'], ['message_threads.id'], ),
+    sa.PrimaryKeyConstraint('thread_id', 'user_id')
+    )
+    op.create_index('ix_thread_members_user_id', 'thread_members', ['user_id'], unique=False)
+    op.create_index(op.f('ix_thread_members_updated_at'), 'thread_members', ['updated_at'], unique=False)
+    op.create_table('messages',
+    sa.Column('thread_id', id_type, nullable=False),
+    sa.Column('seq', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sender_id', id_type, nullable=False),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('attachment_path', sa.String(), nullable=True),
+    sa.Column('attachment_name', sa.String(), nullable=True),
+    sa.Column('attachment_type', sa.String(), nullable=True),
+    sa.Column('attachment_size', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['thread_id'], ['message_threads.id'], ),
+    sa.PrimaryKeyConstraint('thread_id', 'seq')
+    )
+    op.create_index('ix_messages_created_at', 'messages', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_created_at', table_name='messages')
+    op.drop_table('messages')
+    op.drop_index(op.f('ix_thread_members_updated_at'), table_name='thread_members')
+    op.drop_index('ix_thread_members_user_id', table_name='thread_members')
+    op.drop_table('thread_members')
+    op.drop_table('message_threads')
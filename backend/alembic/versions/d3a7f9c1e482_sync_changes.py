@@ -0,0 +1,44 @@
+"""sync change log
+
+Revision ID: d3a7f9c1e482
+Revises: c8e2f4a61d39
+Create Date: 2026-10-22 10:14:37.608213
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a7f9c1e482'
+down_revision: Union[str, None] = 'c8e2f4a61d39'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    id_type = postgresql.UUID() if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    op.create_table('sync_changes',
+    sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', id_type, nullable=False),
+    sa.Column('owner_id', id_type, nullable=True),
+    sa.Column('deleted', sa.Boolean(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+    op.create_index('ix_sync_changes_owner_seq', 'sync_changes', ['owner_id', 'seq'], unique=False)
+    op.create_index('ix_sync_changes_changed_at', 'sync_changes', ['changed_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sync_changes_changed_at', table_name='sync_changes')
+    op.drop_index('ix_sync_changes_owner_seq', table_name='sync_changes')
+    op.drop_table('sync_changes')
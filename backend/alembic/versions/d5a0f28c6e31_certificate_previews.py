@@ -0,0 +1,38 @@
+"""certificate previews
+
+Revision ID: d5a0f28c6e31
+Revises: c9e35a7b1f48
+Create Date: 2026-10-19 19:41:06.218904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a0f28c6e31'
+down_revision: Union[str, None] = 'c9e35a7b1f48'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('doctor_certificates') as batch_op:
+        batch_op.add_column(sa.Column('content_type', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('original_size', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('processing_status', sa.String(), nullable=False, server_default='pending'))
+        batch_op.add_column(sa.Column('preview_path', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('thumbnail_path', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('doctor_certificates') as batch_op:
+        batch_op.drop_column('thumbnail_path')
+        batch_op.drop_column('preview_path')
+        batch_op.drop_column('processing_status')
+        batch_op.drop_column('original_size')
+        batch_op.drop_column('content_type')
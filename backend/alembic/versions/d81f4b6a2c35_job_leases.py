@@ -0,0 +1,33 @@
+"""job leases
+
+Revision ID: d81f4b6a2c35
+Revises: c5e8a2f4d917
+Create Date: 2026-10-25 09:30:52.604113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd81f4b6a2c35'
+down_revision: Union[str, None] = 'c5e8a2f4d917'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('job_leases',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('locked_by', sa.String(), nullable=True),
+    sa.Column('locked_until', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('job_leases')
@@ -0,0 +1,45 @@
+"""outbox events
+
+Revision ID: e2a91f5c7b08
+Revises: c47e0b9f1d23
+Create Date: 2026-10-19 15:21:09.604412
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a91f5c7b08'
+down_revision: Union[str, None] = 'c47e0b9f1d23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('outbox_events',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('event_type', sa.String(), nullable=False),
+    sa.Column('aggregate_id', sa.String(), nullable=True),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_outbox_events_event_type'), 'outbox_events', ['event_type'], unique=False)
+    op.create_table('event_checkpoints',
+    sa.Column('consumer', sa.String(), nullable=False),
+    sa.Column('last_event_id', sa.Integer(), nullable=False),
+    sa.Column('locked_by', sa.String(), nullable=True),
+    sa.Column('locked_until', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('consumer')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('event_checkpoints')
+    op.drop_index(op.f('ix_outbox_events_event_type'), table_name='outbox_events')
+    op.drop_table('outbox_events')
@@ -0,0 +1,42 @@
+"""doctor user link
+
+Revision ID: e7c4a2d9b613
+Revises: d5a0f28c6e31
+Create Date: 2026-10-20 08:14:52.630771
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7c4a2d9b613'
+down_revision: Union[str, None] = 'd5a0f28c6e31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    id_type = postgresql.UUID() if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    with op.batch_alter_table('doctors') as batch_op:
+        batch_op.add_column(sa.Column('user_id', id_type, nullable=True))
+    # Accounts were matched to doctor profiles by email until now
+    op.execute(
+        "UPDATE doctors SET user_id = (SELECT users.id FROM users WHERE users.email = doctors.email)"
+    )
+    with op.batch_alter_table('doctors') as batch_op:
+        batch_op.create_unique_constraint('uq_doctors_user_id', ['user_id'])
+        batch_op.create_foreign_key('fk_doctors_user_id_users', 'users', ['user_id'], ['id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('doctors') as batch_op:
+        batch_op.drop_constraint('fk_doctors_user_id_users', type_='foreignkey')
+        batch_op.drop_constraint('uq_doctors_user_id', type_='unique')
+        batch_op.drop_column('user_id')
@@ -0,0 +1,47 @@
+"""retention archive and hot-table indexes
+
+Revision ID: f3b8d2e6a914
+Revises: e2a91f5c7b08
+Create Date: 2026-10-19 16:48:52.117390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b8d2e6a914'
+down_revision: Union[str, None] = 'e2a91f5c7b08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('archive_segments',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('user_id', sa.String(), nullable=True),
+    sa.Column('period', sa.String(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_archive_segments_lookup', 'archive_segments', ['table_name', 'user_id', 'period'], unique=False)
+    op.create_index('ix_appointments_user_created', 'appointments', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_notifications_user_created', 'notifications', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_otps_user_id', 'otps', ['user_id'], unique=False)
+    op.create_index('ix_otps_expires_at', 'otps', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_otps_expires_at', table_name='otps')
+    op.drop_index('ix_otps_user_id', table_name='otps')
+    op.drop_index('ix_notifications_user_created', table_name='notifications')
+    op.drop_index('ix_appointments_user_created', table_name='appointments')
+    op.drop_index('ix_archive_segments_lookup', table_name='archive_segments')
+    op.drop_table('archive_segments')
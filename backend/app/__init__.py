@@ -1,11 +1,112 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import scoped_session
 from .models import Base
+from . import shards
+import glob
 import os
+import re
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+# Pool sizing follows the worker threadpool (set by app.serve); defaults otherwise
+_pool_options = {
+    option: int(os.environ[name])
+    for option, name in (("pool_size", "DB_POOL_SIZE"), ("max_overflow", "DB_MAX_OVERFLOW"))
+    if os.getenv(name) and ":memory:" not in DATABASE_URL
+}
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **_pool_options)
+# One engine per region shard when SHARD_MAP is set; engines["default"] is engine
+engines = shards.configure(engine, connect_args={"check_same_thread": False}, **_pool_options)
+SessionLocal = scoped_session(shards.sessionmaker(autocommit=False, autoflush=False))
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+MIGRATIONS_DIR = os.path.join(BACKEND_DIR, "alembic", "versions")
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0") == "1"
+
+_REVISION_RE = re.compile(r"^revision(?:: str)? = ['\"](\w+)['\"]", re.M)
+_DOWN_REVISION_RE = re.compile(r"^down_revision(?:: [^=]+)? = (?:['\"](\w+)['\"]|None)", re.M)
+
+
+def schema_head():
+    """Latest Alembic revision, read from the version files without importing alembic."""
+    revisions = {}
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, "*.py")):
+        with open(path) as f:
+            source = f.read()
+        rev = _REVISION_RE.search(source)
+        if rev:
+            down = _DOWN_REVISION_RE.search(source)
+            revisions[rev.group(1)] = down.group(1) if down else None
+    heads = set(revisions) - set(revisions.values())
+    if len(heads) != 1:
+        raise RuntimeError(f"Expected a single migration head, found {sorted(heads)}")
+    return heads.pop()
+
+
+def schema_revision(conn):
+    try:
+        return conn.execute(text("SELECT version_num FROM alembic_version")).scalar()
+    except Exception:
+        conn.rollback()
+        return None
+
+
+def upgrade_schema(url=DATABASE_URL):
+    from alembic import command
+    from alembic.config import Config
+
+    # No ini file: alembic.ini's logging setup would reset the server's loggers
+    cfg = Config()
+    cfg.set_main_option("script_location", os.path.join(BACKEND_DIR, "alembic"))
+    cfg.set_main_option("sqlalchemy.url", url.replace("%", "%%"))
+    cfg.attributes["explicit_url"] = True  # env.py: don't replace it with DATABASE_URL
+    command.upgrade(cfg, "head")
+
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    """Verify the database is at the latest migration (one small query).
+
+    Alembic owns the schema; set DB_AUTO_MIGRATE=1 to upgrade on startup
+    instead of failing (single-process/dev use only).
+    """
+    head = schema_head()
+    for name, shard_engine in engines.items():
+        with shard_engine.connect() as conn:
+            current = schema_revision(conn)
+        if current == head:
+            continue
+        if DB_AUTO_MIGRATE:
+            upgrade_schema(shard_engine.url.render_as_string(hide_password=False))
+            continue
+        where = "" if name == shards.DEFAULT else f"Shard {name}: "
+        raise RuntimeError(
+            f"{where}Database schema is at revision {current or '(unversioned)'}, expected {head}. "
+            "Run 'alembic upgrade head' from the backend directory (or set DB_AUTO_MIGRATE=1)"
+            + (", or 'python -m app.shards init' for every shard." if shards.is_sharded() else ".")
+        )
+
+
+def create_schema(bind=engine):
+    """Create all tables from the models and stamp them as the latest migration (tests, benchmarks)."""
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS alembic_version (version_num VARCHAR(32) NOT NULL PRIMARY KEY)"))
+        conn.execute(text("DELETE FROM alembic_version"))
+        conn.execute(text("INSERT INTO alembic_version (version_num) VALUES (:v)"), {"v": schema_head()})
+
+
+def warmup():
+    """Pay one-off costs before workers fork (e.g. gunicorn --preload with APP_WARMUP=1)."""
+    from . import utils
+    import jwt, requests, httpx, aiosmtplib  # noqa: F401
+
+    utils.get_pwd_context().hash("warmup")  # loads the bcrypt backend
+    init_db()
+    # Pooled connections must not be inherited across fork
+    for shard_engine in engines.values():
+        shard_engine.dispose()
+
+
+def reset_after_fork():
+    """Run in each forked worker: drop the parent's pooled connections without closing them."""
+    for shard_engine in engines.values():
+        shard_engine.dispose(close=False)
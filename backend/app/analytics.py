@@ -0,0 +1,255 @@
+# Admin analytics over precomputed daily rollups
+#
+# The "analytics" outbox consumer turns domain events into per-day counters in
+# daily_rollups, in the same transaction that advances its checkpoint, so each
+# event is counted exactly once. The dashboard endpoints only read rollup rows
+# (one per day and dimension) and never scan appointments, doctors or OTPs.
+#
+#   python -m app.analytics --rebuild   # recompute rollups from existing rows
+
+import argparse
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from . import models, shards
+from .events import subscribe
+from .models import Appointment, DailyRollup, Doctor, EventCheckpoint, OTP, OutboxEvent, Service
+from .routes import PAYMENT_AMOUNT, get_current_user, get_db
+
+CONSUMER = "analytics"
+_table = DailyRollup.__table__
+
+_FUNNEL_STAGES = {
+    "DoctorRegistered": "registered",
+    "DoctorSubmitted": "submitted",
+    "DoctorApproved": "approved",
+    "DoctorRejected": "rejected",
+}
+
+
+def _dialect(conn):
+    return conn.dialect if hasattr(conn, "dialect") else conn.get_bind().dialect
+
+
+def increment(conn, metric, day, dim1="", dim2="", count=1, amount=0):
+    """Add count and amount to one rollup row using conn's transaction."""
+    row = {"metric": metric, "day": day, "dim1": dim1 or "", "dim2": dim2 or "", "count": count, "amount": amount or 0}
+    dialect = _dialect(conn).name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        stmt = upsert(_table).values(**row)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=["metric", "day", "dim1", "dim2"],
+            set_={"count": _table.c.count + stmt.excluded.count, "amount": _table.c.amount + stmt.excluded.amount},
+        ))
+        return
+    key = (_table.c.metric == metric) & (_table.c.day == day) & (_table.c.dim1 == row["dim1"]) & (_table.c.dim2 == row["dim2"])
+    if not conn.execute(update(_table).where(key).values(count=_table.c.count + count, amount=_table.c.amount + row["amount"])).rowcount:
+        conn.execute(insert(_table).values(**row))
+
+
+@subscribe(CONSUMER, "AppointmentBooked", "PaymentSucceeded", "PaymentFailed", "OtpIssued", "OtpVerified", "DoctorsReviewed", *_FUNNEL_STAGES)
+def update_rollups(db, payload, event):
+    day = event.created_at.date()
+    kind = event.event_type
+    if kind == "AppointmentBooked":
+        service_id = payload.get("service_id")
+        if service_id is None:  # events recorded before the payload carried it
+            service_id = db.query(Appointment.service_id).filter(Appointment.id == payload["appointment_id"]).scalar()
+        price = db.query(Service.price).filter(Service.id == service_id).scalar() or 0
+        increment(db, "appointments", day, service_id, payload.get("doctor_id"), amount=price)
+        increment(db, "revenue", day, "booked", amount=price)
+    elif kind in ("PaymentSucceeded", "PaymentFailed"):
+        increment(db, "revenue", day, "paid" if kind == "PaymentSucceeded" else "failed", amount=payload.get("amount"))
+    elif kind in ("OtpIssued", "OtpVerified"):
+        increment(db, "otp", day, payload.get("type"), "issued" if kind == "OtpIssued" else "verified")
+    elif kind == "DoctorsReviewed":
+        # Bulk review: one event, one funnel step per decision
+        stages = Counter(decision["approval_status"] for decision in payload["decisions"])
+        for stage, count in stages.items():
+            increment(db, "doctor_funnel", day, stage, count=count)
+    else:
+        increment(db, "doctor_funnel", day, _FUNNEL_STAGES[kind])
+
+
+def _as_date(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def rebuild(engine, catalog=None):
+    """Recompute every rollup from the current tables and move the analytics
+    checkpoint past all recorded events.
+
+    Base rows only keep their creation time, so payments, doctor reviews and
+    OTP verifications are attributed to the day the row was created. Archived
+    appointments (see retention.py) are not included.
+
+    With shards, run it once per shard engine: catalog is the default shard's
+    engine, where services and doctors live (the doctor funnel is counted there).
+    """
+    catalog = catalog or engine
+    appt_day = func.date(Appointment.created_at)
+    doctor_day = func.date(Doctor.created_at)
+    otp_day = func.date(OTP.expires_at)
+    with catalog.connect() as conn:
+        prices = dict(conn.execute(select(Service.id, Service.price)).all())
+    with engine.begin() as conn:
+        conn.execute(delete(_table))
+        booked = select(appt_day, Appointment.service_id, Appointment.doctor_id, func.count()) \
+            .group_by(appt_day, Appointment.service_id, Appointment.doctor_id)
+        for day, service_id, doctor_id, count in conn.execute(booked):
+            amount = count * (prices.get(service_id) or 0)
+            increment(conn, "appointments", _as_date(day), service_id, doctor_id, count, amount)
+            increment(conn, "revenue", _as_date(day), "booked", count=count, amount=amount)
+        payments = select(appt_day, Appointment.payment_status, func.count()) \
+            .where(Appointment.payment_status.in_(["paid", "failed"])).group_by(appt_day, Appointment.payment_status)
+        for day, status, count in conn.execute(payments):
+            increment(conn, "revenue", _as_date(day), status, count=count, amount=count * PAYMENT_AMOUNT)
+        stages = [
+            ("registered", None),
+            ("submitted", Doctor.kmpdc_license.isnot(None)),
+            ("approved", Doctor.approval_status == "approved"),
+            ("rejected", Doctor.approval_status == "rejected"),
+        ]
+        for stage, condition in stages if engine is catalog else ():
+            q = select(doctor_day, func.count()).select_from(Doctor).group_by(doctor_day)
+            if condition is not None:
+                q = q.where(condition)
+            for day, count in conn.execute(q):
+                increment(conn, "doctor_funnel", _as_date(day), stage, count=count)
+        otps = select(otp_day, OTP.type, OTP.is_used, func.count()).group_by(otp_day, OTP.type, OTP.is_used)
+        for day, otp_type, used, count in conn.execute(otps):
+            otp_type = otp_type.value if hasattr(otp_type, "value") else otp_type
+            increment(conn, "otp", _as_date(day), otp_type, "issued", count)
+            if used:
+                increment(conn, "otp", _as_date(day), otp_type, "verified", count)
+        last_event = conn.execute(select(func.coalesce(func.max(OutboxEvent.id), 0))).scalar()
+        checkpoints = EventCheckpoint.__table__
+        if not conn.execute(update(checkpoints).where(checkpoints.c.consumer == CONSUMER).values(last_event_id=last_event)).rowcount:
+            conn.execute(insert(checkpoints).values(consumer=CONSUMER, last_event_id=last_event))
+
+
+router = APIRouter(prefix="/admin/analytics")
+
+
+def require_superuser(current_user: models.User = Depends(get_current_user)):
+    if current_user.role != models.UserRole.superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return current_user
+
+
+def _range(start, end):
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=29)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+
+def _totals(db, metric, start, end, *group):
+    q = db.query(*group, func.sum(DailyRollup.count), func.sum(DailyRollup.amount)).filter(
+        DailyRollup.metric == metric, DailyRollup.day >= start, DailyRollup.day <= end
+    )
+    rows = shards.scatter(q.group_by(*group).order_by(*group)).all()
+    if not shards.is_sharded():
+        return rows
+    # Every shard keeps rollups for its own events; add up the per-shard groups
+    merged = {}
+    for *key, count, amount in rows:
+        total = merged.setdefault(tuple(key), [0, 0])
+        total[0] += count or 0
+        total[1] += amount or 0
+    return [(*key, count, amount) for key, (count, amount) in sorted(merged.items())]
+
+
+@router.get("/appointments")
+def appointment_stats(
+    group_by: str = "day",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(require_superuser),
+):
+    columns = {"day": DailyRollup.day, "service": DailyRollup.dim1, "doctor": DailyRollup.dim2}
+    if group_by not in columns:
+        raise HTTPException(status_code=400, detail="group_by must be one of day, service, doctor")
+    start, end = _range(start, end)
+    rows = _totals(db, "appointments", start, end, columns[group_by])
+    names = {}
+    if group_by == "service":
+        names = dict(db.query(Service.id, Service.name).filter(Service.id.in_([r[0] for r in rows if r[0]])).all())
+    elif group_by == "doctor":
+        names = dict(db.query(Doctor.id, Doctor.name).filter(Doctor.id.in_([r[0] for r in rows if r[0]])).all())
+    return [
+        {group_by: key, **({"name": names.get(key)} if names else {}), "appointments": count, "value": amount}
+        for key, count, amount in rows
+    ]
+
+
+@router.get("/revenue")
+def revenue_stats(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(require_superuser),
+):
+    start, end = _range(start, end)
+    return [
+        {"day": day, "status": status, "count": count, "amount": amount}
+        for day, status, count, amount in _totals(db, "revenue", start, end, DailyRollup.day, DailyRollup.dim1)
+    ]
+
+
+@router.get("/doctor-funnel")
+def doctor_funnel(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(require_superuser),
+):
+    start, end = _range(start, end)
+    counts = {stage: 0 for stage in _FUNNEL_STAGES.values()}
+    counts.update({stage: count for stage, count, _ in _totals(db, "doctor_funnel", start, end, DailyRollup.dim1)})
+    return counts
+
+
+@router.get("/otp")
+def otp_conversion(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(require_superuser),
+):
+    start, end = _range(start, end)
+    by_type = {}
+    for otp_type, stage, count, _ in _totals(db, "otp", start, end, DailyRollup.dim1, DailyRollup.dim2):
+        by_type.setdefault(otp_type, {"issued": 0, "verified": 0})[stage] = count
+    return [
+        {"type": otp_type, **c, "conversion": round(c["verified"] / c["issued"], 4) if c["issued"] else None}
+        for otp_type, c in by_type.items()
+    ]
+
+
+def main():
+    from .__init__ import engine, engines
+
+    parser = argparse.ArgumentParser(description="Maintain analytics rollups")
+    parser.add_argument("--rebuild", action="store_true", help="recompute all rollups from the base tables")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.error("nothing to do (use --rebuild)")
+    for shard_engine in engines.values():
+        rebuild(shard_engine, catalog=engine)
+    print("analytics rollups rebuilt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# Append-only audit trail for admin and clinical actions
+#
+# record() appends a tuple to a bounded in-memory buffer and returns; it does
+# no I/O, serialization or hashing, so it costs about a microsecond on the
+# request path. A background thread drains the buffer every
+# AUDIT_FLUSH_INTERVAL seconds (or as soon as AUDIT_BATCH_SIZE entries are
+# waiting) and inserts each batch into audit_log in one transaction.
+#
+# Entries form a hash chain: each row stores the previous row's hash and
+# hash = SHA-256(prev_hash + entry), keyed with AUDIT_HMAC_KEY when it is set.
+# Editing, deleting or reordering rows breaks the chain, which verify() and
+# GET /admin/audit/verify report. seq is the primary key, so two processes
+# flushing at once cannot fork the chain: the loser gets a conflict, re-reads
+# the tail and rehashes its batch. On SQLite and PostgreSQL, triggers reject
+# UPDATE and DELETE on audit_log.
+#
+#   python -m app.audit --verify
+
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from . import metrics
+from .models import AuditEntry
+
+logger = logging.getLogger(__name__)
+
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "65536"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_HMAC_KEY = os.getenv("AUDIT_HMAC_KEY", "").encode()
+
+GENESIS = "0" * 64
+
+AUDIT_EVENTS = metrics.register(metrics.Counter(
+    "audit_events_total", "Audit entries by outcome (written, dropped on a full buffer, failed flushes).", ("outcome",)))
+
+_table = AuditEntry.__table__
+_buffer = collections.deque()
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+_flush_lock = threading.Lock()  # one flush at a time per process
+_dropped = collections.deque(maxlen=AUDIT_BUFFER_SIZE)  # actions of entries lost to a full buffer
+
+
+def record(action, actor_id=None, subject_type=None, subject_id=None, **details):
+    """Queue an audit entry; call after the audited change has committed."""
+    if len(_buffer) >= AUDIT_BUFFER_SIZE:
+        # The flusher is far behind (database down?); logged once per flush attempt
+        AUDIT_EVENTS.inc(("dropped",))
+        _dropped.append(action)
+        return
+    # deque.append is atomic, so request threads never take a lock here
+    _buffer.append((datetime.utcnow(), actor_id, action, subject_type, subject_id, details or None))
+    if len(_buffer) >= AUDIT_BATCH_SIZE:
+        _wake.set()
+
+
+def _digest(prev_hash, row):
+    message = prev_hash.encode() + json.dumps([
+        row["seq"], row["created_at"].isoformat(), row["actor_id"], row["action"],
+        row["subject_type"], row["subject_id"], row["details"],
+    ], separators=(",", ":")).encode()
+    if AUDIT_HMAC_KEY:
+        return hmac.new(AUDIT_HMAC_KEY, message, hashlib.sha256).hexdigest()
+    return hashlib.sha256(message).hexdigest()
+
+
+def _chain(entries, seq, prev_hash):
+    rows = []
+    for created_at, actor_id, action, subject_type, subject_id, details in entries:
+        seq += 1
+        row = {
+            "seq": seq, "created_at": created_at, "actor_id": _str(actor_id), "action": action,
+            "subject_type": subject_type, "subject_id": _str(subject_id),
+            "details": json.dumps(details, default=str, sort_keys=True) if details else None,
+        }
+        row["prev_hash"] = prev_hash
+        row["hash"] = prev_hash = _digest(prev_hash, row)
+        rows.append(row)
+    return rows
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _tail(conn):
+    last = conn.execute(select(_table.c.seq, _table.c.hash).order_by(_table.c.seq.desc()).limit(1)).first()
+    return (last.seq, last.hash) if last else (0, GENESIS)
+
+
+def flush(engine, limit=None):
+    """Write buffered entries to audit_log in batches; returns the number written."""
+    written = 0
+    with _flush_lock:
+        if _dropped:
+            actions = collections.Counter(_dropped.popleft() for _ in range(len(_dropped)))
+            logger.error("Audit buffer was full; dropped entries: %s", dict(actions))
+        while _buffer and (limit is None or written < limit):
+            batch = []
+            while _buffer and len(batch) < AUDIT_BATCH_SIZE:
+                batch.append(_buffer.popleft())
+            try:
+                _write(engine, batch)
+            except Exception:
+                # Put the batch back in order; the next flush retries it
+                _buffer.extendleft(reversed(batch))
+                AUDIT_EVENTS.inc(("failed",))
+                raise
+            written += len(batch)
+            AUDIT_EVENTS.inc(("written",), len(batch))
+    return written
+
+
+def _write(engine, batch, attempts=5):
+    for attempt in range(attempts):
+        try:
+            with engine.begin() as conn:
+                seq, prev_hash = _tail(conn)
+                conn.execute(insert(_table), _chain(batch, seq, prev_hash))
+            return
+        except IntegrityError:
+            # Another process appended first; chain onto its tail instead
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+
+def verify(engine, chunk_size=5000):
+    """Recompute the chain; returns {"entries", "head", "broken_at"} (broken_at is None when intact)."""
+    prev_seq, prev_hash, checked = 0, GENESIS, 0
+    with engine.connect() as conn:
+        while True:
+            rows = conn.execute(
+                select(_table).where(_table.c.seq > prev_seq).order_by(_table.c.seq).limit(chunk_size)
+            ).mappings().all()
+            for row in rows:
+                if row["seq"] != prev_seq + 1 or row["prev_hash"] != prev_hash or _digest(prev_hash, row) != row["hash"]:
+                    return {"entries": checked, "head": prev_hash, "broken_at": row["seq"]}
+                prev_seq, prev_hash = row["seq"], row["hash"]
+                checked += 1
+            if len(rows) < chunk_size:
+                return {"entries": checked, "head": prev_hash, "broken_at": None}
+
+
+def start(engine):
+    """Flush the buffer in a daemon thread until stop()."""
+    global _thread
+    if _thread is not None:
+        return
+    _stop.clear()
+
+    def loop():
+        while not _stop.is_set():
+            _wake.wait(AUDIT_FLUSH_INTERVAL)
+            _wake.clear()
+            try:
+                flush(engine)
+            except Exception:
+                logger.exception("Audit flush failed; %d entries waiting", len(_buffer))
+
+    _thread = threading.Thread(target=loop, name="audit-flusher", daemon=True)
+    _thread.start()
+
+
+def stop(engine, timeout=10):
+    """Stop the flusher and write whatever is still buffered."""
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout)
+        _thread = None
+    try:
+        flush(engine)
+    except Exception:
+        logger.exception("Final audit flush failed; %d entries lost", len(_buffer))
+
+
+def search(db, actor_id=None, subject_type=None, subject_id=None, action=None, start=None, end=None,
+           before_seq=None, limit=100):
+    """Entries matching every given filter, newest first; page with before_seq=<last seq>."""
+    q = db.query(AuditEntry)
+    if actor_id:
+        q = q.filter(AuditEntry.actor_id == actor_id)
+    if subject_type:
+        q = q.filter(AuditEntry.subject_type == subject_type)
+    if subject_id:
+        q = q.filter(AuditEntry.subject_id == subject_id)
+    if action:
+        q = q.filter(AuditEntry.action == action)
+    if start:
+        q = q.filter(AuditEntry.created_at >= start)
+    if end:
+        q = q.filter(AuditEntry.created_at < end)
+    if before_seq:
+        q = q.filter(AuditEntry.seq < before_seq)
+    return q.order_by(AuditEntry.seq.desc()).limit(limit).all()
+
+
+def main():
+    from .__init__ import engine
+
+    parser = argparse.ArgumentParser(description="Check the audit log")
+    parser.add_argument("--verify", action="store_true", help="recompute the hash chain")
+    args = parser.parse_args()
+    if not args.verify:
+        parser.error("nothing to do (use --verify)")
+    result = verify(engine)
+    if result["broken_at"] is not None:
+        print(f"audit chain broken at seq {result['broken_at']} after {result['entries']} valid entries")
+        raise SystemExit(1)
+    print(f"audit chain intact: {result['entries']} entries, head {result['head']}")
+
+
+if __name__ == "__main__":
+    main()
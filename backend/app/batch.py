@@ -0,0 +1,102 @@
+# Dashboard bootstrap: runs the read calls a dashboard makes on load under one
+# auth resolution and returns them as a single payload.
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy.orm import Session
+
+from . import models, schemas, shards
+from . import routes
+from .__init__ import SessionLocal
+from .routes import get_db, get_current_user_with_doctor, oauth2_scheme
+
+router = APIRouter()
+
+# Reference lists do not depend on the request session's state, so they run
+# concurrently on their own session while the user-scoped reads run on the
+# request session (a Session is not safe to share between threads).
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bootstrap")
+
+
+def _dump(schema, value):
+    return jsonable_encoder(TypeAdapter(schema).validate_python(value, from_attributes=True))
+
+
+def _profile(db, user, token):
+    profile = routes.get_profile(db=db, current_user=user)
+    if profile.get("doctor_profile") is not None:
+        profile["doctor_profile"] = _dump(schemas.DoctorOut, profile["doctor_profile"])
+    return jsonable_encoder(profile)
+
+
+def _doctor_profile(user):
+    # Loaded together with the user (get_current_user_with_doctor)
+    if user.doctor is None:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    return user.doctor
+
+
+# name -> (loader(db, user, token), response schema or None, shared reference data)
+SECTIONS = {
+    "profile": (_profile, None, False),
+    "doctor_profile": (lambda db, user, token: _doctor_profile(user), schemas.DoctorOut, False),
+    "patient_profile": (lambda db, user, token: user, schemas.UserOut, False),
+    "appointments": (lambda db, user, token: routes.list_appointments(include_archived=False, db=db, current_user=user, projection=None), List[schemas.AppointmentOut], False),
+    "notifications": (lambda db, user, token: routes.get_notifications(limit=100, before=None, db=db, current_user=user, projection=None), List[schemas.NotificationOut], False),
+    "pending_doctors": (lambda db, user, token: routes.list_pending_doctors(db=db, current_user=user, projection=None), List[schemas.DoctorOut], False),
+    "services": (lambda db, user, token: routes.list_services(db=db, projection=None), List[schemas.ServiceOut], True),
+    "doctors": (lambda db, user, token: routes.list_doctors(service=None, db=db, current_user=user, projection=None), List[schemas.DoctorOut], True),
+}
+
+ROLE_SECTIONS = {
+    models.UserRole.patient: ["profile", "patient_profile", "appointments", "notifications", "services", "doctors"],
+    models.UserRole.doctor: ["profile", "doctor_profile", "appointments", "notifications", "services"],
+    models.UserRole.superuser: ["profile", "notifications", "pending_doctors", "services", "doctors"],
+}
+
+
+def _load(name, db, user, token):
+    loader, schema, _ = SECTIONS[name]
+    value = loader(db, user, token)
+    return _dump(schema, value) if schema is not None else value
+
+
+def _load_shared(names, user, token, shard):
+    db = SessionLocal()
+    shards.bind(db, shard)
+    try:
+        # Re-attach the user so relationship loads use this thread's session
+        local_user = db.merge(user, load=False)
+        return {name: _run(name, db, local_user, token) for name in names}
+    finally:
+        db.close()
+
+
+def _run(name, db, user, token):
+    try:
+        return {"status": 200, "data": _load(name, db, user, token)}
+    except HTTPException as e:
+        return {"status": e.status_code, "detail": e.detail}
+
+
+@router.get("/bootstrap")
+def bootstrap(
+    include: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_with_doctor),
+    token: str = Depends(oauth2_scheme),
+):
+    names = [n.strip() for n in include.split(",") if n.strip()] if include else ROLE_SECTIONS[current_user.role]
+    unknown = [n for n in names if n not in SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(unknown)}")
+    shared = [n for n in names if SECTIONS[n][2]]
+    shared_future = _executor.submit(_load_shared, shared, current_user, token, shards.shard_of(db)) if shared else None
+    results = {n: _run(n, db, current_user, token) for n in names if not SECTIONS[n][2]}
+    if shared_future is not None:
+        results.update(shared_future.result())
+    return {"role": current_user.role.value, "sections": {n: results[n] for n in names}}
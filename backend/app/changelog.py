@@ -0,0 +1,73 @@
+# Row-level change log for delta sync (see sync.py), written in the same
+# transaction as the change.
+#
+# Every flush that inserts, updates or deletes a synced row appends one
+# sync_changes entry per row: table, row id, the user whose list the row
+# belongs to (null for shared rows such as services) and whether it was
+# deleted. Deletes leave their entry behind as a tombstone. Changes to
+# certificates are logged against their doctor, whose payload embeds them.
+# The log lives on the same shard as the rows. seq orders it, and sync
+# tokens point into it.
+#
+# Writes that bypass the ORM (bulk UPDATEs, the importer) call record() themselves.
+
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from .models import Appointment, Doctor, Notification, Service, SyncChange
+
+# table -> (model, column holding the owning user's id or None for shared rows)
+SYNCED_TABLES = {
+    "services": (Service, None),
+    "doctors": (Doctor, None),
+    "appointments": (Appointment, "user_id"),
+    "notifications": (Notification, "user_id"),
+}
+# Child tables embedded in a parent's payload: table -> (parent table, column holding the parent id)
+NESTED_TABLES = {"doctor_certificates": ("doctors", "doctor_id")}
+
+_table = SyncChange.__table__
+
+
+def record(conn, changes):
+    """Append (table, row_id, owner_id, deleted) entries to the log using conn's transaction."""
+    now = datetime.utcnow()
+    rows = [{"table_name": t, "row_id": r, "owner_id": o, "deleted": d, "changed_at": now} for t, r, o, d in changes]
+    if rows:
+        conn.execute(insert(_table), rows)
+
+
+def entry(table_name, row):
+    """(table, row id, owner id) for an ORM object or a result row of a synced table."""
+    owner = SYNCED_TABLES[table_name][1]
+    return (table_name, row.id, getattr(row, owner) if owner else None)
+
+
+def _changes(session):
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    for deleted, objects in ((False, session.new), (False, dirty), (True, session.deleted)):
+        for obj in objects:
+            name = getattr(obj, "__tablename__", None)
+            if name in SYNCED_TABLES:
+                yield (*entry(name, obj), deleted)
+            elif name in NESTED_TABLES:
+                parent, column = NESTED_TABLES[name]
+                if getattr(obj, column) is not None:
+                    yield (parent, getattr(obj, column), None, False)
+
+
+@event.listens_for(Session, "after_flush")
+def _log_changes(session, flush_context):
+    # new/dirty/deleted still describe the flush that just ran, and new rows now have their ids
+    conns, by_conn = {}, defaultdict(dict)
+    for table_name, row_id, owner_id, deleted in _changes(session):
+        conn = conns.get(table_name)
+        if conn is None:
+            # Rows of one table are on one shard; write the entry next to them
+            conn = conns[table_name] = session.connection(bind_arguments={"mapper": SYNCED_TABLES[table_name][0].__mapper__})
+        by_conn[conn][(table_name, row_id)] = (table_name, row_id, owner_id, deleted)
+    for conn, changes in by_conn.items():
+        record(conn, changes.values())
@@ -0,0 +1,114 @@
+# Single-flight coalescing for hot, read-only list queries
+#
+# When many requests ask the same question at the same moment (the services
+# catalogue, the doctor directory, the admin review queue), only the first one
+# runs the query. Requests arriving while it is in flight wait for it and get
+# the same result, so a burst of N identical requests costs one round trip.
+#
+# Keys are built by the route from everything that changes the answer: the
+# route, its query parameters and the caller's authorization scope (e.g.
+# "superuser" vs "approved doctors only"), never the caller's identity unless
+# the result is personal. Results must not hold ORM instances; routes convert
+# them to response schemas first, because followers use them from other
+# sessions and threads.
+#
+# COALESCE_CACHE_TTL keeps a finished result for that many seconds so requests
+# just behind the burst also reuse it. It is off by default: a cached list can
+# then be up to that old, on top of the version counters behind the ETag.
+
+import os
+import threading
+import time
+
+from . import metrics
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+COALESCE_CACHE_TTL = float(os.getenv("COALESCE_CACHE_TTL", "0"))  # seconds; 0 shares in-flight calls only
+COALESCE_MAX_KEYS = int(os.getenv("COALESCE_MAX_KEYS", "1024"))  # cached results kept per process
+
+COALESCED_REQUESTS = metrics.register(metrics.Counter(
+    "coalesced_requests_total",
+    "Coalesced reads by outcome (executed the query, shared an in-flight result, served from the micro-cache).",
+    ("route", "outcome")))
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "expires")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = 0.0
+
+
+class SingleFlight:
+    """Runs fn once per key among concurrent callers and hands everyone its result (or exception)."""
+
+    def __init__(self, ttl=COALESCE_CACHE_TTL, max_keys=COALESCE_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, route, key, fn):
+        key = (route, *key)
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.done.is_set() and call.expires <= time.monotonic():
+                call = None
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            outcome = "cached" if call.done.is_set() else "shared"
+            call.done.wait()
+            COALESCED_REQUESTS.inc((route, outcome))
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        COALESCED_REQUESTS.inc((route, "executed"))
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                if call.error is None and self.ttl > 0:
+                    call.expires = time.monotonic() + self.ttl
+                    self._prune()
+                else:
+                    # Errors are shared with the callers already waiting, never cached
+                    self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def _prune(self):
+        if len(self._calls) <= self.max_keys:
+            return
+        now = time.monotonic()
+        for key, call in list(self._calls.items()):
+            if call.done.is_set() and call.expires <= now:
+                del self._calls[key]
+        while len(self._calls) > self.max_keys:
+            # Still full of live entries: drop the oldest finished ones
+            oldest = next((k for k, c in self._calls.items() if c.done.is_set()), None)
+            if oldest is None:
+                break
+            del self._calls[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._calls = {k: c for k, c in self._calls.items() if not c.done.is_set()}
+
+
+flights = SingleFlight()
+
+
+def shared(route, key, fn):
+    """Return fn(), sharing one execution among concurrent callers with the same (route, key)."""
+    if not COALESCE_ENABLED:
+        return fn()
+    return flights.do(route, tuple(key), fn)
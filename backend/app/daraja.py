@@ -1,9 +1,9 @@
 # Daraja (M-Pesa) payment API integration
 
-import requests
 import os
 import base64
 from datetime import datetime
+from .metrics import timed
 
 DARAJA_CONSUMER_KEY = os.getenv("DARAJA_CONSUMER_KEY")
 DARAJA_CONSUMER_SECRET = os.getenv("DARAJA_CONSUMER_SECRET")
@@ -13,13 +13,16 @@ DARAJA_CALLBACK_URL = os.getenv("DARAJA_CALLBACK_URL", "https://yourdomain.com/a
 DARAJA_BASE_URL = os.getenv("DARAJA_BASE_URL", "https://sandbox.safaricom.co.ke")
 
 
+@timed("daraja", "oauth")
 def get_access_token():
+    import requests
     url = f"{DARAJA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
     resp = requests.get(url, auth=(DARAJA_CONSUMER_KEY, DARAJA_CONSUMER_SECRET))
     resp.raise_for_status()
     return resp.json()["access_token"]
 
 
+@timed("daraja", "stk_push")
 def initiate_stk_push(phone_number: str, amount: int):
     access_token = get_access_token()
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -42,6 +45,7 @@ def initiate_stk_push(phone_number: str, amount: int):
         "TransactionDesc": "Consultation Payment"
     }
     url = f"{DARAJA_BASE_URL}/mpesa/stkpush/v1/processrequest"
+    import requests
     resp = requests.post(url, json=payload, headers=headers)
     if resp.status_code == 200:
         return resp.json()
@@ -0,0 +1,83 @@
+# Per-table version counters, bumped in the same transaction as the write.
+# Used to build ETags for list endpoints without running the list query.
+
+import os
+import threading
+import time
+
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+
+from .models import DataVersion
+
+VERSION_CACHE_TTL = float(os.getenv("DATA_VERSION_CACHE_TTL", "0"))  # seconds; 0 reads on every check
+
+_table = DataVersion.__table__
+# Tables some versioned_etag() reads; writes to any other table bump nothing,
+# so busy tables (otps, notifications, outbox) do not contend on a counter row
+VERSIONED_TABLES = {"services", "doctors", "doctor_certificates"}
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def bump(conn, names):
+    """Increment the version of each versioned table in names using conn's transaction."""
+    names = sorted(set(names) & VERSIONED_TABLES)
+    if not names:
+        return
+    if conn.dialect.name in ("postgresql", "sqlite"):
+        if conn.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(_table).on_conflict_do_update(index_elements=["name"], set_={"version": _table.c.version + 1})
+        conn.execute(stmt, [{"name": n, "version": 1} for n in names])
+    else:
+        conn.execute(update(_table).where(_table.c.name.in_(names)).values(version=_table.c.version + 1))
+    with _cache_lock:
+        for n in names:
+            _cache.pop(n, None)
+
+
+def current(engine, names):
+    """Return {name: version} for the given tables (0 for tables never written)."""
+    now = time.monotonic()
+    result = {}
+    missing = []
+    with _cache_lock:
+        for n in names:
+            cached = _cache.get(n)
+            if cached and cached[1] > now:
+                result[n] = cached[0]
+            else:
+                missing.append(n)
+    if missing:
+        with engine.connect() as conn:
+            rows = dict(conn.execute(select(_table.c.name, _table.c.version).where(_table.c.name.in_(missing))).all())
+        with _cache_lock:
+            for n in missing:
+                result[n] = rows.get(n, 0)
+                if VERSION_CACHE_TTL:
+                    _cache[n] = (result[n], now + VERSION_CACHE_TTL)
+    return result
+
+
+def _touched_tables(session):
+    dirty = (obj for obj in session.dirty if session.is_modified(obj))
+    for obj in (*session.new, *dirty, *session.deleted):
+        table = getattr(obj, "__table__", None)
+        if table is not None and table.name in VERSIONED_TABLES:
+            yield table.name
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_changes(session, flush_context, instances):
+    session.info.setdefault("changed_tables", set()).update(_touched_tables(session))
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_versions(session, flush_context):
+    changed = session.info.pop("changed_tables", None)
+    if changed:
+        # data_versions lives on the default shard whichever shard the session writes to
+        bump(session.connection(bind_arguments={"mapper": DataVersion.__mapper__}), changed)
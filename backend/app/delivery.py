@@ -0,0 +1,97 @@
+# File delivery: who sends the bytes of certificates, previews, evidence and
+# message attachments
+#
+# The routes look up the file and check access; send() then hands the transfer
+# to whatever FILE_DELIVERY selects:
+#
+#   direct    the worker streams the file itself (FileResponse); no proxy needed
+#   accel     empty response with X-Accel-Redirect: <FILE_ACCEL_PREFIX>/<path>;
+#             nginx serves the file from an internal location
+#   sendfile  empty response with X-Sendfile: <absolute path> (Apache
+#             mod_xsendfile, lighttpd)
+#   signed    redirect to <FILE_URL_BASE>/<path>?expires=...&sig=..., an
+#             HMAC-SHA256 signed URL valid for FILE_URL_TTL seconds that a static
+#             server checks against FILE_URL_SECRET
+#
+# In the last three modes the worker is free as soon as the database check is
+# done. deploy/nginx/ has a local nginx config for accel and signed.
+#
+# Paths are relative to the backend directory (e.g. certificates/<id>_0.pdf),
+# as stored in the database. Each caller names the directory its files live in
+# (certificates/, evidence/, attachments/); anything outside it is a 404, so a
+# bad path in the database can never expose app.db or the config.
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from . import media
+
+FILE_DELIVERY = os.getenv("FILE_DELIVERY", "direct")  # direct, accel, sendfile or signed
+FILE_ACCEL_PREFIX = os.getenv("FILE_ACCEL_PREFIX", "/_protected").rstrip("/")
+FILE_URL_BASE = os.getenv("FILE_URL_BASE", "/files").rstrip("/")
+FILE_URL_TTL = int(os.getenv("FILE_URL_TTL", "300"))  # seconds a signed URL stays valid
+FILE_URL_SECRET = os.getenv("FILE_URL_SECRET", "").encode()  # shared with the static server; required for signed
+
+# Headers that mark a response whose body the proxy supplies (see http_cache)
+OFFLOAD_HEADERS = (b"x-accel-redirect", b"x-sendfile")
+
+
+def signature(rel_path, expires):
+    """URL-safe HMAC-SHA256 of "<expires>:<path>" with FILE_URL_SECRET, unpadded."""
+    if not FILE_URL_SECRET:
+        raise RuntimeError("FILE_URL_SECRET must be set to sign file URLs")
+    digest = hmac.new(FILE_URL_SECRET, f"{expires}:{rel_path}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def signed_url(rel_path, ttl=FILE_URL_TTL, now=None):
+    expires = int((now or time.time()) + ttl)
+    return f"{FILE_URL_BASE}/{quote(rel_path)}?expires={expires}&sig={signature(rel_path, expires)}"
+
+
+def verify(rel_path, expires, sig, now=None):
+    """Check a signed URL's parameters (for static servers written in Python, and tests)."""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    return expires >= (now or time.time()) and hmac.compare_digest(signature(rel_path, expires), sig or "")
+
+
+def _content_disposition(filename):
+    # RFC 6266: ASCII fallback plus the UTF-8 name
+    fallback = filename.encode("ascii", "replace").decode().replace('"', "")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def send(rel_path, root, media_type=None, filename=None, headers=None, mode=None):
+    """Response delivering the file at rel_path (relative to the backend directory), which must be under root."""
+    mode = mode or FILE_DELIVERY
+    root_dir = os.path.join(media.BACKEND_DIR, root)
+    abs_path = os.path.abspath(os.path.join(media.BACKEND_DIR, rel_path))
+    if not abs_path.startswith(root_dir + os.sep) or not os.path.isfile(abs_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    rel_path = os.path.relpath(abs_path, media.BACKEND_DIR).replace(os.sep, "/")
+    if mode == "direct":
+        return FileResponse(abs_path, filename=filename, media_type=media_type, headers=headers)
+    if mode == "signed":
+        # The URL is the credential: keep it out of shared caches and short-lived
+        return RedirectResponse(signed_url(rel_path), status_code=302, headers={"Cache-Control": "no-store"})
+
+    headers = dict(headers or {})
+    if filename:
+        headers["Content-Disposition"] = _content_disposition(filename)
+    if mode == "accel":
+        headers["X-Accel-Redirect"] = f"{FILE_ACCEL_PREFIX}/{quote(rel_path)}"
+    elif mode == "sendfile":
+        headers["X-Sendfile"] = abs_path
+    else:
+        raise RuntimeError(f"Unknown FILE_DELIVERY mode: {mode}")
+    return Response(status_code=200, media_type=media_type or media.content_type_for(rel_path), headers=headers)
@@ -0,0 +1,296 @@
+# Domain events via a transactional outbox
+#
+# Routes call emit() to add an event row in the same transaction as their own
+# writes. A background relay drains the outbox in id order and hands each event
+# to the consumers subscribed to its type. Every consumer keeps its own
+# checkpoint, so delivery is at-least-once per consumer: a crash between a
+# handler running and its checkpoint being saved replays that event.
+#
+# A consumer stops at an event its handler fails on, to keep its order, and
+# retries it with exponential backoff (OUTBOX_RETRY_BASE doubling up to
+# OUTBOX_RETRY_MAX seconds). After OUTBOX_MAX_ATTEMPTS failures the event is
+# copied to dead_letters and the consumer moves past it, so one bad event
+# cannot hold up the consumer, or outbox pruning, for ever. Each checkpoint
+# advance also renews the lease, so a batch of slow handlers keeps its lease as
+# long as each handler finishes within OUTBOX_LEASE_SECONDS; if the lease was
+# lost anyway, the handler's work is rolled back and the batch stops.
+#
+# The checkpoint is a high-water mark on OutboxEvent.id, but ids are taken at
+# insert and become visible at commit, so id N can appear after N+1 (PostgreSQL
+# sequences). A consumer therefore walks the ids after its checkpoint in order
+# and stops at a gap until the event after it is OUTBOX_SETTLE_SECONDS old; by
+# then the transaction holding the missing id has committed (its event shows up
+# and is delivered) or rolled back (the gap is permanent and is skipped).
+
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import event as sa_event, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import metrics, shards
+from .models import DeadLetter, OutboxEvent, EventCheckpoint
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_RELAY_ENABLED = os.getenv("OUTBOX_RELAY_ENABLED", "1") == "1"
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2.0"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "30"))  # must outlast the slowest single handler
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))  # failures before an event is dead-lettered
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))  # seconds before the first retry
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "600"))
+OUTBOX_SETTLE_SECONDS = float(os.getenv("OUTBOX_SETTLE_SECONDS", "10"))  # longest expected gap between an event's insert and its commit
+OUTBOX_BROKER = os.getenv("OUTBOX_BROKER", "")  # e.g. file:/var/spool/bfh/events.ndjson
+
+OUTBOX_EVENTS = metrics.register(metrics.Counter(
+    "outbox_events_total",
+    "Outbox event deliveries by consumer and outcome (delivered, failed, dead_lettered).",
+    ("consumer", "outcome")))
+
+
+def emit(db, event_type, payload, aggregate_id=None):
+    """Record a domain event; it becomes visible to consumers when db commits."""
+    db.add(OutboxEvent(event_type=event_type, aggregate_id=aggregate_id, payload=json.dumps(payload, default=str)))
+    db.info["outbox_pending"] = True
+
+
+# consumer name -> (event types or None for all, handler or None to forward to the broker)
+_consumers = {}
+
+
+def subscribe(consumer, *event_types):
+    """Register handler(db, payload, event) as a named consumer of event_types.
+
+    The handler runs in the same transaction that advances the consumer's
+    checkpoint, so database-only side effects are applied exactly once.
+    """
+    def decorator(func):
+        _consumers[consumer] = (frozenset(event_types), func)
+        return func
+    return decorator
+
+
+class FileBroker:
+    """Local stand-in for an external broker: appends events to an NDJSON spool file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        lines = "".join(json.dumps({
+            "id": e.id, "type": e.event_type, "aggregate_id": e.aggregate_id,
+            "payload": json.loads(e.payload), "created_at": e.created_at.isoformat(),
+        }) + "\n" for e in events)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _configure_broker():
+    if OUTBOX_BROKER.startswith("file:"):
+        broker = FileBroker(OUTBOX_BROKER[5:])
+        # Forward every event type; the broker consumer checkpoints like any other
+        _consumers["broker"] = (None, None)
+        return broker
+    return None
+
+
+class OutboxRelay:
+    def __init__(self, session_factory, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.broker = _configure_broker()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, name="outbox-relay"):
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delivered = self.drain_once()
+            except Exception:
+                logger.exception("Outbox relay iteration failed")
+                delivered = 0
+            # Keep draining while there is a backlog; otherwise wait for a commit or the poll interval
+            if delivered < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def drain_once(self):
+        """Deliver at most one batch per consumer; returns the largest batch delivered."""
+        delivered = 0
+        for consumer, (event_types, handler) in list(_consumers.items()):
+            delivered = max(delivered, self._drain_consumer(consumer, event_types, handler))
+        return delivered
+
+    def _claim(self, db, consumer):
+        now = datetime.utcnow()
+        if db.get(EventCheckpoint, consumer) is None:
+            db.add(EventCheckpoint(consumer=consumer, last_event_id=0))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()  # another worker created it first
+        # Lease the checkpoint so only one worker drains a consumer at a time
+        claimed = db.execute(
+            update(EventCheckpoint)
+            .where(EventCheckpoint.consumer == consumer)
+            .where(or_(EventCheckpoint.locked_until.is_(None), EventCheckpoint.locked_until < now, EventCheckpoint.locked_by == self.worker_id))
+            .values(locked_by=self.worker_id, locked_until=now + timedelta(seconds=OUTBOX_LEASE_SECONDS))
+        ).rowcount
+        db.commit()
+        return db.get(EventCheckpoint, consumer) if claimed else None
+
+    def _advance(self, db, consumer, event_id):
+        # Move the checkpoint and renew the lease, if this worker still holds it
+        now = datetime.utcnow()
+        return db.execute(
+            update(EventCheckpoint)
+            .where(EventCheckpoint.consumer == consumer, EventCheckpoint.locked_by == self.worker_id)
+            .values(last_event_id=event_id, locked_until=now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+                    failed_event_id=None, attempts=0, retry_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+
+    def _failed(self, db, consumer, checkpoint, e, error, dead_letter=True):
+        """Record a failed delivery of e: schedule a retry, or dead-letter it after OUTBOX_MAX_ATTEMPTS."""
+        attempts = checkpoint.attempts + 1 if checkpoint.failed_event_id == e.id else 1
+        if dead_letter and attempts >= OUTBOX_MAX_ATTEMPTS:
+            if self._advance(db, consumer, e.id):
+                db.add(DeadLetter(consumer=consumer, event_id=e.id, event_type=e.event_type, payload=e.payload,
+                                  attempts=attempts, error=error))
+                logger.error("Consumer %s gave up on event %s (%s) after %d attempts", consumer, e.id, e.event_type, attempts)
+                OUTBOX_EVENTS.inc((consumer, "dead_lettered"))
+        else:
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (attempts - 1))
+            db.execute(
+                update(EventCheckpoint)
+                .where(EventCheckpoint.consumer == consumer, EventCheckpoint.locked_by == self.worker_id)
+                .values(failed_event_id=e.id, attempts=attempts, retry_at=datetime.utcnow() + timedelta(seconds=delay))
+                .execution_options(synchronize_session=False))
+            logger.warning("Consumer %s will retry event %s in %ss (attempt %d)", consumer, e.id, delay, attempts)
+            OUTBOX_EVENTS.inc((consumer, "failed"))
+        db.commit()
+
+    def _drain_consumer(self, consumer, event_types, handler):
+        db = self.session_factory()
+        try:
+            checkpoint = self._claim(db, consumer)
+            if checkpoint is None or (checkpoint.retry_at is not None and checkpoint.retry_at > datetime.utcnow()):
+                return 0
+            walked = _settled(db, checkpoint.last_event_id, self.batch_size)
+            if not walked:
+                return 0
+            wanted = [i for i, event_type in walked if event_types is None or event_type in event_types]
+            events = db.query(OutboxEvent).filter(OutboxEvent.id.in_(wanted)).order_by(OutboxEvent.id).all() if wanted else []
+            if handler is None:
+                try:
+                    if events:
+                        self.broker.publish(events)
+                except Exception as exc:
+                    # A broker outage is not the events' fault; keep retrying them
+                    logger.exception("Could not forward events to the broker")
+                    self._failed(db, consumer, checkpoint, events[0], repr(exc), dead_letter=False)
+                    return 0
+                self._advance(db, consumer, walked[-1][0])
+                db.commit()
+                OUTBOX_EVENTS.inc((consumer, "delivered"), len(events))
+                return len(walked)
+            for e in events:
+                try:
+                    handler(db, json.loads(e.payload), e)
+                    if not self._advance(db, consumer, e.id):
+                        db.rollback()
+                        logger.warning("Consumer %s lost its lease at event %s", consumer, e.id)
+                        return 0
+                    db.commit()
+                    OUTBOX_EVENTS.inc((consumer, "delivered"))
+                except Exception as exc:
+                    # Stop at the failing event to keep per-consumer ordering; retried after a backoff
+                    db.rollback()
+                    logger.exception("Consumer %s failed on event %s (%s)", consumer, e.id, e.event_type)
+                    checkpoint = db.get(EventCheckpoint, consumer)
+                    self._failed(db, consumer, checkpoint, e, repr(exc))
+                    return 0
+            # Move past the events of other types too, so the next walk starts after them
+            if walked[-1][0] != (events[-1].id if events else None):
+                self._advance(db, consumer, walked[-1][0])
+                db.commit()
+            return len(walked)
+        finally:
+            try:
+                db.execute(update(EventCheckpoint)
+                           .where(EventCheckpoint.consumer == consumer, EventCheckpoint.locked_by == self.worker_id)
+                           .values(locked_until=None, locked_by=None))
+                db.commit()
+            except Exception:
+                db.rollback()
+                logger.exception("Could not release outbox lease for %s", consumer)
+            db.close()
+
+
+def _settled(db, after, limit):
+    """[(id, event_type)] of the events after id `after` that no uncommitted event can still precede."""
+    rows = db.query(OutboxEvent.id, OutboxEvent.event_type, OutboxEvent.created_at) \
+        .filter(OutboxEvent.id > after).order_by(OutboxEvent.id).limit(limit).all()
+    cutoff = datetime.utcnow() - timedelta(seconds=OUTBOX_SETTLE_SECONDS)
+    settled = []
+    for event_id, event_type, created_at in rows:
+        if event_id != after + 1 and created_at > cutoff:
+            break  # an earlier id may still commit
+        settled.append((event_id, event_type))
+        after = event_id
+    return settled
+
+
+# One relay per shard (see shards.py); the outbox lives next to the rows that emit into it
+relays = {}
+
+
+def start_relay(session_factory, shard=shards.DEFAULT):
+    if not OUTBOX_RELAY_ENABLED or shard in relays:
+        return
+    relays[shard] = OutboxRelay(session_factory)
+    relays[shard].start("outbox-relay" if shard == shards.DEFAULT else f"outbox-relay-{shard}")
+
+
+def stop_relay():
+    while relays:
+        relays.popitem()[1].stop()
+
+
+@sa_event.listens_for(Session, "after_commit")
+def _wake_relay(session):
+    if session.info.pop("outbox_pending", False):
+        relay = relays.get(shards.shard_of(session))
+        if relay is not None:
+            relay.wake()
+
+
+@sa_event.listens_for(Session, "after_rollback")
+def _clear_pending(session):
+    session.info.pop("outbox_pending", None)
@@ -0,0 +1,96 @@
+# Sparse fieldsets for list endpoints: ?fields=name,specialty&include=certificates
+#
+# fields picks the attributes of each item (id is always included); include
+# adds nested relationships such as a doctor's certificates. Without either
+# parameter a route answers exactly as before, with its full response schema.
+# With them, the query loads only the requested columns (load_only), eagerly
+# loads only the requested relationships (selectinload, the rest noload), and
+# items are serialized through a schema cut down to the requested fields, so
+# less is read from the database and less is sent.
+
+from functools import lru_cache
+from typing import List, Optional
+
+from fastapi import HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import ConfigDict, TypeAdapter, create_model
+from sqlalchemy.orm import ColumnProperty, load_only, noload, selectinload
+
+
+@lru_cache(maxsize=None)
+def _partial_schema(schema, names):
+    fields = {name: (schema.model_fields[name].annotation, schema.model_fields[name]) for name in names}
+    return create_model(f"{schema.__name__}Fields", __config__=ConfigDict(from_attributes=True), **fields)
+
+
+class Projection:
+    """The requested subset of a response schema, and how to load it from model."""
+
+    def __init__(self, schema, model, names, relationships):
+        self.schema = schema
+        self.model = model
+        self.names = names  # schema field names, in schema order
+        self.relationships = relationships
+
+    def apply(self, query):
+        """Restrict query to the requested columns and relationships."""
+        mapper = self.model.__mapper__
+        scalars = [n for n in self.names if n not in self.relationships]
+        # Fields computed from several columns (properties) need the whole row
+        if all(isinstance(mapper.attrs.get(n), ColumnProperty) for n in scalars):
+            query = query.options(load_only(*(getattr(self.model, n) for n in scalars)))
+        for name in _relationship_fields(self.schema, self.model):
+            attr = getattr(self.model, name)
+            query = query.options(selectinload(attr) if name in self.relationships else noload(attr))
+        return query
+
+    def dump(self, rows):
+        """Rows (ORM objects or dicts) as JSON-ready dicts holding only the requested fields."""
+        schema = _partial_schema(self.schema, self.names)
+        return jsonable_encoder(TypeAdapter(List[schema]).validate_python(list(rows), from_attributes=True))
+
+
+def _relationship_fields(schema, model):
+    relationships = model.__mapper__.relationships
+    return tuple(n for n in schema.model_fields if n in relationships)
+
+
+def _split(value):
+    return [part.strip() for part in value.split(",") if part.strip()] if value else []
+
+
+def projection(schema, model, fields=None, include=None):
+    """Projection for the fields/include parameters, or None when neither is given."""
+    if fields is None and include is None:
+        return None
+    related = _relationship_fields(schema, model)
+    requested, included = _split(fields), _split(include)
+    unknown = [n for n in requested if n not in schema.model_fields] + [n for n in included if n not in related]
+    if unknown:
+        raise HTTPException(status_code=400, detail={
+            "message": f"Unknown fields: {', '.join(unknown)}",
+            "fields": [n for n in schema.model_fields if n not in related],
+            "include": list(related),
+        })
+    relationships = frozenset(included) | {n for n in requested if n in related}
+    if requested:
+        wanted = {"id", *requested} | relationships
+    else:
+        wanted = {n for n in schema.model_fields if n not in related} | relationships
+    return Projection(schema, model, tuple(n for n in schema.model_fields if n in wanted), relationships)
+
+
+def sparse(schema, model):
+    """Dependency: the Projection requested by ?fields= and ?include=, or None."""
+    def dependency(
+        fields: Optional[str] = Query(None, description=f"Comma-separated {schema.__name__} fields to return (id is always included)"),
+        include: Optional[str] = Query(None, description="Comma-separated relationships to embed"),
+    ):
+        return projection(schema, model, fields, include)
+    return dependency
+
+
+def respond(items, response):
+    """JSON response for already projected items, keeping headers set by dependencies (ETag)."""
+    return JSONResponse(items, headers=dict(response.headers))
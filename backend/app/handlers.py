@@ -0,0 +1,83 @@
+# Consumers for domain events emitted by the routes (see events.py)
+
+from . import models, utils, daraja, events, shards
+from .events import subscribe
+from .models import Notification
+
+
+def _superusers(db):
+    # Staff accounts live on the default shard; patient shards' relays run these handlers too
+    return shards.on(db.query(models.User).filter(models.User.role == models.UserRole.superuser), shards.DEFAULT).all()
+
+
+@subscribe("appointment_emails", "AppointmentBooked")
+def appointment_emails(db, payload, event):
+    doctor = db.query(models.Doctor).filter(models.Doctor.id == payload["doctor_id"]).first()
+    patient = payload["patient_name"]
+    if doctor:
+        utils.send_notification_email(
+            doctor.email,
+            "New Appointment Booked",
+            f"You have a new appointment from {patient}. Symptoms: {payload['symptoms']}\nDetails: {payload['details']}"
+        )
+    for su in _superusers(db):
+        utils.send_notification_email(
+            su.email,
+            "New Appointment Booked",
+            f"A new appointment has been booked for Dr. {doctor.name if doctor else payload['doctor_id']} by {patient}."
+        )
+
+
+@subscribe("doctor_review_inbox", "DoctorSubmitted")
+def doctor_review_inbox(db, payload, event):
+    for su in _superusers(db):
+        db.add(Notification(
+            user_id=su.id,
+            message=f"New doctor profile submitted: {payload['name']} ({payload['email']}) is awaiting approval.",
+            type="doctor_approval"
+        ))
+
+
+@subscribe("doctor_decision_notice", "DoctorApproved", "DoctorRejected", "DoctorsReviewed")
+def doctor_decision_notice(db, payload, event):
+    if event.event_type == "DoctorsReviewed":
+        decisions = payload["decisions"]  # bulk review: one event, one email batch
+    else:
+        status = "approved" if event.event_type == "DoctorApproved" else "rejected"
+        decisions = [{**payload, "approval_status": status}]
+    emails = []
+    for decision in decisions:
+        message = ("Your doctor profile has been approved." if decision["approval_status"] == "approved"
+                   else "Your doctor profile was not approved.")
+        if decision.get("notes"):
+            message += f" Notes: {decision['notes']}"
+        user_id = decision.get("user_id")
+        if "user_id" not in decision:  # events recorded before doctors were linked to their account
+            user_id = db.query(models.User.id).filter(models.User.email == decision["email"]).scalar()
+        if user_id:
+            db.add(Notification(user_id=user_id, message=message, type="doctor_approval"))
+        emails.append((decision["email"], "Doctor profile review", message))
+    if len(emails) == 1:
+        utils.send_notification_email(*emails[0])
+    else:
+        utils.send_notification_emails(emails)
+
+
+@subscribe("stk_push", "PaymentRequested")
+def stk_push(db, payload, event):
+    app = db.query(models.Appointment).filter(models.Appointment.id == payload["appointment_id"]).first()
+    if not app or app.payment_status == "paid":
+        return  # replayed delivery
+    stk_response = daraja.initiate_stk_push(payload["phone_number"], payload["amount"])
+    outcome = {"appointment_id": app.id, "amount": payload["amount"]}
+    if stk_response.get("ResponseCode") == "0":
+        app.payment_status = "paid"
+        events.emit(db, "PaymentSucceeded", outcome, aggregate_id=app.id)
+    else:
+        app.payment_status = "failed"
+        events.emit(db, "PaymentFailed", outcome, aggregate_id=app.id)
+        db.add(Notification(
+            user_id=app.user_id,
+            message=f"Payment request failed: {stk_response.get('message', 'Failed to initiate payment.')}",
+            type="appointment"
+        ))
@@ -0,0 +1,180 @@
+# Response compression (gzip/brotli) and HTTP caching (ETag, 304, Cache-Control) for JSON endpoints
+
+import gzip
+import hashlib
+import os
+
+from fastapi import Depends, HTTPException, Request, Response
+
+from . import data_versions, delivery
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("HTTP_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "4"))
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/javascript", b"image/svg+xml")
+
+# Route template -> Cache-Control for successful GETs. Routes not listed get
+# DEFAULT_CACHE_CONTROL, which lets clients keep a copy but revalidate by ETag.
+ROUTE_CACHE_CONTROL = {
+    "/services": "public, max-age=300, stale-while-revalidate=60",
+    "/doctors": "private, max-age=60",
+    "/metrics": "no-store",
+}
+DEFAULT_CACHE_CONTROL = "private, no-cache"
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: W/"x" and "x" are equivalent for If-None-Match
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
+def versioned_etag(*tables, per_user=False, user=None):
+    """Dependency: answer 304 from table version counters before the route queries anything.
+
+    user is the route's dependency resolving the caller (e.g. get_current_user).
+    It runs before the version check, so a request the route would refuse gets
+    its 401 rather than a 304. FastAPI caches it per request, so the route's own
+    Depends reuses the result. With per_user the ETag also covers the caller's
+    id, for lists whose content depends on who is asking. The versions read are
+    left on request.state.data_versions for the route to put in its coalesce
+    key, so a shared result is never older than the ETag.
+    """
+    unversioned = set(tables) - data_versions.VERSIONED_TABLES
+    if unversioned:
+        raise ValueError(f"No version counter for {sorted(unversioned)}; add it to data_versions.VERSIONED_TABLES")
+    if per_user and user is None:
+        raise ValueError("per_user needs the user dependency")
+
+    def check(request, response, subject=""):
+        from .__init__ import engine
+
+        versions = data_versions.current(engine, tables)
+        request.state.data_versions = tuple(versions[t] for t in tables)
+        parts = [request.url.path, request.url.query] + [f"{t}:{versions[t]}" for t in tables] + [subject]
+        etag = 'W/"%s"' % hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            raise HTTPException(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+    if user is None:
+        def dependency(request: Request, response: Response):
+            check(request, response)
+    else:
+        def dependency(request: Request, response: Response, current_user=Depends(user)):
+            check(request, response, str(current_user.id) if per_user else "")
+    return dependency
+
+
+def _header(headers, name):
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+def _choose_encoding(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+class HTTPCacheMiddleware:
+    """Adds ETag/Cache-Control to GET responses, answers If-None-Match with 304
+    and compresses large textual bodies. Streaming responses pass through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_headers = scope.get("headers", ())
+        accept_encoding = _header(request_headers, b"accept-encoding")
+        encoding = _choose_encoding(accept_encoding.decode("latin-1")) if accept_encoding else None
+        is_get = scope["method"] == "GET"
+        if not encoding and not is_get:
+            return await self.app(scope, receive, send)
+        if_none_match = _header(request_headers, b"if-none-match")
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body = message.get("body", b"")
+            if message.get("more_body", False):
+                # Streaming (files, SSE): leave as is
+                passthrough = True
+                await send(start_message)
+                return await send(message)
+            await self._finish(scope, start_message, body, encoding, is_get, if_none_match, send)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _finish(self, scope, start, body, encoding, is_get, if_none_match, send):
+        status = start["status"]
+        if status in (204, 304) or any(_header(start["headers"], name) for name in delivery.OFFLOAD_HEADERS):
+            # No body of ours to tag or compress (the proxy sends the file)
+            await send(start)
+            return await send({"type": "http.response.body", "body": body})
+        headers = [(k, v) for k, v in start["headers"] if k != b"content-length"]
+        content_type = _header(headers, b"content-type") or b""
+
+        if is_get and status == 200:
+            etag = _header(headers, b"etag")
+            if etag is None:
+                etag = b'W/"%s"' % hashlib.sha1(body).hexdigest()[:20].encode()
+                headers.append((b"etag", etag))
+            if _header(headers, b"cache-control") is None:
+                route = getattr(scope.get("route"), "path", None)
+                headers.append((b"cache-control", ROUTE_CACHE_CONTROL.get(route, DEFAULT_CACHE_CONTROL).encode()))
+            if if_none_match and _etag_matches(if_none_match.decode("latin-1"), etag.decode("latin-1")):
+                keep = {b"etag", b"cache-control", b"vary", b"access-control-allow-origin", b"access-control-allow-credentials"}
+                await send({"type": "http.response.start", "status": 304, "headers": [(k, v) for k, v in headers if k in keep]})
+                return await send({"type": "http.response.body", "body": b""})
+
+        if (encoding and len(body) >= COMPRESS_MIN_SIZE and _header(headers, b"content-encoding") is None
+                and content_type.startswith(COMPRESSIBLE_TYPES)):
+            if encoding == "br":
+                body = brotli.compress(body, quality=BROTLI_QUALITY)
+            else:
+                body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            headers.append((b"content-encoding", encoding.encode()))
+            vary = _header(headers, b"vary")
+            if vary is None:
+                headers.append((b"vary", b"Accept-Encoding"))
+            elif b"accept-encoding" not in vary.lower():
+                headers = [(k, v + b", Accept-Encoding" if k == b"vary" else v) for k, v in headers]
+
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({**start, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,168 @@
+# Idempotency-Key support for POST endpoints that book or charge
+#
+# A client sends the same Idempotency-Key header on every retry of one logical
+# request. The first request claims the key and runs; its response is stored
+# for IDEMPOTENCY_TTL seconds. Retries with the same body get the stored
+# response back (Idempotent-Replayed: true) without touching the route, so no
+# second appointment, STK push or email round is produced. A retry that arrives
+# while the first request is still running waits for it, up to IDEMPOTENCY_WAIT
+# seconds, then gets 409. Reusing a key with a different body is rejected with 422.
+# Server errors and transient refusals (TRANSIENT_STATUSES: rate limited,
+# unauthenticated, conflicting) are not stored: the claim is released so a
+# retry with the same key runs for real.
+
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from . import metrics
+from .models import IdempotencyKey
+from .ratelimit import _buffer_body, _header, _key_value
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))  # seconds a response is kept
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "60"))  # seconds before a stuck claim lapses
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))  # seconds a concurrent retry waits
+MAX_KEY_LENGTH = 255
+TRANSIENT_STATUSES = frozenset({401, 408, 409, 425, 429})  # the same request may succeed later
+
+IDEMPOTENT_ROUTES = {
+    ("POST", "/appointments"),
+    ("POST", "/appointments/payment"),
+}
+
+IDEMPOTENT_REQUESTS = metrics.register(metrics.Counter(
+    "idempotent_requests_total", "Requests carrying an Idempotency-Key, by outcome.", ("route", "outcome")))
+
+_table = IdempotencyKey.__table__
+
+
+class KeyStore:
+    """Keys and stored responses in the idempotency_keys table."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def claim(self, scope_key, method, path, fingerprint):
+        """Claim scope_key for this request; returns None if claimed, else the existing row."""
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            conn.execute(delete(_table).where(_table.c.scope_key == scope_key, _table.c.expires_at < now))
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(_table).values(
+                    scope_key=scope_key, method=method, path=path, fingerprint=fingerprint, status="processing",
+                    created_at=now, locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT),
+                    expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL),
+                ))
+            return None
+        except IntegrityError:
+            pass
+        with self.engine.begin() as conn:
+            # Take over a claim whose request died without completing
+            taken = conn.execute(update(_table).where(
+                _table.c.scope_key == scope_key, _table.c.status == "processing",
+                _table.c.fingerprint == fingerprint, _table.c.locked_until < now,
+            ).values(locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT))).rowcount
+            if taken:
+                return None
+            return conn.execute(select(_table).where(_table.c.scope_key == scope_key)).first()
+
+    def get(self, scope_key):
+        with self.engine.connect() as conn:
+            return conn.execute(select(_table).where(_table.c.scope_key == scope_key)).first()
+
+    def complete(self, scope_key, status, content_type, body):
+        with self.engine.begin() as conn:
+            conn.execute(update(_table).where(_table.c.scope_key == scope_key).values(
+                status="completed", response_status=status, content_type=content_type,
+                response_body=body, locked_until=None,
+            ))
+
+    def release(self, scope_key):
+        with self.engine.begin() as conn:
+            conn.execute(delete(_table).where(_table.c.scope_key == scope_key, _table.c.status == "processing"))
+
+
+async def _respond(send, status, body, content_type=b"application/json", extra_headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *extra_headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, store=None, routes=IDEMPOTENT_ROUTES):
+        self.app = app
+        self.routes = routes
+        if store is None:
+            from .__init__ import engine
+            store = KeyStore(engine)
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            return await self.app(scope, receive, send)
+        key = _header(scope, b"idempotency-key")
+        user = _key_value("user", scope, None)
+        if not key or not user:
+            return await self.app(scope, receive, send)
+        route = scope["path"]
+        if len(key) > MAX_KEY_LENGTH:
+            return await _respond(send, 400, b'{"detail":"Idempotency-Key is too long"}')
+
+        body, receive = await _buffer_body(receive)
+        fingerprint = hashlib.sha256(b"\n".join((scope["method"].encode(), route.encode(), body))).hexdigest()
+        scope_key = f"{user}:{key}"
+        existing = await run_in_threadpool(self.store.claim, scope_key, scope["method"], route, fingerprint)
+        if existing is not None:
+            return await self._replay(send, route, scope_key, existing, fingerprint)
+
+        captured = {"status": 500, "content_type": None, "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                for name, value in message.get("headers", ()):
+                    if name.lower() == b"content-type":
+                        captured["content_type"] = value.decode("latin-1")
+            elif message["type"] == "http.response.body":
+                captured["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture)
+        except BaseException:
+            await run_in_threadpool(self.store.release, scope_key)
+            raise
+        if captured["status"] >= 500 or captured["status"] in TRANSIENT_STATUSES:
+            # Not a final answer; let the client retry for real
+            await run_in_threadpool(self.store.release, scope_key)
+            IDEMPOTENT_REQUESTS.inc((route, "released"))
+        else:
+            await run_in_threadpool(self.store.complete, scope_key, captured["status"],
+                                    captured["content_type"], b"".join(captured["body"]))
+            IDEMPOTENT_REQUESTS.inc((route, "stored"))
+
+    async def _replay(self, send, route, scope_key, row, fingerprint):
+        if row.fingerprint != fingerprint:
+            IDEMPOTENT_REQUESTS.inc((route, "mismatch"))
+            return await _respond(send, 422, b'{"detail":"Idempotency-Key was already used with a different request"}')
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT
+        while row is not None and row.status != "completed" and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.1)
+            row = await run_in_threadpool(self.store.get, scope_key)
+        if row is None or row.status != "completed":
+            IDEMPOTENT_REQUESTS.inc((route, "conflict"))
+            return await _respond(send, 409, b'{"detail":"A request with this Idempotency-Key is still in progress"}',
+                                  extra_headers=[(b"retry-after", b"1")])
+        IDEMPOTENT_REQUESTS.inc((route, "replayed"))
+        await _respond(send, row.response_status, row.response_body or b"",
+                       (row.content_type or "application/json").encode("latin-1"),
+                       extra_headers=[(b"idempotent-replayed", b"true")])
@@ -0,0 +1,100 @@
+# Primary keys: time-ordered UUIDv7 values stored as 16 bytes
+#
+# UUIDv4 text keys are 36 random characters, so every insert lands on a random
+# B-tree page and every foreign key carries the full string. UUIDv7 starts with
+# a millisecond timestamp, so new rows append to the right edge of the index,
+# and the binary form is less than half the size. Python code still sees the
+# canonical string form, so schemas, JWT subjects and URLs are unchanged.
+
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Mapper
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def uuid7():
+    """UUIDv7 (RFC 9562) with a 12-bit counter in rand_a, so ids made in the same
+    millisecond by this process stay ordered."""
+    global _last_ms, _counter
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms > _last_ms:
+            _last_ms, _counter = ms, int.from_bytes(os.urandom(2), "big") & 0x3FF
+        else:
+            _counter += 1
+            if _counter > 0xFFF:  # counter exhausted: borrow the next millisecond
+                _last_ms, _counter = _last_ms + 1, 0
+            ms = _last_ms
+        counter = _counter
+    rand_b = int.from_bytes(os.urandom(8), "big") & 0x3FFFFFFFFFFFFFFF
+    value = (ms & 0xFFFFFFFFFFFF) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | rand_b
+    return uuid.UUID(int=value)
+
+
+def new_id():
+    return str(uuid7())
+
+
+def parse(value):
+    """Return value as a uuid.UUID, or None if it is not a valid id."""
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value) if isinstance(value, str) else uuid.UUID(bytes=bytes(value))
+    except (ValueError, TypeError):
+        return None
+
+
+def is_valid(value):
+    return parse(value) is not None
+
+
+class CompactUUID(TypeDecorator):
+    """Native UUID on PostgreSQL, 16-byte binary elsewhere; str on the Python side.
+
+    Strings that are not valid ids bind as NULL, so lookups by a malformed id
+    simply find nothing. Assigning one to a mapped attribute raises ValueError
+    instead (see _check_assigned), so a typo is never stored as NULL.
+    """
+
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=True))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        value = parse(value)
+        if value is None:
+            return None
+        return value if dialect.name == "postgresql" else value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(value) if isinstance(value, uuid.UUID) else str(uuid.UUID(bytes=bytes(value)))
+
+
+def _check_assigned(target, value, oldvalue, initiator):
+    if value is not None and parse(value) is None:
+        raise ValueError(f"{type(target).__name__}.{initiator.key}: {value!r} is not a valid id")
+    return value
+
+
+@event.listens_for(Mapper, "mapper_configured")
+def _validate_assigned_ids(mapper, cls):
+    # Inserts and updates through the ORM; a NULL user_id on a notification means "broadcast"
+    for prop in mapper.column_attrs:
+        if any(isinstance(column.type, CompactUUID) for column in prop.columns):
+            event.listen(prop.class_attribute, "set", _check_assigned, retval=True)
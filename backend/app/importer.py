@@ -0,0 +1,280 @@
+# Bulk data import: streams CSV/NDJSON and upserts in chunks with INSERT ... ON CONFLICT.
+#
+#   python -m app.importer services services.csv
+#   python -m app.importer users roster.ndjson --chunk-size 5000 --workers 8
+#   python -m app.importer appointments history.csv --on-error skip
+#
+# With SHARD_MAP set, users are written to the shard of their region (doctors
+# and superusers to the default shard, existing accounts where they already
+# live) and recorded in shard_directory in the same chunk, so imported accounts
+# are unique across shards and can log in without rerunning `shards init`.
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from . import changelog, data_versions, shards
+from .ids import is_valid, new_id
+from .models import Service, Doctor, User, Appointment, ShardDirectory, UserRole
+from .utils import get_password_hash
+
+
+def read_records(path, fmt=None):
+    """Yield dicts from a CSV or NDJSON file ('-' for stdin) without loading it into memory."""
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = "csv" if ext == ".csv" else "ndjson"
+    stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8") if path == "-" else open(path, newline="", encoding="utf-8")
+    with stream:
+        if fmt == "csv":
+            for row in csv.DictReader(stream):
+                yield {k: (v if v != "" else None) for k, v in row.items()}
+        else:
+            for line in stream:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def chunked(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert(conn, table, rows, conflict_cols, update_cols=()):
+    """Insert rows, updating update_cols (or skipping) when conflict_cols already exist."""
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Upsert is not supported on {conn.dialect.name}")
+    stmt = insert(table)
+    if update_cols:
+        stmt = stmt.on_conflict_do_update(index_elements=list(conflict_cols), set_={c: stmt.excluded[c] for c in update_cols})
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=list(conflict_cols))
+    if table.name in changelog.SYNCED_TABLES:
+        # RETURNING gives the ids of rows actually written (existing ids on conflict, none when skipped)
+        owner = changelog.SYNCED_TABLES[table.name][1]
+        stmt = stmt.returning(table.c.id, *([table.c[owner]] if owner else []))
+        result = conn.execute(stmt, rows)
+        changelog.record(conn, [(*changelog.entry(table.name, row), False) for row in result.all()])
+    else:
+        result = conn.execute(stmt, rows)
+    data_versions.bump(conn, [table.name])
+    return result
+
+
+def _parse_datetime(value):
+    if not value:
+        return datetime.utcnow()
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def _parse_bool(value, default=False):
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y")
+
+
+# Row preparation. Each returns rows ready for executemany; the pool is only
+# used by users, where bcrypt dominates the cost.
+
+def prepare_services(records, conn, pool):
+    return [{
+        "name": r["name"],
+        "description": r.get("description"),
+        "price": int(r["price"]),
+        "created_at": _parse_datetime(r.get("created_at")),
+    } for r in records]
+
+
+def prepare_doctors(records, conn, pool):
+    # Link to an existing login account with the same email (users imported first)
+    accounts = _lookup(conn, User.id, User.email, (r["email"].strip().lower() for r in records))
+    rows = []
+    for r in records:
+        approval_status = r.get("approval_status") or ("approved" if _parse_bool(r.get("is_approved")) else "pending")
+        email = r["email"].strip().lower()
+        rows.append({
+            "user_id": accounts.get(email),
+            "name": r["name"],
+            "email": email,
+            "phone": r["phone"],
+            "gender": r["gender"],
+            "specialty": r["specialty"],
+            "qualifications": r.get("qualifications"),
+            "kmpdc_license": r.get("kmpdc_license"),
+            "approval_status": approval_status,
+            "is_approved": approval_status == "approved",
+            "created_at": _parse_datetime(r.get("created_at")),
+        })
+    return rows
+
+
+def prepare_users(records, conn, pool):
+    plain = [r.get("password") for r in records if not r.get("password_hash")]
+    hashes = iter(pool.map(get_password_hash, plain, chunksize=32) if pool else map(get_password_hash, plain))
+    rows = []
+    for r in records:
+        rows.append({
+            "name": r.get("name"),
+            "email": r["email"].strip().lower(),
+            "phone": r["phone"],
+            "region": r.get("region"),
+            "password_hash": r.get("password_hash") or next(hashes),
+            "is_verified": _parse_bool(r.get("is_verified")),
+            "role": UserRole(r.get("role") or "patient"),
+            "created_at": _parse_datetime(r.get("created_at")),
+        })
+    return rows
+
+
+def _lookup(conn, column, key_column, values):
+    values = {v for v in values if v}
+    if not values:
+        return {}
+    return dict(conn.execute(select(key_column, column).where(key_column.in_(values))).all())
+
+
+def prepare_appointments(records, conn, pool):
+    # Resolve natural keys with one IN query per chunk instead of a SELECT per row
+    users = _lookup(conn, User.id, User.email, (r.get("user_email") for r in records if not r.get("user_id")))
+    doctors = _lookup(conn, Doctor.id, Doctor.email, (r.get("doctor_email") for r in records if not r.get("doctor_id")))
+    services = _lookup(conn, Service.id, Service.name, (r.get("service_name") for r in records if not r.get("service_id")))
+    rows = []
+    for r in records:
+        row = {
+            "id": r.get("id") or new_id(),
+            "user_id": r.get("user_id") or users.get(r.get("user_email")),
+            "doctor_id": r.get("doctor_id") or doctors.get(r.get("doctor_email")),
+            "service_id": r.get("service_id") or services.get(r.get("service_name")),
+            "gender": r.get("gender"),
+            "symptoms": r.get("symptoms"),
+            "details": r.get("details"),
+            "status": r.get("status") or "pending",
+            "payment_status": r.get("payment_status") or "pending",
+            "created_at": _parse_datetime(r.get("created_at")),
+        }
+        # A malformed id would bind as NULL
+        if not all(is_valid(row[key]) for key in ("id", "user_id", "doctor_id", "service_id")):
+            raise ValueError(f"Unresolved or malformed id/user/doctor/service reference in appointment record: {r}")
+        rows.append(row)
+    return rows
+
+
+# entity -> (table, prepare, conflict columns, columns updated on conflict)
+ENTITIES = {
+    "services": (Service.__table__, prepare_services, ("name",), ("description", "price")),
+    "doctors": (Doctor.__table__, prepare_doctors, ("email",), ("name", "phone", "gender", "specialty", "qualifications", "kmpdc_license")),
+    "users": (User.__table__, prepare_users, ("email",), ("name", "phone")),
+    "appointments": (Appointment.__table__, prepare_appointments, ("id",), ("status", "payment_status")),
+}
+
+
+def _write_chunk(engine, entity, records, pool):
+    table, prepare, conflict_cols, update_cols = ENTITIES[entity]
+    if entity == "users" and shards.is_sharded():
+        return _write_sharded_users(records, pool)
+    with engine.begin() as conn:
+        rows = prepare(records, conn, pool)
+        # Last record wins; Postgres rejects one statement touching the same key twice
+        rows = list({tuple(r[c] for c in conflict_cols): r for r in rows}.values())
+        upsert(conn, table, rows, conflict_cols, update_cols)
+    return len(rows)
+
+
+def _write_sharded_users(records, pool):
+    """Upsert users on their shards and their shard_directory entries; all or nothing per chunk."""
+    table, prepare, conflict_cols, update_cols = ENTITIES["users"]
+    directory = ShardDirectory.__table__
+    with ExitStack() as stack:
+        # Entered first, so it commits last: a directory conflict rolls the shards back too
+        default = stack.enter_context(shards.engines[shards.DEFAULT].begin())
+        rows = list({r["email"]: r for r in prepare(records, default, pool)}.values())
+        placed = dict(default.execute(
+            select(directory.c.email, directory.c.shard).where(directory.c.email.in_([r["email"] for r in rows]))).all())
+        groups = {}
+        for row in rows:
+            shard = placed.get(row["email"])
+            if shard not in shards.engines:
+                shard = shards.shard_for_region(row["region"]) if row["role"] == UserRole.patient else shards.DEFAULT
+            groups.setdefault(shard, []).append(row)
+        entries = []
+        for shard, group in groups.items():
+            conn = default if shard == shards.DEFAULT else stack.enter_context(shards.engines[shard].begin())
+            upsert(conn, table, group, conflict_cols, update_cols)
+            written = conn.execute(select(User.id, User.email, User.phone).where(User.email.in_([r["email"] for r in group])))
+            entries += [{"user_id": user_id, "email": email, "phone": phone, "shard": shard} for user_id, email, phone in written]
+        upsert(default, directory, entries, ("user_id",), ("email", "phone", "shard"))
+    return len(rows)
+
+
+def import_records(engine, entity, records, chunk_size=2000, workers=None, on_error="abort", progress=True):
+    """Import an iterable of dicts; returns (imported, skipped)."""
+    pool = ProcessPoolExecutor(max_workers=workers) if entity == "users" and workers != 1 else None
+    imported = skipped = 0
+    start = time.perf_counter()
+    try:
+        for chunk in chunked(records, chunk_size):
+            try:
+                imported += _write_chunk(engine, entity, chunk, pool)
+            except (IntegrityError, ValueError, KeyError):
+                if on_error != "skip":
+                    raise
+                # Fall back to row-by-row so one bad record does not sink the chunk
+                for record in chunk:
+                    try:
+                        imported += _write_chunk(engine, entity, [record], None)
+                    except (IntegrityError, ValueError, KeyError) as e:
+                        skipped += 1
+                        print(f"skipped {entity} record: {e}", file=sys.stderr)
+            if progress:
+                elapsed = time.perf_counter() - start
+                print(f"\r{entity}: {imported} imported, {skipped} skipped ({imported / elapsed:.0f}/s)", end="", file=sys.stderr, flush=True)
+    finally:
+        if pool:
+            pool.shutdown()
+    if progress:
+        print(file=sys.stderr)
+    return imported, skipped
+
+
+def main():
+    from .__init__ import engine
+
+    parser = argparse.ArgumentParser(description="Bulk import services, doctors, users or appointments")
+    parser.add_argument("entity", choices=sorted(ENTITIES))
+    parser.add_argument("path", help="CSV or NDJSON file, or '-' for stdin")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=None, help="password hashing processes (default: CPU count)")
+    parser.add_argument("--on-error", choices=["abort", "skip"], default="abort")
+    args = parser.parse_args()
+    imported, skipped = import_records(engine, args.entity, read_records(args.path, args.format), args.chunk_size, args.workers, args.on_error)
+    print(f"Imported {imported} {args.entity}, skipped {skipped}.")
+
+
+if __name__ == "__main__":
+    main()
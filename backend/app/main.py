@@ -1,9 +1,23 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .routes import router
+from . import metrics, ratelimit, http_cache, batch, analytics, idempotency, serve, messaging, sync
+from . import handlers, media  # noqa: F401  registers outbox event consumers
+from .__init__ import engines, warmup
+import os
 
 app = FastAPI()
 
+# Size the threadpool that runs sync routes (THREADPOOL_SIZE, set by app.serve)
+app.add_event_handler("startup", serve.configure_threadpool)
+
+# Throttle expensive endpoints (inside CORS so 429s stay readable by browsers)
+app.add_middleware(ratelimit.RateLimitMiddleware)
+
+# Replay stored responses for retried bookings/payments (outside the limiter so
+# replays do not use up the client's budget)
+app.add_middleware(idempotency.IdempotencyMiddleware)
+
 # Allow all origins for development
 app.add_middleware(
     CORSMiddleware,
@@ -13,4 +27,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ETag/304, Cache-Control and gzip/brotli for JSON responses
+app.add_middleware(http_cache.HTTPCacheMiddleware)
+
+# Per-route latency, SQL and external-call metrics, scraped from /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+for shard_engine in engines.values():
+    metrics.instrument_engine(shard_engine)
+
 app.include_router(router)
+app.include_router(batch.router)
+app.include_router(analytics.router)
+app.include_router(messaging.router)
+app.include_router(sync.router)
+app.include_router(metrics.router)
+
+# Pre-fork warmup: with gunicorn --preload the master pays these costs once
+if os.getenv("APP_WARMUP", "0") == "1":
+    warmup()
@@ -0,0 +1,174 @@
+# Certificate previews
+#
+# Uploaded certificates are kept as sent. For review screens the
+# certificate_previews outbox consumer renders a compressed preview and a
+# thumbnail in a process pool, waiting at most MEDIA_TIMEOUT seconds. The wait
+# holds the shared relay thread and must end well inside the outbox lease, so
+# in the relay it is also capped at half of OUTBOX_LEASE_SECONDS. Images are
+# rotated per EXIF and re-encoded without metadata; PDFs have their first page
+# rasterized. Reviewers load the derivatives, and the original is only
+# downloaded on demand.
+#
+# Needs Pillow (and pypdfium2 for PDFs); without them certificates are marked
+# "unsupported" and only the original is served.
+#
+#   python -m app.media --backfill   # process certificates uploaded earlier
+
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import models
+from .events import OUTBOX_LEASE_SECONDS, subscribe
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PREVIEW_DIR = "certificates/previews"  # relative to BACKEND_DIR, like DoctorCertificate.file_path
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_TIMEOUT = float(os.getenv("MEDIA_TIMEOUT", "15"))  # seconds per certificate
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "1600"))  # px, longest side
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "320"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "75"))
+
+IMAGE_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp",
+               ".heic": "image/heic", ".gif": "image/gif", ".bmp": "image/bmp", ".tif": "image/tiff", ".tiff": "image/tiff"}
+
+
+class UnsupportedMedia(Exception):
+    pass
+
+
+def content_type_for(path):
+    ext = os.path.splitext(path)[1].lower()
+    return "application/pdf" if ext == ".pdf" else IMAGE_TYPES.get(ext, "application/octet-stream")
+
+
+def _open_first_page(src):
+    if content_type_for(src) == "application/pdf":
+        try:
+            import pypdfium2
+        except ImportError:
+            raise UnsupportedMedia("pypdfium2 is not installed")
+        pdf = pypdfium2.PdfDocument(src)
+        try:
+            page = pdf[0]
+            # Render at roughly PREVIEW_MAX_SIZE on the longest side
+            width, height = page.get_size()
+            return page.render(scale=PREVIEW_MAX_SIZE / max(width, height)).to_pil()
+        finally:
+            pdf.close()
+    from PIL import Image, ImageOps
+    image = Image.open(src)
+    return ImageOps.exif_transpose(image)
+
+
+def render_derivatives(src, preview_dst, thumbnail_dst):
+    """Write a JPEG preview and thumbnail of src; runs in a worker process.
+
+    Returns (preview_bytes, thumbnail_bytes). Saving a fresh RGB image drops
+    EXIF/XMP metadata (GPS, device) along with the alpha channel.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise UnsupportedMedia("Pillow is not installed")
+    try:
+        image = _open_first_page(src)
+    except UnsupportedMedia:
+        raise
+    except Exception as e:
+        raise UnsupportedMedia(f"cannot decode {os.path.basename(src)}: {e}")
+    if image.mode != "RGB":
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A") if "A" in image.getbands() else None)
+        image = background
+    os.makedirs(os.path.dirname(preview_dst), exist_ok=True)
+    sizes = []
+    for dst, limit in ((preview_dst, PREVIEW_MAX_SIZE), (thumbnail_dst, THUMBNAIL_MAX_SIZE)):
+        copy = image.copy()
+        copy.thumbnail((limit, limit), Image.LANCZOS)
+        tmp = dst + ".tmp"
+        copy.save(tmp, "JPEG", quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp, dst)
+        sizes.append(os.path.getsize(dst))
+    return tuple(sizes)
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=MEDIA_WORKERS)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def process_certificate(cert, timeout=MEDIA_TIMEOUT):
+    """Render derivatives for one DoctorCertificate and record the outcome on it."""
+    src = os.path.join(BACKEND_DIR, cert.file_path)
+    cert.content_type = content_type_for(cert.file_path)
+    if not os.path.exists(src):
+        cert.processing_status = "failed"
+        return
+    cert.original_size = os.path.getsize(src)
+    preview = f"{PREVIEW_DIR}/{cert.id}_preview.jpg"
+    thumbnail = f"{PREVIEW_DIR}/{cert.id}_thumb.jpg"
+    future = get_pool().submit(render_derivatives, src,
+                               os.path.join(BACKEND_DIR, preview), os.path.join(BACKEND_DIR, thumbnail))
+    try:
+        future.result(timeout)
+    except UnsupportedMedia as e:
+        logger.info("No preview for certificate %s: %s", cert.id, e)
+        cert.processing_status = "unsupported"
+        return
+    except Exception:
+        # Recorded rather than raised so one bad file cannot stall the consumer;
+        # --backfill retries failed certificates
+        logger.exception("Preview rendering failed for certificate %s", cert.id)
+        cert.processing_status = "failed"
+        return
+    cert.preview_path, cert.thumbnail_path = preview, thumbnail
+    cert.processing_status = "ready"
+
+
+@subscribe("certificate_previews", "CertificateUploaded")
+def certificate_previews(db, payload, event):
+    cert = db.get(models.DoctorCertificate, payload["certificate_id"])
+    if cert is None or cert.processing_status == "ready":
+        return  # deleted, or a replayed delivery
+    process_certificate(cert, timeout=min(MEDIA_TIMEOUT, OUTBOX_LEASE_SECONDS / 2))
+
+
+def main():
+    from .__init__ import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Render certificate previews")
+    parser.add_argument("--backfill", action="store_true", help="process every certificate without a preview")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.error("nothing to do (use --backfill)")
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        pending = db.query(models.DoctorCertificate).filter(models.DoctorCertificate.processing_status != "ready").all()
+        for cert in pending:
+            process_certificate(cert)
+            db.commit()
+        print(f"processed {len(pending)} certificates")
+    finally:
+        db.close()
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
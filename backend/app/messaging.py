@@ -0,0 +1,535 @@
+# Doctor-patient messaging
+#
+# Each appointment (or legacy assignment) gets one thread with two members, the
+# patient and the doctor. Messages are numbered 1, 2, 3... per thread: the
+# thread row's last_seq is incremented in the sending transaction, so
+# (thread_id, seq) is the message's primary key and history pages by seq
+# (keyset) without OFFSET. Receipts are two watermarks per member,
+# delivered_seq and read_seq ("everything up to N"), so reading a page of
+# messages is one UPDATE instead of one per message.
+#
+# Clients hold one WebSocket per user (/ws/messages?token=...). The in-process
+# registry maps user ids to their open sockets. Each socket has a bounded send
+# queue drained by its own writer task; a client that stops reading is
+# disconnected rather than buffering without limit, and catches up from the
+# history endpoint when it reconnects. Messages sent through a worker are
+# pushed to that worker's sockets at once. Other workers pick them up within
+# MESSAGING_POLL_INTERVAL seconds, with one query per tick while they have
+# sockets open. seq is contiguous, so a client that sees a gap fetches
+# history with after_seq.
+#
+# Frames from the client:
+#   {"type": "send", "thread_id", "body", "client_id"}  -> {"type": "sent", "client_id", "thread_id", "seq"}
+#   {"type": "receipt", "thread_id", "delivered_seq"?, "read_seq"?}
+#   {"type": "ping"}                                      -> {"type": "pong"}
+# Frames to the client:
+#   {"type": "message", ...MessageOut}
+#   {"type": "receipt", "thread_id", "user_id", "delivered_seq", "read_seq"}
+#   {"type": "error", "client_id", "status", "detail"}
+#
+# Frames are validated with the same schemas as the HTTP API (422 with the
+# validation errors). A frame that fails in any other way gets a 500 error
+# frame; the socket stays open for the next one.
+#
+# Attachments are stored under backend/attachments/ like certificates, copied
+# from the upload in chunks (never read into memory whole), and served by
+# members only.
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, UploadFile, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, selectinload
+
+from . import delivery, ids, media, models, schemas, shards, tokens, utils
+from .__init__ import SessionLocal
+from .models import Message, MessageThread, ThreadMember
+from .routes import get_current_user, get_db
+
+logger = logging.getLogger(__name__)
+
+MESSAGING_POLL_INTERVAL = float(os.getenv("MESSAGING_POLL_INTERVAL", "1.0"))  # 0 = single worker, no polling
+MESSAGING_SEND_QUEUE = int(os.getenv("MESSAGING_SEND_QUEUE", "256"))  # frames buffered per socket
+MESSAGE_MAX_LENGTH = int(os.getenv("MESSAGE_MAX_LENGTH", "4000"))
+MESSAGE_ATTACHMENT_MAX_BYTES = int(os.getenv("MESSAGE_ATTACHMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+ATTACHMENT_DIR = "attachments"  # relative to media.BACKEND_DIR
+_COPY_CHUNK = 1024 * 1024
+
+router = APIRouter()
+
+
+# Store (sync; runs in the threadpool)
+
+def _check_id(value, what):
+    if not ids.is_valid(value):
+        raise HTTPException(status_code=422, detail=f"Invalid {what} id")
+
+
+def _membership(db, thread_id, user_id):
+    _check_id(thread_id, "thread")
+    member = db.get(ThreadMember, (thread_id, user_id))
+    if member is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return member
+
+
+def _participants(db, appointment_id=None, assignment_id=None):
+    """[(user_id, role)] for an appointment's or assignment's patient and doctor."""
+    if appointment_id:
+        _check_id(appointment_id, "appointment")
+        # The appointment lives on the patient's shard; the caller may be the doctor
+        appointment = shards.scatter(db.query(models.Appointment).filter(models.Appointment.id == appointment_id)).first()
+        if appointment is None:
+            raise HTTPException(status_code=404, detail="Appointment not found")
+        patient_id, doctor_id = appointment.user_id, appointment.doctor_id
+    else:
+        _check_id(assignment_id, "assignment")
+        assignment = db.get(models.Assignment, assignment_id)
+        request = assignment and db.get(models.ConsultationRequest, assignment.request_id)
+        patient = request and db.get(models.Patient, request.patient_id)
+        if patient is None:
+            raise HTTPException(status_code=404, detail="Assignment not found")
+        # Legacy patient records have no login; match the account by email
+        patient_id = patient.email and shards.scatter(
+            db.query(models.User.id).filter(models.User.email == patient.email)).scalar()
+        doctor_id = assignment.assigned_doctor_id
+    doctor = db.get(models.Doctor, doctor_id) if doctor_id else None
+    if not patient_id or doctor is None or doctor.user_id is None:
+        raise HTTPException(status_code=409, detail="Both the patient and the doctor need an account to message")
+    return [(patient_id, "patient"), (doctor.user_id, "doctor")]
+
+
+def open_thread(db, user_id, appointment_id=None, assignment_id=None):
+    """Get or create the thread for an appointment or assignment the user takes part in."""
+    if bool(appointment_id) == bool(assignment_id):
+        raise HTTPException(status_code=400, detail="Give exactly one of appointment_id or assignment_id")
+    column, value = (MessageThread.appointment_id, appointment_id) if appointment_id else (MessageThread.assignment_id, assignment_id)
+    thread = db.query(MessageThread).filter(column == value).first()
+    if thread is None:
+        members = _participants(db, appointment_id, assignment_id)
+        if user_id not in [m for m, _ in members]:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        thread = MessageThread(appointment_id=appointment_id, assignment_id=assignment_id,
+                               members=[ThreadMember(user_id=m, role=role) for m, role in members])
+        db.add(thread)
+        # The unique appointment/assignment columns make concurrent opens converge on one thread
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            thread = db.query(MessageThread).filter(column == value).first()
+    if user_id not in [m.user_id for m in thread.members]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return thread
+
+
+def list_threads(db, user_id):
+    rows = db.query(MessageThread, ThreadMember).join(ThreadMember, ThreadMember.thread_id == MessageThread.id) \
+        .options(selectinload(MessageThread.members)) \
+        .filter(ThreadMember.user_id == user_id).order_by(MessageThread.created_at.desc()).all()
+    return [{**schemas.ThreadOut.model_validate(thread, from_attributes=True).model_dump(), "unread": thread.last_seq - member.read_seq}
+            for thread, member in rows]
+
+
+def history(db, thread_id, user_id, before_seq=None, after_seq=None, limit=50):
+    """A page of messages in seq order: the newest ones, those before before_seq, or those after after_seq."""
+    _membership(db, thread_id, user_id)
+    q = db.query(Message).filter(Message.thread_id == thread_id)
+    if after_seq is not None:
+        return q.filter(Message.seq > after_seq).order_by(Message.seq).limit(limit).all()
+    if before_seq is not None:
+        q = q.filter(Message.seq < before_seq)
+    return list(reversed(q.order_by(Message.seq.desc()).limit(limit).all()))
+
+
+def post_message(db, thread_id, user_id, body=None, attachment=None):
+    """Append a message; returns (message payload, member user ids)."""
+    if body is not None and len(body) > MESSAGE_MAX_LENGTH:
+        raise HTTPException(status_code=413, detail=f"Messages are limited to {MESSAGE_MAX_LENGTH} characters")
+    if not body and attachment is None:
+        raise HTTPException(status_code=400, detail="Empty message")
+    _membership(db, thread_id, user_id)
+    # Row lock on the thread: concurrent senders get consecutive numbers
+    seq = db.execute(
+        update(MessageThread).where(MessageThread.id == thread_id)
+        .values(last_seq=MessageThread.last_seq + 1).returning(MessageThread.last_seq)
+        .execution_options(synchronize_session=False)
+    ).scalar_one()
+    message = Message(thread_id=thread_id, seq=seq, sender_id=user_id, body=body, **(attachment or {}))
+    db.add(message)
+    # The sender has seen their own message
+    _advance(db, thread_id, user_id, seq, seq)
+    db.flush()
+    payload = jsonable_encoder(schemas.MessageOut.model_validate(message, from_attributes=True))
+    members = [m for (m,) in db.execute(select(ThreadMember.user_id).where(ThreadMember.thread_id == thread_id))]
+    db.commit()
+    return payload, members
+
+
+def _advance(db, thread_id, user_id, delivered_seq=None, read_seq=None):
+    """Move a member's watermarks forward (never back); read implies delivered."""
+    if read_seq is not None:
+        delivered_seq = max(delivered_seq or 0, read_seq)
+    key = (ThreadMember.thread_id == thread_id) & (ThreadMember.user_id == user_id)
+    now = datetime.utcnow()
+    for column, value in ((ThreadMember.delivered_seq, delivered_seq), (ThreadMember.read_seq, read_seq)):
+        if value is not None:
+            db.execute(update(ThreadMember).where(key, column < value).values({column: value, ThreadMember.updated_at: now})
+                       .execution_options(synchronize_session=False))
+
+
+def update_receipts(db, thread_id, user_id, delivered_seq=None, read_seq=None):
+    """Record receipts; returns (receipt payload, member user ids)."""
+    member = _membership(db, thread_id, user_id)
+    last_seq = db.query(MessageThread.last_seq).filter(MessageThread.id == thread_id).scalar()
+    clamp = lambda seq: None if seq is None else max(0, min(seq, last_seq))
+    _advance(db, thread_id, user_id, clamp(delivered_seq), clamp(read_seq))
+    db.commit()
+    db.refresh(member)
+    payload = {"type": "receipt", "thread_id": thread_id, "user_id": user_id,
+               "delivered_seq": member.delivered_seq, "read_seq": member.read_seq}
+    members = [m for (m,) in db.execute(select(ThreadMember.user_id).where(ThreadMember.thread_id == thread_id))]
+    return payload, members
+
+
+def store_attachment(db, thread_id, user_id, upload):
+    """Copy an upload into the attachments directory in chunks; returns the message's attachment columns."""
+    _membership(db, thread_id, user_id)
+    ext = os.path.splitext(upload.filename or "")[1].lower()
+    rel_path = f"{ATTACHMENT_DIR}/{thread_id}/{uuid.uuid4().hex}{ext}"
+    abs_path = os.path.join(media.BACKEND_DIR, rel_path)
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    size = 0
+    with open(abs_path, "wb") as out:
+        while chunk := upload.file.read(_COPY_CHUNK):
+            size += len(chunk)
+            if size > MESSAGE_ATTACHMENT_MAX_BYTES:
+                out.close()
+                os.remove(abs_path)
+                raise HTTPException(status_code=413, detail="Attachment too large")
+            out.write(chunk)
+    return {"attachment_path": rel_path, "attachment_name": os.path.basename(upload.filename or rel_path),
+            "attachment_type": upload.content_type or media.content_type_for(rel_path), "attachment_size": size}
+
+
+def _with_session(func, *args, **kwargs):
+    # WebSocket frames have no request-scoped session; threads and messages
+    # live on the default shard, so a plain session serves every user
+    db = SessionLocal.session_factory()
+    try:
+        return func(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+# Connections
+
+class Connection:
+    def __init__(self, websocket, user_id):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue = asyncio.Queue(MESSAGING_SEND_QUEUE)
+        self.pushed = {}  # thread_id -> highest seq sent, so polled copies are not sent twice
+        self.receipts = {}  # (thread_id, user_id) -> (delivered_seq, read_seq) last sent
+        self.task = None
+        self.closed = False
+
+    def send(self, text):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            # A client that does not keep up is dropped; it resyncs from history
+            logger.info("Closing slow messaging socket for user %s", self.user_id)
+            self.close(now=True)
+
+    def close(self, now=False):
+        """Stop the writer after the frames already queued, or right away."""
+        if self.closed:
+            return
+        self.closed = True
+        if now or self.queue.full():
+            if self.task is not None:
+                self.task.cancel()
+        else:
+            self.queue.put_nowait(None)
+
+    async def run_writer(self):
+        try:
+            while (text := await self.queue.get()) is not None:
+                await self.websocket.send_text(text)
+        except Exception:
+            pass  # the reader side notices the disconnect
+        finally:
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+
+class ConnectionRegistry:
+    """Open sockets of this worker process, by user id (event loop only)."""
+
+    def __init__(self):
+        self._by_user = {}
+
+    def __len__(self):
+        return sum(len(conns) for conns in self._by_user.values())
+
+    def add(self, conn):
+        self._by_user.setdefault(conn.user_id, set()).add(conn)
+
+    def remove(self, conn):
+        conns = self._by_user.get(conn.user_id)
+        if conns is not None:
+            conns.discard(conn)
+            if not conns:
+                del self._by_user[conn.user_id]
+
+    def users(self):
+        return set(self._by_user)
+
+    def publish_message(self, payload, user_ids):
+        text = None
+        thread_id, seq = payload["thread_id"], payload["seq"]
+        for user_id in user_ids:
+            for conn in self._by_user.get(user_id, ()):
+                if conn.pushed.get(thread_id, 0) >= seq:
+                    continue
+                conn.pushed[thread_id] = seq
+                text = text or json.dumps({"type": "message", **payload})
+                conn.send(text)
+
+    def publish_receipt(self, payload, user_ids):
+        text = None
+        key = (payload["thread_id"], payload["user_id"])
+        marks = (payload["delivered_seq"], payload["read_seq"])
+        for user_id in user_ids:
+            for conn in self._by_user.get(user_id, ()):
+                if conn.receipts.get(key, (0, 0)) >= marks:
+                    continue
+                conn.receipts[key] = marks
+                text = text or json.dumps(payload)
+                conn.send(text)
+
+    def close_all(self):
+        for conns in list(self._by_user.values()):
+            for conn in conns:
+                conn.close()
+        self._by_user.clear()
+
+
+registry = ConnectionRegistry()
+
+
+def _changes_since(db, since):
+    """Messages and receipt changes after since, with the user ids to push them to."""
+    messages = db.query(Message, ThreadMember.user_id).join(ThreadMember, ThreadMember.thread_id == Message.thread_id) \
+        .filter(Message.created_at > since).order_by(Message.thread_id, Message.seq).all()
+    other = aliased(ThreadMember)
+    receipts = db.query(ThreadMember, other.user_id).join(other, other.thread_id == ThreadMember.thread_id) \
+        .filter(ThreadMember.updated_at > since).all()
+    out_messages = {}
+    for message, user_id in messages:
+        key = (message.thread_id, message.seq)
+        if key not in out_messages:
+            out_messages[key] = (jsonable_encoder(schemas.MessageOut.model_validate(message, from_attributes=True)), [])
+        out_messages[key][1].append(user_id)
+    out_receipts = {}
+    for member, user_id in receipts:
+        key = (member.thread_id, member.user_id)
+        if key not in out_receipts:
+            out_receipts[key] = ({"type": "receipt", "thread_id": member.thread_id, "user_id": member.user_id,
+                                  "delivered_seq": member.delivered_seq, "read_seq": member.read_seq}, [])
+        out_receipts[key][1].append(user_id)
+    return list(out_messages.values()), list(out_receipts.values())
+
+
+async def _poll_other_workers():
+    # Overlap the window a little: rows committed slightly out of created_at
+    # order are still seen, and the per-socket watermarks drop duplicates
+    overlap = timedelta(seconds=max(MESSAGING_POLL_INTERVAL, 1.0))
+    since = datetime.utcnow()
+    while True:
+        await asyncio.sleep(MESSAGING_POLL_INTERVAL)
+        now = datetime.utcnow()
+        if not len(registry):
+            since = now
+            continue
+        try:
+            messages, receipts = await run_in_threadpool(_with_session, _changes_since, since - overlap)
+        except Exception:
+            logger.exception("Messaging poll failed")
+            continue
+        since = now
+        for payload, user_ids in messages:
+            registry.publish_message(payload, user_ids)
+        for payload, user_ids in receipts:
+            registry.publish_receipt(payload, user_ids)
+
+
+_poller = None
+
+
+@router.on_event("startup")
+async def start_poller():
+    global _poller
+    if MESSAGING_POLL_INTERVAL and _poller is None:
+        _poller = asyncio.create_task(_poll_other_workers())
+
+
+@router.on_event("shutdown")
+async def stop_poller():
+    global _poller
+    if _poller is not None:
+        _poller.cancel()
+        _poller = None
+    registry.close_all()
+
+
+# HTTP API
+
+@router.post("/threads", response_model=schemas.ThreadOut)
+def create_thread(data: schemas.ThreadCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    return open_thread(db, current_user.id, data.appointment_id, data.assignment_id)
+
+
+@router.get("/threads")
+def get_threads(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    return list_threads(db, current_user.id)
+
+
+@router.get("/threads/{thread_id}/messages", response_model=List[schemas.MessageOut])
+def get_messages(
+    thread_id: str,
+    before_seq: Optional[int] = None,
+    after_seq: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    return history(db, thread_id, current_user.id, before_seq, after_seq, limit)
+
+
+@router.post("/threads/{thread_id}/messages", response_model=schemas.MessageOut)
+async def send_message(thread_id: str, data: schemas.MessageCreate, db: Session = Depends(get_db),
+                       current_user: models.User = Depends(get_current_user)):
+    payload, members = await run_in_threadpool(post_message, db, thread_id, current_user.id, data.body)
+    registry.publish_message(payload, members)
+    return payload
+
+
+@router.post("/threads/{thread_id}/attachments", response_model=schemas.MessageOut)
+async def send_attachment(thread_id: str, file: UploadFile = File(...), body: Optional[str] = Form(None),
+                          db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    def store_and_post():
+        attachment = store_attachment(db, thread_id, current_user.id, file)
+        try:
+            return post_message(db, thread_id, current_user.id, body, attachment)
+        except Exception:
+            os.remove(os.path.join(media.BACKEND_DIR, attachment["attachment_path"]))
+            raise
+
+    payload, members = await run_in_threadpool(store_and_post)
+    registry.publish_message(payload, members)
+    return payload
+
+
+@router.get("/threads/{thread_id}/messages/{seq}/attachment")
+def get_attachment(thread_id: str, seq: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    _membership(db, thread_id, current_user.id)
+    message = db.get(Message, (thread_id, seq))
+    if message is None or not message.attachment_path:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return delivery.send(message.attachment_path, ATTACHMENT_DIR, media_type=message.attachment_type, filename=message.attachment_name,
+                         headers={"Cache-Control": "private, max-age=86400"})
+
+
+@router.post("/threads/{thread_id}/receipts")
+async def post_receipts(thread_id: str, data: schemas.ReceiptUpdate, db: Session = Depends(get_db),
+                        current_user: models.User = Depends(get_current_user)):
+    payload, members = await run_in_threadpool(update_receipts, db, thread_id, current_user.id, data.delivered_seq, data.read_seq)
+    registry.publish_receipt(payload, members)
+    return payload
+
+
+# WebSocket
+
+def _socket_user(websocket, token):
+    if not token:
+        header = websocket.headers.get("authorization", "")
+        token = header[7:] if header.lower().startswith("bearer ") else None
+    payload = utils.decode_access_token(token) if token else None
+    return payload.get("sub") if payload and not tokens.is_revoked(None, payload) else None
+
+
+async def _handle_frame(conn, frame):
+    kind = frame.get("type")
+    if kind == "ping":
+        conn.send(json.dumps({"type": "pong"}))
+        return
+    client_id = frame.get("client_id")
+    try:
+        if kind == "send":
+            data = schemas.MessageCreate.model_validate(frame)
+            payload, members = await run_in_threadpool(
+                _with_session, post_message, str(frame.get("thread_id", "")), conn.user_id, data.body)
+            conn.send(json.dumps({"type": "sent", "client_id": client_id, "thread_id": payload["thread_id"], "seq": payload["seq"]}))
+            registry.publish_message(payload, members)
+        elif kind == "receipt":
+            data = schemas.ReceiptUpdate.model_validate(frame)
+            payload, members = await run_in_threadpool(
+                _with_session, update_receipts, str(frame.get("thread_id", "")), conn.user_id,
+                data.delivered_seq, data.read_seq)
+            registry.publish_receipt(payload, members)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown frame type {kind!r}")
+    except HTTPException as e:
+        _send_error(conn, client_id, e.status_code, e.detail)
+    except ValidationError as e:
+        _send_error(conn, client_id, 422, jsonable_encoder(e.errors(include_url=False, include_context=False, include_input=False)))
+    except Exception:
+        logger.exception("Messaging frame %r from user %s failed", kind, conn.user_id)
+        _send_error(conn, client_id, 500, "Internal server error")
+
+
+def _send_error(conn, client_id, status_code, detail):
+    conn.send(json.dumps({"type": "error", "client_id": client_id, "status": status_code, "detail": detail}, default=str))
+
+
+@router.websocket("/ws/messages")
+async def messages_socket(websocket: WebSocket, token: Optional[str] = None):
+    user_id = await run_in_threadpool(_socket_user, websocket, token)
+    if not user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    conn = Connection(websocket, user_id)
+    registry.add(conn)
+    conn.task = asyncio.create_task(conn.run_writer())
+    try:
+        while True:
+            try:
+                frame = await websocket.receive_json()
+            except (ValueError, KeyError):
+                frame = None
+            if not isinstance(frame, dict):
+                _send_error(conn, None, 400, "Frames must be JSON objects")
+                continue
+            await _handle_frame(conn, frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        registry.remove(conn)
+        conn.close()
@@ -0,0 +1,220 @@
+# Request, SQL and external-call instrumentation exposed in Prometheus text format
+
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # optional dependency
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "x-profile").lower().encode()
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "../profiles"))
+if PROFILING_ENABLED and Profiler is None:
+    logger.warning("PROFILING_ENABLED is set but pyinstrument is not installed; X-Profile is ignored")
+    PROFILING_ENABLED = False
+
+
+class Histogram:
+    def __init__(self, name, help_, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._series.items()]
+        for label_values, counts, total, count in items:
+            base = _format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{base}{"," if base else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base}{"," if base else ""}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_, labels):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{{{_format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    return ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status"))
+REQUEST_DB_QUERIES = Histogram("http_request_db_queries", "SQL statements executed per HTTP request.", ("method", "route"), QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram("http_request_db_duration_seconds", "Time spent in SQL per HTTP request.", ("method", "route"))
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "Latency of individual SQL statements.", ("operation",))
+EXTERNAL_LATENCY = Histogram("external_call_duration_seconds", "Latency of calls to external services.", ("service", "operation", "outcome"))
+
+_registry = [REQUEST_LATENCY, REQUEST_DB_QUERIES, REQUEST_DB_TIME, DB_QUERY_LATENCY, EXTERNAL_LATENCY]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Per-request SQL accounting. The stats list is mutated in place so that
+# sync routes running in the threadpool (which copies the context) still
+# report back to the request that spawned them.
+_request_db_stats = contextvars.ContextVar("request_db_stats", default=None)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_LATENCY.observe((statement.lstrip()[:6].upper(),), elapsed)
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def timed(service, operation):
+    """Record latency and outcome of an external call (Daraja, SMTP, SMS)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                EXTERNAL_LATENCY.observe((service, operation, outcome), time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; avoids BaseHTTPMiddleware's per-request task overhead."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if PROFILING_ENABLED and _wants_profile(scope):
+            return await self._profiled(scope, receive, send)
+
+        stats = [0, 0.0]
+        token = _request_db_stats.set(stats)
+        status_holder = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_db_stats.reset(token)
+            method = scope["method"]
+            route = _route_label(scope)
+            REQUEST_LATENCY.observe((method, route, status_holder[0]), elapsed)
+            REQUEST_DB_QUERIES.observe((method, route), stats[0])
+            REQUEST_DB_TIME.observe((method, route), stats[1])
+
+    async def _profiled(self, scope, receive, send):
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            route = _route_label(scope).strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+            path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}_{scope['method']}_{route}.html")
+            with open(path, "w") as f:
+                f.write(profiler.output_html())
+
+
+def _wants_profile(scope):
+    for name, value in scope.get("headers", ()):
+        if name == PROFILE_HEADER:
+            return value not in (b"", b"0")
+    return False
+
+
+def _route_label(scope):
+    # Use the route template, not the raw path, to keep label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+router = APIRouter()
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
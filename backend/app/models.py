@@ -1,7 +1,7 @@
-from sqlalchemy import Column, String, Enum, Integer, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, String, Enum, Integer, DateTime, Date, ForeignKey, Boolean, Text, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-import uuid
+from .ids import CompactUUID, new_id
 import enum
 from datetime import datetime
 
@@ -23,7 +23,7 @@ class UserRole(enum.Enum):
 
 class Patient(Base):
     __tablename__ = "patients"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
     name = Column(String, nullable=False)
     email = Column(String, nullable=True)
     gender = Column(String, nullable=True)
@@ -32,8 +32,8 @@ class Patient(Base):
 
 class ConsultationRequest(Base):
     __tablename__ = "consultation_requests"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    patient_id = Column(String, ForeignKey("patients.id"))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    patient_id = Column(CompactUUID, ForeignKey("patients.id"))
     issue = Column(String, nullable=False)
     details = Column(String)
     fee_amount = Column(Integer, default=1000)
@@ -42,44 +42,81 @@ class ConsultationRequest(Base):
 
 class Assignment(Base):
     __tablename__ = "assignments"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    request_id = Column(String, ForeignKey("consultation_requests.id"))
-    head_doctor_id = Column(String)
-    assigned_doctor_id = Column(String)
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    request_id = Column(CompactUUID, ForeignKey("consultation_requests.id"))
+    head_doctor_id = Column(CompactUUID)
+    assigned_doctor_id = Column(CompactUUID)
     assigned_at = Column(DateTime, default=lambda: datetime.utcnow())
 
 class User(Base):
     __tablename__ = "users"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
     name = Column(String, nullable=True)
     email = Column(String, unique=True, nullable=False)
     phone = Column(String, unique=True, nullable=False)
     password_hash = Column(String, nullable=False)
     is_verified = Column(Boolean, default=False)
     role = Column(Enum(UserRole), default=UserRole.patient)
+    region = Column(String, nullable=True, index=True)  # county; picks the user's shard (see shards.py)
     created_at = Column(DateTime, default=lambda: datetime.utcnow())
     appointments = relationship("Appointment", back_populates="user")
+    doctor = relationship("Doctor", back_populates="user", uselist=False)
 
 class OTP(Base):
     __tablename__ = "otps"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = Column(CompactUUID, ForeignKey("users.id"))
     code = Column(String, nullable=False)
     type = Column(Enum(OTPType), nullable=False)
     expires_at = Column(DateTime, nullable=False)
     is_used = Column(Boolean, default=False)
+    __table_args__ = (Index("ix_otps_user_id", "user_id"), Index("ix_otps_expires_at", "expires_at"))
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    # Single-use: POST /auth/refresh spends it and issues the next one in the same family
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = Column(CompactUUID, ForeignKey("users.id"), nullable=False)
+    family_id = Column(CompactUUID, nullable=False)  # every token descended from one login
+    token_hash = Column(String, nullable=False, unique=True)  # sha256 of the token
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime, nullable=True)  # spent; presenting it again revokes the family
+    revoked_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_refresh_tokens_user_id", "user_id"),
+        Index("ix_refresh_tokens_family_id", "family_id"),
+        Index("ix_refresh_tokens_expires_at", "expires_at"),
+    )
+
+class TokenRevocation(Base):
+    __tablename__ = "token_revocations"
+    # Revoked access tokens: one token by jti, or (jti null) every token issued to user_id before revoked_at
+    seq = Column(Integer, primary_key=True, autoincrement=True)  # workers sync their filters from it
+    jti = Column(String, nullable=True)
+    user_id = Column(CompactUUID, nullable=True)
+    revoked_at = Column(DateTime, nullable=False, default=lambda: datetime.utcnow())
+    expires_at = Column(DateTime, nullable=False)  # every token it covers has expired by then
+    __table_args__ = (
+        Index("ix_token_revocations_jti", "jti"),
+        Index("ix_token_revocations_user", "user_id", "revoked_at"),
+        Index("ix_token_revocations_expires_at", "expires_at"),
+        {"sqlite_autoincrement": True},
+    )
 
 class Service(Base):
     __tablename__ = "services"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    name = Column(String, nullable=False)
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    name = Column(String, nullable=False, unique=True)
     description = Column(String, nullable=True)
     price = Column(Integer, nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.utcnow())
 
 class Doctor(Base):
     __tablename__ = "doctors"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    # Login account; empty for doctors added by an admin without one
+    user_id = Column(CompactUUID, ForeignKey("users.id"), unique=True, nullable=True)
     name = Column(String, nullable=False)
     email = Column(String, unique=True, nullable=False)
     phone = Column(String, unique=True, nullable=False)
@@ -93,13 +130,14 @@ class Doctor(Base):
     is_approved = Column(Boolean, default=False)
     created_at = Column(DateTime, default=lambda: datetime.utcnow())
     certificates = relationship("DoctorCertificate", back_populates="doctor", cascade="all, delete-orphan")
+    user = relationship("User", back_populates="doctor")
 
 class Appointment(Base):
     __tablename__ = "appointments"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"))
-    doctor_id = Column(String, ForeignKey("doctors.id"))
-    service_id = Column(String, ForeignKey("services.id"))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = Column(CompactUUID, ForeignKey("users.id"))
+    doctor_id = Column(CompactUUID, ForeignKey("doctors.id"))
+    service_id = Column(CompactUUID, ForeignKey("services.id"))
     gender = Column(String, nullable=True)
     symptoms = Column(String, nullable=True)
     details = Column(String, nullable=True)
@@ -107,21 +145,195 @@ class Appointment(Base):
     payment_status = Column(String, default="pending")
     created_at = Column(DateTime, default=lambda: datetime.utcnow())
     user = relationship("User", back_populates="appointments")
+    __table_args__ = (Index("ix_appointments_user_created", "user_id", "created_at"),)
 
 class DoctorCertificate(Base):
     __tablename__ = "doctor_certificates"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    doctor_id = Column(String, ForeignKey("doctors.id"))
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    doctor_id = Column(CompactUUID, ForeignKey("doctors.id"))
     title = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
     uploaded_at = Column(DateTime, default=lambda: datetime.utcnow())
+    content_type = Column(String, nullable=True)
+    original_size = Column(Integer, nullable=True)  # bytes
+    processing_status = Column(String, nullable=False, default="pending")  # pending/ready/unsupported/failed
+    preview_path = Column(String, nullable=True)
+    thumbnail_path = Column(String, nullable=True)
     doctor = relationship("Doctor", back_populates="certificates")
 
+    @property
+    def download_url(self):
+        return f"/certificates/{self.id}/download"
+
+    @property
+    def preview_url(self):
+        return f"/certificates/{self.id}/preview" if self.preview_path else None
+
+    @property
+    def thumbnail_url(self):
+        return f"/certificates/{self.id}/thumbnail" if self.thumbnail_path else None
+
 class Notification(Base):
     __tablename__ = "notifications"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"), nullable=True)  # null for broadcast
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = Column(CompactUUID, ForeignKey("users.id"), nullable=True)  # null for broadcast
     message = Column(String, nullable=False)
     type = Column(String, nullable=True)  # e.g. 'doctor_approval', 'appointment', 'event'
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    __table_args__ = (Index("ix_notifications_user_created", "user_id", "created_at"),)
+
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+    name = Column(String, primary_key=True)  # table name
+    version = Column(Integer, nullable=False, default=0)
+
+class SyncChange(Base):
+    __tablename__ = "sync_changes"
+    # Change log behind GET /sync: one row per insert, update or delete of a synced row
+    seq = Column(Integer, primary_key=True, autoincrement=True)  # monotonic; sync tokens point into it
+    table_name = Column(String, nullable=False)
+    row_id = Column(CompactUUID, nullable=False)
+    owner_id = Column(CompactUUID, nullable=True)  # user whose list the row is in; null for shared rows
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, nullable=False, default=lambda: datetime.utcnow())
+    __table_args__ = (
+        Index("ix_sync_changes_owner_seq", "owner_id", "seq"),
+        Index("ix_sync_changes_changed_at", "changed_at"),
+        {"sqlite_autoincrement": True},  # never reuse a seq, even after the log is pruned
+    )
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    id = Column(Integer, primary_key=True, autoincrement=True)  # monotonic; consumers checkpoint on it
+    event_type = Column(String, nullable=False, index=True)
+    aggregate_id = Column(String, nullable=True)
+    payload = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+
+class EventCheckpoint(Base):
+    __tablename__ = "event_checkpoints"
+    consumer = Column(String, primary_key=True)
+    last_event_id = Column(Integer, nullable=False, default=0)
+    locked_by = Column(String, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    # The event the consumer is stuck on, how often it failed and when to try again
+    failed_event_id = Column(Integer, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    retry_at = Column(DateTime, nullable=True)
+
+class JobLease(Base):
+    __tablename__ = "job_leases"
+    # One worker at a time runs a background job (e.g. retention) on this shard
+    name = Column(String, primary_key=True)
+    locked_by = Column(String, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+
+class DeadLetter(Base):
+    __tablename__ = "dead_letters"
+    # Events a consumer gave up on after OUTBOX_MAX_ATTEMPTS failures; the outbox row may be pruned later
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    consumer = Column(String, nullable=False)
+    event_id = Column(Integer, nullable=False)
+    event_type = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    __table_args__ = (Index("ix_dead_letters_consumer_event", "consumer", "event_id", unique=True),)
+
+class ArchiveSegment(Base):
+    __tablename__ = "archive_segments"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String, nullable=False)
+    user_id = Column(String, nullable=True)
+    period = Column(String, nullable=False)  # YYYY-MM of the archived rows
+    row_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)  # zlib-compressed JSON list of rows
+    archived_at = Column(DateTime, default=lambda: datetime.utcnow())
+    __table_args__ = (Index("ix_archive_segments_lookup", "table_name", "user_id", "period"),)
+
+class DailyRollup(Base):
+    __tablename__ = "daily_rollups"
+    metric = Column(String, primary_key=True)  # appointments, revenue, doctor_funnel, otp
+    day = Column(Date, primary_key=True)
+    dim1 = Column(String, primary_key=True, default="")
+    dim2 = Column(String, primary_key=True, default="")
+    count = Column(Integer, nullable=False, default=0)
+    amount = Column(Integer, nullable=False, default=0)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    scope_key = Column(String, primary_key=True)  # "<user id>:<Idempotency-Key header>"
+    method = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)  # sha256 of method, path and body
+    status = Column(String, nullable=False, default="processing")  # processing/completed
+    response_status = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    response_body = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    locked_until = Column(DateTime, nullable=True)  # a crashed request's claim lapses after this
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class ShardDirectory(Base):
+    __tablename__ = "shard_directory"
+    user_id = Column(CompactUUID, primary_key=True)
+    email = Column(String, unique=True, nullable=False)  # unique across shards
+    phone = Column(String, unique=True, nullable=False)
+    shard = Column(String, nullable=False)
+
+class AuditEntry(Base):
+    __tablename__ = "audit_log"  # append-only; written by audit.py
+    seq = Column(Integer, primary_key=True, autoincrement=False)  # position in the hash chain
+    created_at = Column(DateTime, nullable=False)
+    actor_id = Column(String, nullable=True)  # string ids: entries outlive the rows they mention
+    action = Column(String, nullable=False)
+    subject_type = Column(String, nullable=True)
+    subject_id = Column(String, nullable=True)
+    details = Column(Text, nullable=True)  # JSON
+    prev_hash = Column(String(64), nullable=False)
+    hash = Column(String(64), nullable=False)
+    __table_args__ = (
+        Index("ix_audit_log_actor", "actor_id", "created_at"),
+        Index("ix_audit_log_subject", "subject_type", "subject_id", "created_at"),
+        Index("ix_audit_log_created_at", "created_at"),
+    )
+
+class MessageThread(Base):
+    __tablename__ = "message_threads"  # one per appointment or assignment; see messaging.py
+    id = Column(CompactUUID, primary_key=True, default=new_id)
+    appointment_id = Column(CompactUUID, unique=True, nullable=True)
+    assignment_id = Column(CompactUUID, unique=True, nullable=True)
+    last_seq = Column(Integer, nullable=False, default=0)  # seq of the newest message
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    members = relationship("ThreadMember", back_populates="thread", cascade="all, delete-orphan")
+
+class ThreadMember(Base):
+    __tablename__ = "thread_members"
+    thread_id = Column(CompactUUID, ForeignKey("message_threads.id"), primary_key=True)
+    user_id = Column(CompactUUID, primary_key=True)
+    role = Column(String, nullable=False)  # patient/doctor
+    # Receipts are watermarks: every message up to this seq was delivered / read
+    delivered_seq = Column(Integer, nullable=False, default=0)
+    read_seq = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=lambda: datetime.utcnow(), index=True)  # last receipt change
+    thread = relationship("MessageThread", back_populates="members")
+    __table_args__ = (Index("ix_thread_members_user_id", "user_id"),)
+
+class Message(Base):
+    __tablename__ = "messages"
+    thread_id = Column(CompactUUID, ForeignKey("message_threads.id"), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)  # 1, 2, 3... within the thread
+    sender_id = Column(CompactUUID, nullable=False)
+    body = Column(Text, nullable=True)
+    attachment_path = Column(String, nullable=True)  # relative to the backend directory
+    attachment_name = Column(String, nullable=True)
+    attachment_type = Column(String, nullable=True)
+    attachment_size = Column(Integer, nullable=True)  # bytes
+    created_at = Column(DateTime, default=lambda: datetime.utcnow())
+    __table_args__ = (Index("ix_messages_created_at", "created_at"),)
+
+    @property
+    def attachment_url(self):
+        return f"/threads/{self.thread_id}/messages/{self.seq}/attachment" if self.attachment_path else None
@@ -0,0 +1,418 @@
+# Outbound email and SMS delivery
+#
+# Messages are queued to one asyncio loop running in a background thread. The
+# loop keeps a small pool of authenticated SMTP sessions open and one pooled
+# HTTP client for the SMS gateway, drains each queue in batches (SMS batches go
+# through the gateway's bulk endpoint when one is configured), and puts every
+# provider behind a circuit breaker so an outage fails fast instead of tying up
+# request threads. Callers get a concurrent.futures.Future; the helpers in
+# utils wait on it so failures still surface to the caller.
+#
+# Providers: NOTIFY_EMAIL_PROVIDER=smtp|console|fake, NOTIFY_SMS_PROVIDER=http|console|fake.
+# Without one, smtp/http are used when their credentials are set, otherwise
+# console (logged as a warning at startup rather than silently printing).
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_SENT = metrics.register(metrics.Counter(
+    "notifications_sent_total", "Outbound emails and SMS by provider and outcome.", ("channel", "provider", "outcome")))
+NOTIFY_BATCH_SIZE = metrics.register(metrics.Histogram(
+    "notify_batch_size", "Messages handed to a provider per send.", ("channel",), buckets=(1, 2, 5, 10, 25, 50, 100, 250)))
+
+
+@dataclass(frozen=True)
+class Settings:
+    email_provider: str
+    sms_provider: str
+    smtp_host: Optional[str]
+    smtp_port: int
+    smtp_user: Optional[str]
+    smtp_pass: Optional[str]
+    smtp_from: Optional[str]
+    smtp_pool_size: int
+    smtp_validate_certs: bool
+    sms_api_url: Optional[str]
+    sms_api_key: Optional[str]
+    sms_bulk_url: Optional[str]
+    http_pool_size: int
+    batch_size: int
+    batch_window: float
+    send_timeout: float
+    breaker_threshold: int
+    breaker_reset: float
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ
+        smtp_ready = all(env.get(k) for k in ("SMTP_HOST", "SMTP_USER", "SMTP_PASS"))
+        sms_ready = all(env.get(k) for k in ("SMS_API_URL", "SMS_API_KEY"))
+        return cls(
+            email_provider=env.get("NOTIFY_EMAIL_PROVIDER") or ("smtp" if smtp_ready else "console"),
+            sms_provider=env.get("NOTIFY_SMS_PROVIDER") or ("http" if sms_ready else "console"),
+            smtp_host=env.get("SMTP_HOST"),
+            smtp_port=int(env.get("SMTP_PORT", "587")),
+            smtp_user=env.get("SMTP_USER"),
+            smtp_pass=env.get("SMTP_PASS"),
+            smtp_from=env.get("SMTP_FROM") or env.get("SMTP_USER"),
+            smtp_pool_size=int(env.get("SMTP_POOL_SIZE", "4")),
+            smtp_validate_certs=env.get("SMTP_VALIDATE_CERTS", "1") == "1",
+            sms_api_url=env.get("SMS_API_URL"),
+            sms_api_key=env.get("SMS_API_KEY"),
+            sms_bulk_url=env.get("SMS_BULK_API_URL"),
+            http_pool_size=int(env.get("SMS_POOL_SIZE", "20")),
+            batch_size=int(env.get("NOTIFY_BATCH_SIZE", "100")),
+            batch_window=float(env.get("NOTIFY_BATCH_WINDOW", "0.02")),
+            send_timeout=float(env.get("NOTIFY_SEND_TIMEOUT", "30")),
+            breaker_threshold=int(env.get("NOTIFY_BREAKER_THRESHOLD", "5")),
+            breaker_reset=float(env.get("NOTIFY_BREAKER_RESET", "30")),
+        )
+
+
+@dataclass(frozen=True)
+class EmailMessage:
+    to: str
+    subject: str
+    body: str
+
+
+@dataclass(frozen=True)
+class SMSMessage:
+    to: str
+    body: str
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failed sends; after `reset_after`
+    seconds one trial send is let through (half-open)."""
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            self.opened_at = time.monotonic()  # one trial per reset window
+            return True
+        return False
+
+    def record(self, ok):
+        if ok:
+            self.failures, self.opened_at = 0, None
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+# Providers take a list of messages and return one result per message:
+# None on success or the exception for that message.
+
+class ConsoleProvider:
+    name = "console"
+
+    async def send(self, messages):
+        for m in messages:
+            if isinstance(m, EmailMessage):
+                print(f"[DEV] Email to {m.to}: {m.subject}\n{m.body}")
+            else:
+                print(f"[DEV] SMS to {m.to}: {m.body}")
+        return [None] * len(messages)
+
+    async def close(self):
+        pass
+
+
+class FakeProvider:
+    """Keeps messages in memory; for tests and benchmarks."""
+
+    name = "fake"
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, messages):
+        self.sent.extend(messages)
+        return [None] * len(messages)
+
+    async def close(self):
+        pass
+
+
+class SMTPProvider:
+    """Pool of persistent, authenticated SMTP sessions (aiosmtplib)."""
+
+    name = "smtp"
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._idle = []
+        self._open = 0
+        self._available = None
+
+    async def _connect(self):
+        import aiosmtplib
+        client = aiosmtplib.SMTP(hostname=self.settings.smtp_host, port=self.settings.smtp_port,
+                                 timeout=self.settings.send_timeout, validate_certs=self.settings.smtp_validate_certs)
+        await client.connect()  # upgrades with STARTTLS when the server offers it
+        await client.login(self.settings.smtp_user, self.settings.smtp_pass)
+        return client
+
+    async def _acquire(self):
+        if self._available is None:
+            self._available = asyncio.Semaphore(self.settings.smtp_pool_size)
+        await self._available.acquire()
+        if self._idle:
+            return self._idle.pop()
+        try:
+            client = await self._connect()
+        except BaseException:
+            self._available.release()
+            raise
+        self._open += 1
+        return client
+
+    def _release(self, client, broken=False):
+        if broken:
+            self._open -= 1
+            client.close()
+        else:
+            self._idle.append(client)
+        self._available.release()
+
+    async def _send_one(self, message):
+        import aiosmtplib
+        from email.mime.text import MIMEText
+        mime = MIMEText(message.body)
+        mime["Subject"] = message.subject
+        mime["From"] = self.settings.smtp_from
+        mime["To"] = message.to
+        for attempt in (1, 2):
+            client = await self._acquire()
+            try:
+                await client.send_message(mime)
+            except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, ConnectionError):
+                self._release(client, broken=True)
+                if attempt == 2:
+                    raise
+                continue  # stale pooled session; retry once on a fresh one
+            except BaseException:
+                self._release(client, broken=True)
+                raise
+            self._release(client)
+            return
+
+    async def send(self, messages):
+        return list(await asyncio.gather(*(self._send_one(m) for m in messages), return_exceptions=True))
+
+    async def close(self):
+        while self._idle:
+            client = self._idle.pop()
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+
+class HTTPSMSProvider:
+    """SMS gateway over one pooled httpx.AsyncClient; uses the bulk endpoint for batches."""
+
+    name = "http"
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._client = None
+
+    def _http(self):
+        if self._client is None:
+            import httpx
+            size = self.settings.http_pool_size
+            self._client = httpx.AsyncClient(timeout=self.settings.send_timeout,
+                                             limits=httpx.Limits(max_connections=size, max_keepalive_connections=size))
+        return self._client
+
+    async def _send_one(self, message):
+        response = await self._http().post(self.settings.sms_api_url, json={
+            "to": message.to, "message": message.body, "apiKey": self.settings.sms_api_key})
+        response.raise_for_status()
+
+    async def send(self, messages):
+        if self.settings.sms_bulk_url and len(messages) > 1:
+            response = await self._http().post(self.settings.sms_bulk_url, json={
+                "apiKey": self.settings.sms_api_key,
+                "messages": [{"to": m.to, "message": m.body} for m in messages],
+            })
+            response.raise_for_status()
+            return [None] * len(messages)
+        return list(await asyncio.gather(*(self._send_one(m) for m in messages), return_exceptions=True))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+
+def make_provider(kind, settings):
+    if kind == "console":
+        return ConsoleProvider()
+    if kind == "fake":
+        return FakeProvider()
+    if kind == "smtp":
+        return SMTPProvider(settings)
+    if kind == "http":
+        return HTTPSMSProvider(settings)
+    raise ValueError(f"Unknown notification provider: {kind}")
+
+
+class Notifier:
+    """Owns the delivery loop thread and one batching queue per channel."""
+
+    def __init__(self, settings, email_provider, sms_provider):
+        self.settings = settings
+        self.providers = {"email": email_provider, "sms": sms_provider}
+        self.breakers = {ch: CircuitBreaker(settings.breaker_threshold, settings.breaker_reset) for ch in self.providers}
+        self._loop = asyncio.new_event_loop()
+        self._queues = {}
+        self._tasks = []
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="notify", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        for channel in self.providers:
+            self._queues[channel] = asyncio.Queue()
+            self._tasks.append(self._loop.create_task(self._drain(channel)))
+        self._ready.set()
+        self._loop.run_forever()
+
+    def submit(self, channel, message):
+        future = Future()
+        self._loop.call_soon_threadsafe(self._queues[channel].put_nowait, (message, future))
+        return future
+
+    async def _next_batch(self, queue):
+        batch = [await queue.get()]
+        deadline = self._loop.time() + self.settings.batch_window
+        while len(batch) < self.settings.batch_size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _drain(self, channel):
+        provider, breaker = self.providers[channel], self.breakers[channel]
+        queue = self._queues[channel]
+        while True:
+            batch = await self._next_batch(queue)
+            if not breaker.allow():
+                error = CircuitOpenError(f"{channel} provider {provider.name} is unavailable")
+                results = [error] * len(batch)
+            else:
+                NOTIFY_BATCH_SIZE.observe((channel,), len(batch))
+                try:
+                    results = await provider.send([m for m, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                breaker.record(any(r is None for r in results))
+            for (_, future), result in zip(batch, results):
+                NOTIFICATIONS_SENT.inc((channel, provider.name, "ok" if result is None else "error"))
+                if result is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(result)
+                queue.task_done()
+
+    def stop(self, timeout=5):
+        """Send what is already queued (up to timeout seconds), then close the providers."""
+        async def _close():
+            try:
+                await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues.values())), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Notification queue not drained within %ss; pending messages dropped", timeout)
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            for provider in self.providers.values():
+                await provider.close()
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout * 2)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+
+
+_notifier = None
+_lock = threading.Lock()
+
+
+def get_notifier():
+    global _notifier
+    if _notifier is None:
+        with _lock:
+            if _notifier is None:
+                settings = Settings.from_env()
+                for channel, kind in (("email", settings.email_provider), ("sms", settings.sms_provider)):
+                    if kind == "console":
+                        logger.warning("No %s provider configured; messages are printed to stdout", channel)
+                _notifier = Notifier(settings, make_provider(settings.email_provider, settings),
+                                     make_provider(settings.sms_provider, settings)).start()
+    return _notifier
+
+
+def use_fake():
+    """Route both channels to one in-memory FakeProvider and return it."""
+    global _notifier
+    fake = FakeProvider()
+    with _lock:
+        if _notifier is not None:
+            _notifier.stop()
+        _notifier = Notifier(Settings.from_env(), fake, fake).start()
+    return fake
+
+
+def shutdown():
+    global _notifier
+    with _lock:
+        if _notifier is not None:
+            _notifier.stop()
+            _notifier = None
+
+
+def send_email(to, subject, body, wait=True):
+    notifier = get_notifier()
+    future = notifier.submit("email", EmailMessage(to, subject, body))
+    return future.result(notifier.settings.send_timeout) if wait else future
+
+
+def send_sms(to, body, wait=True):
+    notifier = get_notifier()
+    future = notifier.submit("sms", SMSMessage(to, body))
+    return future.result(notifier.settings.send_timeout) if wait else future
@@ -0,0 +1,231 @@
+# GCRA rate limiting for expensive endpoints (bcrypt logins, SMS OTPs, STK pushes, uploads)
+#
+# Limits are per route and keyed by client IP, authenticated user or a request
+# field (e.g. the phone an OTP is sent to). State lives in process by default;
+# set RATE_LIMIT_REDIS_URL to share it between workers.
+
+import json
+import math
+import os
+import time
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+
+from . import metrics, utils
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_POLICIES = os.getenv("RATE_LIMIT_POLICIES")  # optional JSON file overriding DEFAULT_POLICIES
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "0") == "1"
+
+RATE_LIMITED = metrics.register(metrics.Counter("rate_limited_requests_total", "Requests rejected by the rate limiter.", ("route", "key")))
+
+
+@dataclass(frozen=True)
+class Limit:
+    key: str        # 'ip', 'user', 'body:<field>' or 'query:<field>'
+    rate: int       # requests allowed per period
+    period: float   # seconds
+    burst: int = 0  # defaults to rate
+
+    @property
+    def interval(self):
+        return self.period / self.rate
+
+    @property
+    def capacity(self):
+        return self.burst or self.rate
+
+
+DEFAULT_POLICIES = {
+    ("POST", "/auth/login"): [Limit("ip", 20, 60, 10), Limit("body:username", 5, 60)],
+    ("POST", "/auth/refresh"): [Limit("ip", 30, 60, 10)],
+    ("POST", "/auth/signup"): [Limit("ip", 10, 3600, 5)],
+    ("POST", "/auth/send-otp"): [Limit("ip", 10, 60), Limit("body:phone", 3, 600), Limit("body:email", 3, 600)],
+    ("POST", "/auth/verify-otp"): [Limit("ip", 20, 60), Limit("body:phone", 10, 600), Limit("body:email", 10, 600)],
+    ("POST", "/payments/stkpush/"): [Limit("ip", 10, 60), Limit("query:phone_number", 3, 60)],
+    ("POST", "/appointments/payment"): [Limit("user", 5, 60)],
+    ("POST", "/auth/doctor-signup"): [Limit("ip", 10, 3600, 3)],
+    ("POST", "/admin/doctor-signup"): [Limit("ip", 10, 3600, 3)],
+    ("POST", "/doctor/profile-completion"): [Limit("user", 10, 3600, 3)],
+}
+
+
+def load_policies(path=RATE_LIMIT_POLICIES):
+    """Read {"POST /auth/login": [{"key": "ip", "rate": 20, "period": 60, "burst": 10}], ...}."""
+    if not path:
+        return DEFAULT_POLICIES
+    with open(path) as f:
+        raw = json.load(f)
+    policies = {}
+    for route, limits in raw.items():
+        method, path_ = route.split(" ", 1)
+        policies[(method.upper(), path_)] = [Limit(**limit) for limit in limits]
+    return policies
+
+
+class MemoryStore:
+    """In-process GCRA state: key -> theoretical arrival time."""
+
+    def __init__(self, sweep_every=10000):
+        self._tat = {}
+        self._calls = 0
+        self._sweep_every = sweep_every
+
+    async def hit(self, key, interval, capacity, now):
+        self._calls += 1
+        if self._calls % self._sweep_every == 0:
+            self._tat = {k: v for k, v in self._tat.items() if v > now}
+        tat = max(self._tat.get(key, now), now)
+        new_tat = tat + interval
+        allow_at = new_tat - capacity * interval
+        if now < allow_at:
+            return allow_at - now
+        self._tat[key] = new_tat
+        return 0.0
+
+
+_GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval
+local allow_at = new_tat - capacity * interval
+if now < allow_at then return tostring(allow_at - now) end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return '0'
+"""
+
+
+class RedisStore:
+    """Shared GCRA state in Redis (or any server speaking its protocol and EVALSHA)."""
+
+    def __init__(self, url):
+        import redis.asyncio as redis
+
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(_GCRA_LUA)
+
+    async def hit(self, key, interval, capacity, now):
+        return float(await self._script(keys=[f"rl:{key}"], args=[now, interval, capacity]))
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, policies=None, store=None):
+        self.app = app
+        self.policies = policies if policies is not None else load_policies()
+        self.store = store or (RedisStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryStore())
+        # Fast path: keys known to be over the limit are rejected locally until
+        # their retry time, without a round trip to the shared store.
+        self._blocked = {}
+        self._needs_body = {route: any(l.key.startswith("body:") for l in limits) for route, limits in self.policies.items()}
+
+    async def __call__(self, scope, receive, send):
+        if not RATE_LIMIT_ENABLED or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = (scope["method"], scope["path"])
+        limits = self.policies.get(route)
+        if not limits:
+            return await self.app(scope, receive, send)
+
+        body = None
+        if self._needs_body[route]:
+            body, receive = await _buffer_body(receive)
+        now = time.time()
+        for limit in limits:
+            value = _key_value(limit.key, scope, body)
+            if value is None:
+                continue
+            key = f"{route[0]}:{route[1]}:{limit.key}:{value}"
+            blocked_until = self._blocked.get(key)
+            if blocked_until and blocked_until > now:
+                retry_after = blocked_until - now
+            else:
+                retry_after = await self.store.hit(key, limit.interval, limit.capacity, now)
+                if retry_after > 0:
+                    self._blocked[key] = now + retry_after
+                    if len(self._blocked) > 100000:
+                        self._blocked = {k: v for k, v in self._blocked.items() if v > now}
+            if retry_after > 0:
+                RATE_LIMITED.inc((route[1], limit.key))
+                return await _too_many_requests(send, retry_after)
+        await self.app(scope, receive, send)
+
+
+async def _buffer_body(receive):
+    chunks = []
+    more = True
+    while more:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    body = b"".join(chunks)
+    replayed = False
+
+    async def replay():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return body, replay
+
+
+def _header(scope, name):
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _key_value(key, scope, body):
+    if key == "ip":
+        if TRUST_PROXY_HEADERS:
+            forwarded = _header(scope, b"x-forwarded-for")
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+    if key == "user":
+        auth = _header(scope, b"authorization")
+        if not auth or not auth.lower().startswith("bearer "):
+            return None
+        payload = utils.decode_access_token(auth[7:])
+        return payload.get("sub") if payload else None
+    source, _, field = key.partition(":")
+    if source == "query":
+        values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get(field)
+        return values[0] if values else None
+    if source == "body" and body:
+        content_type = _header(scope, b"content-type") or ""
+        try:
+            if content_type.startswith("application/json"):
+                data = json.loads(body)
+                value = data.get(field) if isinstance(data, dict) else None
+            elif content_type.startswith("application/x-www-form-urlencoded"):
+                value = (parse_qs(body.decode()).get(field) or [None])[0]
+            else:
+                return None
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return str(value).strip().lower() if value else None
+    return None
+
+
+async def _too_many_requests(send, retry_after):
+    body = b'{"detail":"Too many requests"}'
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,276 @@
+# Retention and archival for the append-heavy tables
+#
+# Old appointments and notifications are moved, in chunks, into
+# archive_segments: one zlib-compressed JSON blob per (table, user, month),
+# indexed by user so history stays queryable. Spent OTPs, delivered outbox
+# events, old sync log entries, expired refresh tokens and lapsed token
+# revocations are deleted outright. Removing a synced row (appointments,
+# notifications) logs a tombstone like any delete, so delta sync drops it from
+# clients just as a reset snapshot would.
+#
+# A pass holds a lease (job_leases) on its shard, renewed in every chunk's
+# transaction, so with several workers running the background job only one
+# of them works on a shard at a time; a chunk whose lease was lost is rolled back.
+#
+#   python -m app.retention            # one pass over every policy
+#   python -m app.retention --dry-run  # only count eligible rows
+
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import changelog
+from .models import (
+    Appointment, ArchiveSegment, EventCheckpoint, IdempotencyKey, JobLease, Notification, OTP, OutboxEvent, RefreshToken, SyncChange,
+    TokenRevocation,
+)
+
+logger = logging.getLogger(__name__)
+
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "1000"))
+RETENTION_CHUNK_PAUSE = float(os.getenv("RETENTION_CHUNK_PAUSE", "0.05"))  # seconds between chunks
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "0"))  # seconds; 0 disables the in-app job
+RETENTION_LEASE_SECONDS = int(os.getenv("RETENTION_LEASE_SECONDS", "300"))  # renewed with every chunk
+
+LEASE = "retention"
+_worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def _days(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+@dataclass
+class RetentionPolicy:
+    model: type
+    # Builds the WHERE clause for rows to remove, given the current time
+    eligible: Callable
+    archive: bool
+    order_column: Optional[object] = None
+
+
+def _outbox_delivered(now):
+    # Only events every consumer has checkpointed past may go
+    floor = select(func.coalesce(func.min(EventCheckpoint.last_event_id), 0)).scalar_subquery()
+    return and_(OutboxEvent.id <= floor, OutboxEvent.created_at < now - timedelta(days=_days("RETENTION_OUTBOX_DAYS", 7)))
+
+
+def _sync_log_expired(now):
+    # Keep the newest entry: sync detects pruned history from the oldest seq left
+    newest = select(func.max(SyncChange.seq)).scalar_subquery()
+    return and_(SyncChange.changed_at < now - timedelta(days=_days("RETENTION_SYNC_LOG_DAYS", 30)), SyncChange.seq < newest)
+
+
+POLICIES = {
+    "appointments": RetentionPolicy(
+        Appointment,
+        lambda now: Appointment.created_at < now - timedelta(days=_days("RETENTION_APPOINTMENTS_DAYS", 365)),
+        archive=True, order_column=Appointment.created_at,
+    ),
+    "notifications": RetentionPolicy(
+        Notification,
+        lambda now: or_(
+            and_(Notification.is_read == True, Notification.created_at < now - timedelta(days=_days("RETENTION_NOTIFICATIONS_READ_DAYS", 90))),
+            Notification.created_at < now - timedelta(days=_days("RETENTION_NOTIFICATIONS_DAYS", 365)),
+        ),
+        archive=True, order_column=Notification.created_at,
+    ),
+    "otps": RetentionPolicy(
+        OTP,
+        lambda now: OTP.expires_at < now - timedelta(days=_days("RETENTION_OTPS_DAYS", 1)),
+        archive=False, order_column=OTP.expires_at,
+    ),
+    "outbox_events": RetentionPolicy(OutboxEvent, _outbox_delivered, archive=False, order_column=OutboxEvent.id),
+    "idempotency_keys": RetentionPolicy(
+        IdempotencyKey, lambda now: IdempotencyKey.expires_at < now, archive=False, order_column=IdempotencyKey.expires_at,
+    ),
+    "sync_changes": RetentionPolicy(SyncChange, _sync_log_expired, archive=False, order_column=SyncChange.seq),
+    "refresh_tokens": RetentionPolicy(
+        RefreshToken,
+        lambda now: RefreshToken.expires_at < now - timedelta(days=_days("RETENTION_REFRESH_TOKENS_DAYS", 1)),
+        archive=False, order_column=RefreshToken.expires_at,
+    ),
+    "token_revocations": RetentionPolicy(
+        TokenRevocation, lambda now: TokenRevocation.expires_at < now, archive=False, order_column=TokenRevocation.expires_at,
+    ),
+}
+
+
+def _row_dict(obj):
+    row = {}
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.key)
+        row[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return row
+
+
+def _write_segments(db, table_name, rows):
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row.get("user_id"), (row.get("created_at") or "")[:7])].append(row)
+    for (user_id, period), items in groups.items():
+        db.add(ArchiveSegment(
+            table_name=table_name, user_id=user_id, period=period or "unknown", row_count=len(items),
+            payload=zlib.compress(json.dumps(items, separators=(",", ":")).encode(), 6),
+        ))
+
+
+def _renew_lease(db):
+    # Take or extend the lease in db's transaction; False if another worker holds it
+    now = datetime.utcnow()
+    return db.execute(
+        update(JobLease)
+        .where(JobLease.name == LEASE)
+        .where(or_(JobLease.locked_until.is_(None), JobLease.locked_until < now, JobLease.locked_by == _worker_id))
+        .values(locked_by=_worker_id, locked_until=now + timedelta(seconds=RETENTION_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def _claim_lease(session_factory):
+    db = session_factory()
+    try:
+        if db.get(JobLease, LEASE) is None:
+            db.add(JobLease(name=LEASE))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()  # another worker created it first
+        claimed = _renew_lease(db)
+        db.commit()
+        return claimed
+    finally:
+        db.close()
+
+
+def _release_lease(session_factory):
+    db = session_factory()
+    try:
+        db.execute(update(JobLease).where(JobLease.name == LEASE, JobLease.locked_by == _worker_id)
+                   .values(locked_by=None, locked_until=None))
+        db.commit()
+    finally:
+        db.close()
+
+
+def apply_policy(session_factory, name, policy, now=None, chunk_size=RETENTION_CHUNK_SIZE, dry_run=False):
+    """Remove (and optionally archive) eligible rows in chunks; returns the number of rows handled."""
+    now = now or datetime.utcnow()
+    model = policy.model
+    pk = model.__mapper__.primary_key[0]
+    total = 0
+    while True:
+        db = session_factory()
+        try:
+            condition = policy.eligible(now)
+            if dry_run:
+                return db.query(func.count()).select_from(model).filter(condition).scalar()
+            q = db.query(model).filter(condition)
+            if policy.order_column is not None:
+                q = q.order_by(policy.order_column)
+            chunk = q.limit(chunk_size).all()
+            if not chunk:
+                return total
+            if not _renew_lease(db):
+                db.rollback()
+                logger.warning("Retention lease lost; stopping %s", name)
+                return total
+            if policy.archive:
+                _write_segments(db, name, [_row_dict(obj) for obj in chunk])
+            if name in changelog.SYNCED_TABLES:
+                # The Core delete bypasses the flush hook that logs deletes
+                changelog.record(db.connection(bind_arguments={"mapper": model.__mapper__}),
+                                 [(*changelog.entry(name, obj), True) for obj in chunk])
+            # Archive insert and delete commit together, so a crash never loses or duplicates rows
+            db.execute(delete(model).where(pk.in_([getattr(obj, pk.key) for obj in chunk])).execution_options(synchronize_session=False))
+            db.commit()
+            total += len(chunk)
+        finally:
+            db.close()
+        if len(chunk) < chunk_size:
+            return total
+        time.sleep(RETENTION_CHUNK_PAUSE)  # let request traffic in between chunks
+
+
+def run_once(session_factory, dry_run=False):
+    """One pass over every policy; None if another worker is running one on this shard."""
+    if not dry_run and not _claim_lease(session_factory):
+        logger.info("Retention pass skipped: another worker holds the lease")
+        return None
+    results = {}
+    try:
+        for name, policy in POLICIES.items():
+            results[name] = apply_policy(session_factory, name, policy, dry_run=dry_run)
+            if results[name]:
+                logger.info("retention %s: %s %s rows", name, "eligible" if dry_run else "removed", results[name])
+    finally:
+        if not dry_run:
+            _release_lease(session_factory)
+    return results
+
+
+def archived_rows(db, table_name, user_id):
+    """Decompress archived rows for one user, newest first."""
+    segments = db.query(ArchiveSegment).filter(
+        ArchiveSegment.table_name == table_name, ArchiveSegment.user_id == user_id
+    ).order_by(ArchiveSegment.period.desc()).all()
+    rows = [row for seg in segments for row in json.loads(zlib.decompress(seg.payload))]
+    rows.sort(key=lambda r: r.get("created_at") or "", reverse=True)
+    return rows
+
+
+_stop = threading.Event()
+
+
+def start_background(session_factory, shard=None):
+    """Run run_once every RETENTION_INTERVAL seconds in a daemon thread; workers take turns through the lease."""
+    if not RETENTION_INTERVAL:
+        return
+
+    def loop():
+        while not _stop.wait(RETENTION_INTERVAL):
+            try:
+                run_once(session_factory)
+            except Exception:
+                logger.exception("Retention pass failed")
+
+    threading.Thread(target=loop, name=f"retention-{shard}" if shard else "retention", daemon=True).start()
+
+
+def stop_background():
+    _stop.set()
+
+
+def main():
+    from . import shards
+    from .__init__ import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Purge and archive old rows")
+    parser.add_argument("--dry-run", action="store_true", help="only count eligible rows")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for shard, session_factory in shards.session_factories(SessionLocal):
+        prefix = f"{shard} " if shards.is_sharded() else ""
+        results = run_once(session_factory, dry_run=args.dry_run)
+        if results is None:
+            print(f"{prefix}skipped: another worker is running retention")
+            continue
+        for name, count in results.items():
+            print(f"{prefix}{name}: {count} {'eligible' if args.dry_run else 'removed'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, UploadFile, File, Form
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response, UploadFile, File, Form, Query
+from sqlalchemy import case, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from . import schemas, models, utils, daraja
-from .__init__ import SessionLocal, init_db
+from . import schemas, models, utils, daraja, http_cache, events, retention, ids, notify, media, shards, audit, coalesce, data_versions, changelog, fieldsets, delivery, tokens
+from .__init__ import SessionLocal, engine, init_db
 from datetime import datetime, timedelta
 from typing import List, Optional
 import os
-from fastapi.responses import FileResponse
+from fastapi.responses import RedirectResponse
 from .models import Notification
 
 router = APIRouter()
 
+PAYMENT_AMOUNT = 1000  # KES, charged per appointment
+MAX_REVIEW_BATCH = 500  # decisions per /admin/review-doctors request
+EVIDENCE_DIR = "evidence"  # uploaded evidence files, relative to the backend directory
+
 # Dependency
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    # A fresh session per request: the dependency and the route body may run on
+    # different threadpool threads, so the thread-local SessionLocal() registry
+    # would hand one session to concurrent requests that passed through the same thread
+    db = SessionLocal.session_factory()
+    # Pinned to the caller's shard (token claim); anonymous requests use the default shard
+    shards.route(db, request.headers.get("authorization"))
     try:
         yield db
     finally:
@@ -22,49 +33,129 @@ def get_db():
 @router.on_event("startup")
 def on_startup():
     init_db()
+    for shard, session_factory in shards.session_factories(SessionLocal):
+        events.start_relay(session_factory, shard)
+        retention.start_background(session_factory, shard if shards.is_sharded() else None)
+    audit.start(engine)
+
+@router.on_event("shutdown")
+def on_shutdown():
+    audit.stop(engine)
+    events.stop_relay()
+    retention.stop_background()
+    notify.shutdown()
+    media.shutdown()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def _token_payload(db, token):
     payload = utils.decode_access_token(token)
-    if not payload:
+    # Revocation is checked against an in-memory filter; the database only on a filter hit
+    if not payload or tokens.is_revoked(db, payload):
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = db.query(models.User).filter(models.User.id == payload.get("sub")).first()
+    return payload
+
+def _token_subject(db, token):
+    return _token_payload(db, token).get("sub")
+
+def _load_user(db, token, *options):
+    user_id = _token_subject(db, token)
+    user = db.query(models.User).options(*options).filter(models.User.id == user_id).first()
+    if not user and shards.locate(db, user_id=user_id):
+        # Moved to another shard since the token was issued
+        user = db.query(models.User).options(*options).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return _load_user(db, token)
+
+def get_current_user_with_doctor(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    # The linked doctor profile comes back in the same query (LEFT JOIN doctors)
+    return _load_user(db, token, joinedload(models.User.doctor))
+
+def get_current_doctor(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    doctor = db.query(models.Doctor).filter(models.Doctor.user_id == _token_subject(db, token)).first()
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    return doctor
+
 # Auth endpoints
 @router.post("/auth/signup", response_model=schemas.UserOut)
 def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    if db.query(models.User).filter((models.User.email == user.email) | (models.User.phone == user.phone)).first():
-        raise HTTPException(status_code=400, detail="Email or phone already registered")
     role = models.UserRole.superuser if user.email == "ericmutuma15@gmail.com" else models.UserRole.patient
+    if role == models.UserRole.patient:
+        shards.bind(db, shards.shard_for_region(user.region))
     db_user = models.User(
         name=user.name,
         email=user.email,
         phone=user.phone,
+        region=user.region,
         password_hash=utils.get_password_hash(user.password),
         is_verified=False,
         role=role,
         created_at=datetime.utcnow()
     )
     db.add(db_user)
-    db.commit()
+    shards.register(db, db_user)
+    # The unique email/phone constraints (and the shard directory's) reject duplicates
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email or phone already registered")
     db.refresh(db_user)
     return db_user
 
 @router.post("/auth/login")
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    shards.locate(db, email=form_data.username)
     user = db.query(models.User).filter(models.User.email == form_data.username).first()
     if not user or not utils.verify_password(form_data.password, user.password_hash):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
-    token = utils.create_access_token({"sub": user.id})
-    return {"access_token": token, "token_type": "bearer"}
+    pair = tokens.issue(db, user)
+    db.commit()
+    return pair
+
+@router.post("/auth/refresh")
+def refresh(req: schemas.TokenRefresh, db: Session = Depends(get_db)):
+    return tokens.rotate(db, req.refresh_token)
+
+@router.post("/auth/logout")
+def logout(req: Optional[schemas.Logout] = None, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    payload = _token_payload(db, token)
+    tokens.revoke_token(db, payload)
+    if req and req.refresh_token:
+        tokens.revoke_refresh(db, req.refresh_token, payload.get("sub"))
+    db.commit()
+    return {"message": "Logged out"}
+
+@router.post("/auth/logout-all")
+def logout_all(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    tokens.revoke_user(db, current_user.id)
+    db.commit()
+    audit.record("auth.logout_all", current_user.id, "user", current_user.id)
+    return {"message": "Logged out everywhere"}
+
+@router.post("/admin/users/{user_id}/revoke-sessions")
+def revoke_user_sessions(user_id: str, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    if current_user.role != models.UserRole.superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    # Refresh tokens live on the user's shard
+    shards.locate(db, user_id=user_id)
+    user = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    tokens.revoke_user(db, user.id)
+    db.commit()
+    audit.record("auth.revoke_sessions", current_user.id, "user", user_id)
+    return {"message": "Sessions revoked"}
 
 @router.post("/auth/send-otp")
 def send_otp(req: schemas.OTPRequest, db: Session = Depends(get_db)):
     user = None
+    shards.locate(db, email=req.email, phone=req.phone)
     if req.email:
         user = db.query(models.User).filter(models.User.email == req.email).first()
     elif req.phone:
@@ -75,6 +166,7 @@ def send_otp(req: schemas.OTPRequest, db: Session = Depends(get_db)):
     expires_at = datetime.utcnow() + timedelta(minutes=10)
     otp = models.OTP(user_id=user.id, code=code, type=req.type, expires_at=expires_at, is_used=False)
     db.add(otp)
+    events.emit(db, "OtpIssued", {"user_id": user.id, "type": req.type}, aggregate_id=user.id)
     db.commit()
     utils.send_otp_stub(req.email or req.phone, code, req.type)
     return {"message": "OTP sent"}
@@ -82,6 +174,7 @@ def send_otp(req: schemas.OTPRequest, db: Session = Depends(get_db)):
 @router.post("/auth/verify-otp")
 def verify_otp(req: schemas.OTPVerify, db: Session = Depends(get_db)):
     user = None
+    shards.locate(db, email=req.email, phone=req.phone)
     if req.email:
         user = db.query(models.User).filter(models.User.email == req.email).first()
     elif req.phone:
@@ -99,17 +192,18 @@ def verify_otp(req: schemas.OTPVerify, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Invalid or expired OTP")
     otp.is_used = True
     user.is_verified = True
+    events.emit(db, "OtpVerified", {"user_id": user.id, "type": req.type}, aggregate_id=user.id)
+    # Return tokens for immediate login after verification
+    pair = tokens.issue(db, user)
     db.commit()
-    # Return JWT token for immediate login after verification
-    token = utils.create_access_token({"sub": user.id})
-    return {"message": "OTP verified", "access_token": token, "token_type": "bearer", "role": user.role.value}
+    return {"message": "OTP verified", **pair, "role": user.role.value}
 
 # Profile endpoints
 @router.get("/profile")
-def get_profile(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def get_profile(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user_with_doctor)):
     # If doctor, include doctor profile and profile_incomplete flag
     if current_user.role == models.UserRole.doctor:
-        doctor = db.query(models.Doctor).filter(models.Doctor.email == current_user.email).first()
+        doctor = current_user.doctor
         profile_incomplete = not (doctor and doctor.qualifications and doctor.kmpdc_license and doctor.evidence_url and doctor.is_approved)
         return {
             "id": current_user.id,
@@ -146,25 +240,40 @@ def get_profile(db: Session = Depends(get_db), current_user: models.User = Depen
 
 @router.put("/profile", response_model=schemas.UserOut)
 def update_profile(update: schemas.UserCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    changed = sorted(f for f in ("name", "email", "phone", "region")
+                     if getattr(update, f) is not None and getattr(update, f) != getattr(current_user, f))
     current_user.name = update.name
     current_user.email = update.email
     current_user.phone = update.phone
-    db.commit()
+    if update.region is not None:
+        current_user.region = update.region  # a new shard takes effect at the next rebalance
+    shards.update_directory(db, current_user)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email or phone already registered")
     db.refresh(current_user)
+    audit.record("profile.update", current_user.id, "user", current_user.id, fields=changed)
     return current_user
 
+def _evidence_url(doctor, value):
+    """Validate a client-supplied evidence_url: an http(s) link, or the doctor's own uploaded file."""
+    if value.startswith(("http://", "https://")):
+        return value
+    # Only the path the upload endpoint generated; never an arbitrary file under backend/
+    if value.startswith(f"{EVIDENCE_DIR}/{doctor.id}_evidence") and value == doctor.evidence_url:
+        return value
+    raise HTTPException(status_code=422, detail="evidence_url must be an http(s) URL")
+
 @router.put("/doctor/profile", response_model=schemas.DoctorOut)
-def update_doctor_profile(update: schemas.DoctorProfileUpdate, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    # Find doctor by user email (assuming user is logged in as doctor)
-    user = db.query(models.User).filter(models.User.id == utils.decode_access_token(token).get("sub")).first()
-    doctor = db.query(models.Doctor).filter(models.Doctor.email == user.email).first()
-    if not doctor:
-        raise HTTPException(status_code=404, detail="Doctor not found")
+def update_doctor_profile(update: schemas.DoctorProfileUpdate, db: Session = Depends(get_db), doctor: models.Doctor = Depends(get_current_doctor)):
     doctor.qualifications = update.qualifications
-    doctor.evidence_url = update.evidence_url
+    doctor.evidence_url = _evidence_url(doctor, update.evidence_url)
     doctor.kmpdc_license = update.kmpdc_license
     db.commit()
     db.refresh(doctor)
+    audit.record("doctor_profile.update", doctor.user_id, "doctor", doctor.id, kmpdc_license=update.kmpdc_license)
     return doctor
 
 # Appointment endpoints
@@ -181,43 +290,46 @@ def create_appointment(app: schemas.AppointmentCreate, db: Session = Depends(get
         payment_status="pending"
     )
     db.add(db_app)
+    db.flush()
+    # Doctor and superuser emails are sent by the appointment_emails consumer
+    events.emit(db, "AppointmentBooked", {
+        "appointment_id": db_app.id,
+        "doctor_id": app.doctor_id,
+        "service_id": app.service_id,
+        "patient_name": current_user.name or current_user.email,
+        "symptoms": app.symptoms,
+        "details": app.details,
+    }, aggregate_id=db_app.id)
     db.commit()
     db.refresh(db_app)
-
-    # Notify doctor and all superusers
-    doctor = db.query(models.Doctor).filter(models.Doctor.id == app.doctor_id).first()
-    if doctor:
-        utils.send_notification_email(
-            doctor.email,
-            "New Appointment Booked",
-            f"You have a new appointment from {current_user.name or current_user.email}. Symptoms: {app.symptoms}\nDetails: {app.details}"
-        )
-    superusers = db.query(models.User).filter(models.User.role == models.UserRole.superuser).all()
-    for su in superusers:
-        utils.send_notification_email(
-            su.email,
-            "New Appointment Booked",
-            f"A new appointment has been booked for Dr. {doctor.name if doctor else app.doctor_id} by {current_user.name or current_user.email}."
-        )
     return db_app
 
 @router.get("/appointments", response_model=list[schemas.AppointmentOut])
-def list_appointments(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    return db.query(models.Appointment).filter(models.Appointment.user_id == current_user.id).all()
+def list_appointments(
+    include_archived: bool = False,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.AppointmentOut, models.Appointment)),
+    response: Response = None,
+):
+    q = db.query(models.Appointment).filter(models.Appointment.user_id == current_user.id)
+    appointments = (projection.apply(q) if projection else q).all()
+    if include_archived:
+        # Older history lives in compressed archive segments (see retention.py)
+        appointments = appointments + retention.archived_rows(db, "appointments", current_user.id)
+    return fieldsets.respond(projection.dump(appointments), response) if projection else appointments
 
 @router.post("/appointments/payment")
 def appointment_payment(req: schemas.AppointmentPaymentRequest, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     app = db.query(models.Appointment).filter(models.Appointment.id == req.appointment_id, models.Appointment.user_id == current_user.id).first()
     if not app:
         raise HTTPException(status_code=404, detail="Appointment not found")
-    # Initiate Daraja STK Push
-    stk_response = daraja.initiate_stk_push(req.phone_number, 1000)
-    if stk_response.get("ResponseCode") == "0":
-        app.payment_status = "paid"
-        db.commit()
-        return {"message": "Payment initiated. Check your phone to complete the payment.", "stk_response": stk_response}
-    else:
-        return {"status": "error", "message": stk_response.get("message", "Failed to initiate payment."), "stk_response": stk_response}
+    # The STK push is sent by the stk_push consumer once this commits
+    events.emit(db, "PaymentRequested", {"appointment_id": app.id, "phone_number": req.phone_number, "amount": PAYMENT_AMOUNT}, aggregate_id=app.id)
+    user_id, appointment_id = current_user.id, app.id  # read before commit expires them
+    db.commit()
+    audit.record("payment.initiate", user_id, "appointment", appointment_id, amount=PAYMENT_AMOUNT)
+    return {"message": "Payment initiated. Check your phone to complete the payment.", "status": "pending"}
 
 @router.post("/patients/", response_model=schemas.PatientOut)
 def create_patient(patient: schemas.PatientCreate, db: Session = Depends(get_db)):
@@ -264,21 +376,80 @@ def assign_doctor(assignment: schemas.AssignmentCreate, db: Session = Depends(ge
     return db_assignment
 
 # Doctor/admin endpoints
-@router.get("/admin/patients")
-def get_patients(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+@router.get("/admin/patients", response_model=List[schemas.UserOut])
+def get_patients(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.UserOut, models.User)),
+    response: Response = None,
+):
     if current_user.role != models.UserRole.doctor:
         raise HTTPException(status_code=403, detail="Not authorized")
-    return db.query(models.User).filter(models.User.role == models.UserRole.patient).all()
+    # Patients live on their region's shard; gather them from every shard
+    q = shards.scatter(db.query(models.User).filter(models.User.role == models.UserRole.patient))
+    return _sparse_list(q, projection, response)
 
-@router.get("/admin/appointments")
-def get_all_appointments(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+@router.get("/admin/appointments", response_model=List[schemas.AppointmentOut])
+def get_all_appointments(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.AppointmentOut, models.Appointment)),
+    response: Response = None,
+):
     if current_user.role != models.UserRole.doctor:
         raise HTTPException(status_code=403, detail="Not authorized")
-    return db.query(models.Appointment).all()
+    return _sparse_list(shards.scatter(db.query(models.Appointment)), projection, response)
+
+def _sparse_list(query, projection, response):
+    # Full rows through the route's response_model, or only the fields asked for
+    if projection is None:
+        return query.all()
+    return fieldsets.respond(projection.dump(projection.apply(query).all()), response)
+
+@router.get("/admin/audit", response_model=List[schemas.AuditEntryOut])
+def search_audit_log(
+    actor_id: Optional[str] = None,
+    subject_type: Optional[str] = None,
+    subject_id: Optional[str] = None,
+    action: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    before_seq: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    if current_user.role != models.UserRole.superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return audit.search(db, actor_id, subject_type, subject_id, action, start, end, before_seq, limit)
+
+@router.get("/admin/audit/verify")
+def verify_audit_log(current_user: models.User = Depends(get_current_user)):
+    if current_user.role != models.UserRole.superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return audit.verify(engine)
+
+@router.get("/services", response_model=List[schemas.ServiceOut], dependencies=[Depends(http_cache.versioned_etag("services"))])
+def list_services(
+    request: Request = None,
+    db: Session = Depends(get_db),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.ServiceOut, models.Service)),
+    response: Response = None,
+):
+    return _shared_list(request, "/services", (), db.query(models.Service), schemas.ServiceOut, projection, response)
+
+def _dump(schema, rows):
+    # Coalesced results outlive the session that loaded them
+    return [schema.model_validate(row, from_attributes=True) for row in rows]
 
-@router.get("/services", response_model=List[schemas.ServiceOut])
-def list_services(db: Session = Depends(get_db)):
-    return db.query(models.Service).all()
+def _shared_list(request, route, key, query, schema, projection, response):
+    """Coalesced list read, serialized in full or through the requested projection."""
+    # Results read under other table versions than this request's ETag must not be shared with it
+    key = (getattr(request and request.state, "data_versions", ()), *key)
+    if projection is None:
+        return coalesce.shared(route, key, lambda: _dump(schema, query.all()))
+    items = coalesce.shared(route, (*key, projection.names), lambda: projection.dump(projection.apply(query).all()))
+    return fieldsets.respond(items, response)
 
 @router.post("/admin/doctor-signup", response_model=schemas.DoctorOut)
 def admin_doctor_signup(
@@ -291,9 +462,6 @@ def admin_doctor_signup(
     certificate_titles: List[str] = Form([]),
     db: Session = Depends(get_db)
 ):
-    # Check for existing doctor
-    if db.query(models.Doctor).filter((models.Doctor.email == email) | (models.Doctor.phone == phone)).first():
-        raise HTTPException(status_code=400, detail="Email or phone already registered")
     db_doctor = models.Doctor(
         name=name,
         email=email,
@@ -303,7 +471,12 @@ def admin_doctor_signup(
         is_approved=False
     )
     db.add(db_doctor)
-    db.commit()
+    # The unique email/phone constraints reject duplicates
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email or phone already registered")
     db.refresh(db_doctor)
 
     # Save certificates
@@ -322,21 +495,34 @@ def admin_doctor_signup(
             cert = models.DoctorCertificate(
                 doctor_id=db_doctor.id,
                 title=title,
-                file_path=f"certificates/{fname}"
+                file_path=f"certificates/{fname}",
+                content_type=media.content_type_for(fname),
+                original_size=len(file_bytes)
             )
             db.add(cert)
+            db.flush()
+            # Preview and thumbnail are rendered by the certificate_previews consumer
+            events.emit(db, "CertificateUploaded", {"certificate_id": cert.id}, aggregate_id=cert.id)
             cert_objs.append(cert)
     db.commit()
+    audit.record("doctor.create", None, "doctor", db_doctor.id, certificates=len(cert_objs))
     # DO NOT manually assign db_doctor.certificates = cert_objs
     # Instead, reload the doctor from the DB so the certificates relationship is clean
     doctor_out = db.query(models.Doctor).filter(models.Doctor.id == db_doctor.id).first()
     return doctor_out
 
 @router.get("/admin/pending-doctors", response_model=List[schemas.DoctorOut])
-def list_pending_doctors(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def list_pending_doctors(
+    request: Request = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.DoctorOut, models.Doctor)),
+    response: Response = None,
+):
     if current_user.role != models.UserRole.superuser:
         raise HTTPException(status_code=403, detail="Not authorized")
-    return db.query(models.Doctor).filter(models.Doctor.approval_status == "pending").all()
+    q = db.query(models.Doctor).filter(models.Doctor.approval_status == "pending")
+    return _shared_list(request, "/admin/pending-doctors", (), q, schemas.DoctorOut, projection, response)
 
 @router.post("/admin/approve-doctor", response_model=schemas.DoctorOut)
 def approve_doctor(data: schemas.DoctorApproval, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
@@ -348,16 +534,79 @@ def approve_doctor(data: schemas.DoctorApproval, db: Session = Depends(get_db),
     doctor.approval_status = data.approval_status
     doctor.approval_notes = data.approval_notes
     doctor.is_approved = data.approval_status == "approved"
+    if data.approval_status in ("approved", "rejected"):
+        events.emit(db, "DoctorApproved" if doctor.is_approved else "DoctorRejected",
+                    {"doctor_id": doctor.id, "user_id": doctor.user_id, "email": doctor.email, "notes": data.approval_notes},
+                    aggregate_id=doctor.id)
+    user_id = current_user.id
     db.commit()
+    coalesce.flights.clear()
     db.refresh(doctor)
+    audit.record("doctor.review", user_id, "doctor", doctor.id, status=data.approval_status, notes=data.approval_notes)
     return doctor
 
+@router.post("/admin/review-doctors", response_model=List[schemas.DoctorReviewResult])
+def review_doctors(batch: schemas.DoctorReviewBatch, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    """Apply many approve/reject decisions in one UPDATE; results are in request order."""
+    if current_user.role != models.UserRole.superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if len(batch.decisions) > MAX_REVIEW_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_REVIEW_BATCH} decisions per request")
+    results, decisions = [], {}
+    for item in batch.decisions:
+        parsed = ids.parse(item.doctor_id)
+        doctor_id = str(parsed) if parsed else item.doctor_id
+        result = {"doctor_id": doctor_id, "status": item.approval_status}
+        if item.approval_status not in ("approved", "rejected"):
+            result.update(status="invalid", detail="approval_status must be 'approved' or 'rejected'")
+        elif parsed is None:
+            result.update(status="not_found", detail="Doctor not found")
+        elif doctor_id in decisions:
+            result.update(status="duplicate", detail="Doctor appears earlier in this batch")
+        else:
+            decisions[doctor_id] = item
+        results.append(result)
+
+    found = {}
+    if decisions:
+        column = models.Doctor.id
+        stmt = (
+            update(models.Doctor)
+            .where(column.in_(list(decisions)))
+            .values(
+                approval_status=case(*[(column == d, i.approval_status) for d, i in decisions.items()]),
+                approval_notes=case(*[(column == d, i.approval_notes) for d, i in decisions.items()]),
+                is_approved=case(*[(column == d, i.approval_status == "approved") for d, i in decisions.items()]),
+            )
+            .returning(models.Doctor.id, models.Doctor.user_id, models.Doctor.email)
+            .execution_options(synchronize_session=False)
+        )
+        found = {row.id: row for row in db.execute(stmt)}
+    if found:
+        events.emit(db, "DoctorsReviewed", {"decisions": [
+            {"doctor_id": d, "user_id": row.user_id, "email": row.email,
+             "approval_status": decisions[d].approval_status, "notes": decisions[d].approval_notes}
+            for d, row in found.items()
+        ]})
+        # The UPDATE bypasses the flush hooks that version and log doctor changes: record the batch once
+        data_versions.bump(db.connection(bind_arguments={"mapper": models.DataVersion.__mapper__}), ["doctors"])
+        changelog.record(db.connection(bind_arguments={"mapper": models.Doctor.__mapper__}),
+                         [("doctors", d, None, False) for d in found])
+    user_id = current_user.id
+    db.commit()
+    if found:
+        coalesce.flights.clear()
+    for result in results:
+        if result["doctor_id"] in decisions and result["status"] in ("approved", "rejected"):
+            if result["doctor_id"] in found:
+                item = decisions[result["doctor_id"]]
+                audit.record("doctor.review", user_id, "doctor", result["doctor_id"], status=item.approval_status, notes=item.approval_notes)
+            else:
+                result.update(status="not_found", detail="Doctor not found")
+    return results
+
 @router.get("/doctor/profile", response_model=schemas.DoctorOut)
-def get_doctor_profile(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    user = db.query(models.User).filter(models.User.id == utils.decode_access_token(token).get("sub")).first()
-    doctor = db.query(models.Doctor).filter(models.Doctor.email == user.email).first()
-    if not doctor:
-        raise HTTPException(status_code=404, detail="Doctor not found")
+def get_doctor_profile(doctor: models.Doctor = Depends(get_current_doctor)):
     return doctor
 
 @router.get("/patient/profile", response_model=schemas.UserOut)
@@ -370,10 +619,7 @@ def create_superuser(password: str, db: Session = Depends(SessionLocal), token:
     if user:
         raise HTTPException(status_code=400, detail="Superuser already exists.")
     # Only allow if the current user is ericmutuma15@gmail.com
-    payload = utils.decode_access_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    current_user = db.query(models.User).filter(models.User.id == payload.get("sub")).first()
+    current_user = db.query(models.User).filter(models.User.id == _token_subject(db, token)).first()
     if not current_user or current_user.email != "ericmutuma15@gmail.com":
         raise HTTPException(status_code=403, detail="Not authorized")
     superuser = models.User(
@@ -386,19 +632,31 @@ def create_superuser(password: str, db: Session = Depends(SessionLocal), token:
         created_at=datetime.utcnow()
     )
     db.add(superuser)
+    shards.register(db, superuser)
+    db.flush()
+    actor_id, superuser_id = current_user.id, superuser.id
     db.commit()
+    audit.record("superuser.create", actor_id, "user", superuser_id)
     return {"message": "Superuser created!"}
 
-@router.get("/doctors", response_model=List[schemas.DoctorOut])
-def list_doctors(service: Optional[str] = None, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+@router.get("/doctors", response_model=List[schemas.DoctorOut], dependencies=[Depends(http_cache.versioned_etag("doctors", "doctor_certificates", per_user=True, user=get_current_user))])
+def list_doctors(
+    request: Request = None,
+    service: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.DoctorOut, models.Doctor)),
+    response: Response = None,
+):
     # Superusers see all doctors, others see only approved
-    if current_user.role == models.UserRole.superuser:
+    scope = "all" if current_user.role == models.UserRole.superuser else "approved"
+    if scope == "all":
         q = db.query(models.Doctor)
     else:
         q = db.query(models.Doctor).filter(models.Doctor.is_approved == True)
     if service:
         q = q.filter(models.Doctor.specialty == service)
-    return q.all()
+    return _shared_list(request, "/doctors", (scope, service), q, schemas.DoctorOut, projection, response)
 
 @router.post("/auth/doctor-signup", response_model=schemas.UserOut)
 def doctor_signup(
@@ -412,10 +670,8 @@ def doctor_signup(
     certificate_titles: List[str] = Form([]),
     db: Session = Depends(get_db)
 ):
-    # Check if user or doctor already exists
-    if db.query(models.User).filter((models.User.email == email) | (models.User.phone == phone)).first() or \
-       db.query(models.Doctor).filter((models.Doctor.email == email) | (models.Doctor.phone == phone)).first():
-        raise HTTPException(status_code=400, detail="Email or phone already registered")
+    # Doctor accounts live on the default shard, next to their profiles
+    shards.bind(db, shards.DEFAULT)
     # Create user with doctor role
     db_user = models.User(
         name=name,
@@ -426,11 +682,9 @@ def doctor_signup(
         role=models.UserRole.doctor,
         created_at=datetime.utcnow()
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    # Create doctor profile
+    # Create doctor profile linked to the account
     db_doctor = models.Doctor(
+        user=db_user,
         name=name,
         email=email,
         phone=phone,
@@ -439,7 +693,16 @@ def doctor_signup(
         is_approved=False,
         created_at=datetime.utcnow()
     )
-    db.add(db_doctor)
+    db.add_all([db_user, db_doctor])
+    shards.register(db, db_user)
+    # Both inserts go in one transaction; the unique email/phone constraints on
+    # users and doctors reject duplicates
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email or phone already registered")
+    events.emit(db, "DoctorRegistered", {"doctor_id": db_doctor.id, "email": email}, aggregate_id=db_doctor.id)
     db.commit()
     db.refresh(db_doctor)
     # Save certificates
@@ -457,9 +720,14 @@ def doctor_signup(
             cert = models.DoctorCertificate(
                 doctor_id=db_doctor.id,
                 title=title,
-                file_path=f"certificates/{fname}"
+                file_path=f"certificates/{fname}",
+                content_type=media.content_type_for(fname),
+                original_size=len(file_bytes)
             )
             db.add(cert)
+            db.flush()
+            # Preview and thumbnail are rendered by the certificate_previews consumer
+            events.emit(db, "CertificateUploaded", {"certificate_id": cert.id}, aggregate_id=cert.id)
     db.commit()
     return db_user
 
@@ -470,12 +738,8 @@ def doctor_profile_completion(
     evidence_file: UploadFile = File(None),
     evidence_url: str = Form(None),
     db: Session = Depends(get_db),
-    token: str = Depends(oauth2_scheme)
+    doctor: models.Doctor = Depends(get_current_doctor)
 ):
-    user = db.query(models.User).filter(models.User.id == utils.decode_access_token(token).get("sub")).first()
-    doctor = db.query(models.Doctor).filter(models.Doctor.email == user.email).first()
-    if not doctor:
-        raise HTTPException(status_code=404, detail="Doctor not found")
     doctor.qualifications = qualifications
     doctor.kmpdc_license = kmpdc_license
     # Handle evidence file upload
@@ -483,28 +747,21 @@ def doctor_profile_completion(
         evidence_dir = os.path.join(os.path.dirname(__file__), "../evidence")
         os.makedirs(evidence_dir, exist_ok=True)
         ext = os.path.splitext(evidence_file.filename)[1]
-        fname = f"{doctor.id}_evidence{ext}"
+        fname = f"{doctor.id}_evidence{ext if ext[1:].isalnum() else ''}"
         fpath = os.path.join(evidence_dir, fname)
         with open(fpath, "wb") as f:
             f.write(evidence_file.file.read())
         doctor.evidence_url = f"evidence/{fname}"
     elif evidence_url:
-        doctor.evidence_url = evidence_url
+        doctor.evidence_url = _evidence_url(doctor, evidence_url)
     else:
         raise HTTPException(status_code=400, detail="Evidence file or URL required")
     doctor.approval_status = "pending"
     doctor.is_approved = False
+    # Superusers are notified by the doctor_review_inbox consumer
+    events.emit(db, "DoctorSubmitted", {"doctor_id": doctor.id, "name": doctor.name, "email": doctor.email}, aggregate_id=doctor.id)
     db.commit()
-    db.refresh(doctor)
-    # Notify all superusers
-    superusers = db.query(models.User).filter(models.User.role == models.UserRole.superuser).all()
-    for su in superusers:
-        db.add(Notification(
-            user_id=su.id,
-            message=f"New doctor profile submitted: {doctor.name} ({doctor.email}) is awaiting approval.",
-            type="doctor_approval"
-        ))
-    db.commit()
+    audit.record("doctor_profile.submit", doctor.user_id, "doctor", doctor.id, kmpdc_license=kmpdc_license)
     return db.query(models.Doctor).filter(models.Doctor.id == doctor.id).first()
 
 @router.get("/certificates/{certificate_id}/download")
@@ -512,12 +769,35 @@ def download_doctor_certificate(certificate_id: str, db: Session = Depends(get_d
     cert = db.query(models.DoctorCertificate).filter(models.DoctorCertificate.id == certificate_id).first()
     if not cert:
         raise HTTPException(status_code=404, detail="Certificate not found")
-    # The file_path is relative to the backend/app directory
-    abs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), f"../{cert.file_path}"))
-    if not os.path.exists(abs_path):
-        raise HTTPException(status_code=404, detail="File not found")
-    filename = os.path.basename(abs_path)
-    return FileResponse(abs_path, filename=filename)
+    # The file_path is relative to the backend directory
+    return delivery.send(cert.file_path, "certificates", media_type=cert.content_type, filename=os.path.basename(cert.file_path))
+
+@router.get("/certificates/{certificate_id}/preview")
+def certificate_preview(certificate_id: str, db: Session = Depends(get_db)):
+    return _certificate_derivative(db, certificate_id, "preview_path")
+
+@router.get("/certificates/{certificate_id}/thumbnail")
+def certificate_thumbnail(certificate_id: str, db: Session = Depends(get_db)):
+    return _certificate_derivative(db, certificate_id, "thumbnail_path")
+
+def _certificate_derivative(db, certificate_id, attr):
+    cert = db.query(models.DoctorCertificate).filter(models.DoctorCertificate.id == certificate_id).first()
+    if not cert or not getattr(cert, attr):
+        raise HTTPException(status_code=404, detail="Preview not available")
+    # Derivatives are rewritten only when the certificate is reprocessed
+    return delivery.send(getattr(cert, attr), media.PREVIEW_DIR, media_type="image/jpeg", headers={"Cache-Control": "private, max-age=86400"})
+
+@router.get("/doctors/{doctor_id}/evidence")
+def download_doctor_evidence(doctor_id: str, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    # Review material: superusers and the doctor themselves only
+    doctor = db.query(models.Doctor).filter(models.Doctor.id == doctor_id).first()
+    if not doctor or (current_user.role != models.UserRole.superuser and doctor.user_id != current_user.id):
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    if not doctor.evidence_url:
+        raise HTTPException(status_code=404, detail="No evidence uploaded")
+    if doctor.evidence_url.startswith(("http://", "https://")):
+        return RedirectResponse(doctor.evidence_url)
+    return delivery.send(doctor.evidence_url, EVIDENCE_DIR, filename=os.path.basename(doctor.evidence_url))
 
 from fastapi import Request
 
@@ -532,6 +812,11 @@ async def daraja_callback(request: Request, db: Session = Depends(get_db)):
 # Notification endpoints
 @router.post("/notifications/", response_model=schemas.NotificationOut)
 def create_notification(notification: schemas.NotificationCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    # Stored on the recipient's shard; broadcasts on the default shard, where every user's reads look for them
+    if notification.user_id:
+        shards.locate(db, user_id=notification.user_id)
+    else:
+        shards.bind(db, shards.DEFAULT)
     db_notification = Notification(
         user_id=notification.user_id,
         message=notification.message,
@@ -542,14 +827,41 @@ def create_notification(notification: schemas.NotificationCreate, db: Session =
     db.refresh(db_notification)
     return db_notification
 
+def notification_queries(db, user):
+    """Queries for the notifications user sees: their own and the broadcasts (user_id null).
+
+    Broadcasts live on the default shard, so a user on another shard needs one query per shard.
+    """
+    if shards.shard_of(db) == shards.DEFAULT:
+        return [db.query(Notification).filter((Notification.user_id == user.id) | (Notification.user_id == None))]
+    return [db.query(Notification).filter(Notification.user_id == user.id),
+            shards.on(db.query(Notification).filter(Notification.user_id == None), shards.DEFAULT)]
+
 @router.get("/notifications/", response_model=List[schemas.NotificationOut])
-def get_notifications(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    # Fetch notifications for the current user and broadcast (user_id is None)
-    return db.query(Notification).filter((Notification.user_id == current_user.id) | (Notification.user_id == None)).order_by(Notification.created_at.desc()).all()
+def get_notifications(
+    limit: int = Query(100, ge=1, le=500),
+    before: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    projection: Optional[fieldsets.Projection] = Depends(fieldsets.sparse(schemas.NotificationOut, Notification)),
+    response: Response = None,
+):
+    # Fetch notifications for the current user and broadcast (user_id is None), newest first;
+    # page further back with ?before=<created_at of the last item>
+    queries = [q.filter(Notification.created_at < before) if before else q for q in notification_queries(db, current_user)]
+    if len(queries) == 1:
+        return _sparse_list(queries[0].order_by(Notification.created_at.desc()).limit(limit), projection, response)
+    # Newest `limit` of each shard, merged; created_at rides along in case the projection leaves it out
+    rows = [row for q in queries for row in (projection.apply(q) if projection else q)
+            .add_columns(Notification.created_at).order_by(Notification.created_at.desc()).limit(limit)]
+    items = [n for n, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:limit]]
+    return items if projection is None else fieldsets.respond(projection.dump(items), response)
 
 @router.put("/notifications/{notification_id}/read", response_model=schemas.NotificationOut)
 def mark_notification_read(notification_id: str, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     notification = db.query(Notification).filter(Notification.id == notification_id).first()
+    if not notification and shards.shard_of(db) != shards.DEFAULT:
+        notification = shards.on(db.query(Notification).filter(Notification.id == notification_id, Notification.user_id == None), shards.DEFAULT).first()
     if not notification or (notification.user_id and notification.user_id != current_user.id):
         raise HTTPException(status_code=404, detail="Notification not found")
     notification.is_read = True
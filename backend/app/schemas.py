@@ -1,7 +1,18 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import AfterValidator, BaseModel, EmailStr
+from typing import Annotated, Literal, Optional, List
 from datetime import datetime
 
+from . import ids
+
+
+def _valid_id(value):
+    if not ids.is_valid(value):
+        raise ValueError("not a valid id")
+    return value
+
+# Ids in request bodies: a malformed one is a 422, never a NULL foreign key
+Id = Annotated[str, AfterValidator(_valid_id)]
+
 # Patient schemas
 class PatientCreate(BaseModel):
     name: str
@@ -15,7 +26,7 @@ class PatientOut(PatientCreate):
 
 # Consultation Request schemas
 class ConsultationRequestCreate(BaseModel):
-    patient_id: str
+    patient_id: Id
     issue: str
     details: str
 
@@ -27,9 +38,9 @@ class ConsultationRequestOut(ConsultationRequestCreate):
 
 # Assignment schemas
 class AssignmentCreate(BaseModel):
-    request_id: str
-    head_doctor_id: str
-    assigned_doctor_id: str
+    request_id: Id
+    head_doctor_id: Id
+    assigned_doctor_id: Id
 
 class AssignmentOut(AssignmentCreate):
     id: str
@@ -69,13 +80,19 @@ class PatientLogin(BaseModel):
 class OTPRequest(BaseModel):
     email: Optional[EmailStr] = None
     phone: Optional[str] = None
-    type: str  # 'email' or 'phone'
+    type: Literal["email", "phone"]
 
 class OTPVerify(BaseModel):
     email: Optional[EmailStr] = None
     phone: Optional[str] = None
     code: str
-    type: str
+    type: Literal["email", "phone"]
+
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
+class Logout(BaseModel):
+    refresh_token: Optional[str] = None  # also revoke this token's family
 
 # Service schemas
 class ServiceOut(BaseModel):
@@ -105,11 +122,25 @@ class DoctorApproval(BaseModel):
     approval_status: str  # 'approved' or 'rejected'
     approval_notes: str = ''
 
+class DoctorReviewBatch(BaseModel):
+    decisions: List[DoctorApproval]
+
+class DoctorReviewResult(BaseModel):
+    doctor_id: str
+    status: str  # approved, rejected, not_found, invalid or duplicate
+    detail: str | None = None
+
 class DoctorCertificateOut(BaseModel):
     id: str
     title: str
     file_path: str
     uploaded_at: datetime
+    content_type: str | None = None
+    original_size: int | None = None
+    processing_status: str = "pending"
+    download_url: str
+    preview_url: str | None = None
+    thumbnail_url: str | None = None
     class Config:
         orm_mode = True
 
@@ -133,8 +164,8 @@ class DoctorOut(BaseModel):
 
 # Appointment schemas (updated)
 class AppointmentCreate(BaseModel):
-    doctor_id: str
-    service_id: str
+    doctor_id: Id
+    service_id: Id
     gender: str
     symptoms: str
     details: str
@@ -166,6 +197,7 @@ class UserOut(BaseModel):
     phone: str
     is_verified: bool
     role: str
+    region: Optional[str] = None
     created_at: datetime
     class Config:
         orm_mode = True
@@ -176,10 +208,11 @@ class UserCreate(BaseModel):
     phone: str
     password: str
     role: str = "patient"  # 'superuser', 'doctor', 'patient'
+    region: Optional[str] = None  # county; picks the patient's shard
 
 # Payment schemas
 class AppointmentPaymentRequest(BaseModel):
-    appointment_id: str
+    appointment_id: Id
     phone_number: str
 
 class NotificationOut(BaseModel):
@@ -192,7 +225,62 @@ class NotificationOut(BaseModel):
     class Config:
         orm_mode = True
 
+class AuditEntryOut(BaseModel):
+    seq: int
+    created_at: datetime
+    actor_id: Optional[str]
+    action: str
+    subject_type: Optional[str]
+    subject_id: Optional[str]
+    details: Optional[str]  # JSON
+    hash: str
+    class Config:
+        orm_mode = True
+
 class NotificationCreate(BaseModel):
-    user_id: Optional[str] = None
+    user_id: Optional[Id] = None  # None broadcasts
     message: str
     type: Optional[str] = None
+
+# Messaging schemas
+class ThreadCreate(BaseModel):
+    appointment_id: Optional[Id] = None
+    assignment_id: Optional[Id] = None
+
+class ThreadMemberOut(BaseModel):
+    user_id: str
+    role: str
+    delivered_seq: int
+    read_seq: int
+    class Config:
+        orm_mode = True
+
+class ThreadOut(BaseModel):
+    id: str
+    appointment_id: Optional[str]
+    assignment_id: Optional[str]
+    last_seq: int
+    created_at: datetime
+    members: List[ThreadMemberOut] = []
+    class Config:
+        orm_mode = True
+
+class MessageCreate(BaseModel):
+    body: str
+
+class MessageOut(BaseModel):
+    thread_id: str
+    seq: int
+    sender_id: str
+    body: Optional[str]
+    attachment_name: Optional[str] = None
+    attachment_type: Optional[str] = None
+    attachment_size: Optional[int] = None
+    attachment_url: Optional[str] = None
+    created_at: datetime
+    class Config:
+        orm_mode = True
+
+class ReceiptUpdate(BaseModel):
+    delivered_seq: Optional[int] = None
+    read_seq: Optional[int] = None
@@ -1,62 +1,48 @@
-import os
 from app.models import Service, Doctor, User
-from app.__init__ import SessionLocal, init_db
-from app.utils import get_password_hash
-from datetime import datetime
+from app.__init__ import engine, init_db
+from app.importer import upsert, prepare_services, prepare_doctors, prepare_users
 
-def seed_services():
-    services = [
-        {"name": "General Consultation", "description": "Consult with a general practitioner for any health concern.", "price": 1000},
-        {"name": "Pediatrics", "description": "Specialized care for children and infants.", "price": 1200},
-        {"name": "Dermatology", "description": "Skin, hair, and nail care and treatment.", "price": 1500},
-        {"name": "Dental", "description": "Dental checkups, cleaning, and treatment.", "price": 2000},
-        {"name": "Mental Health", "description": "Counseling and mental health support.", "price": 1800},
-        {"name": "Gynecology", "description": "Women's health and reproductive care.", "price": 1700},
-        {"name": "Cardiology", "description": "Heart and blood vessel care.", "price": 2500},
-        {"name": "Orthopedics", "description": "Bone, joint, and muscle care.", "price": 2200},
-    ]
-    db = SessionLocal()
-    for s in services:
-        if not db.query(Service).filter(Service.name == s["name"]).first():
-            db.add(Service(name=s["name"], description=s["description"], price=s["price"], created_at=datetime.utcnow()))
-    db.commit()
-    db.close()
+SERVICES = [
+    {"name": "General Consultation", "description": "Consult with a general practitioner for any health concern.", "price": 1000},
+    {"name": "Pediatrics", "description": "Specialized care for children and infants.", "price": 1200},
+    {"name": "Dermatology", "description": "Skin, hair, and nail care and treatment.", "price": 1500},
+    {"name": "Dental", "description": "Dental checkups, cleaning, and treatment.", "price": 2000},
+    {"name": "Mental Health", "description": "Counseling and mental health support.", "price": 1800},
+    {"name": "Gynecology", "description": "Women's health and reproductive care.", "price": 1700},
+    {"name": "Cardiology", "description": "Heart and blood vessel care.", "price": 2500},
+    {"name": "Orthopedics", "description": "Bone, joint, and muscle care.", "price": 2200},
+]
 
-def seed_doctors():
-    doctors = [
-        {"name": "Dr. Jane Doe", "email": "jane@hospital.com", "phone": "0712345678", "gender": "female", "specialty": "General Consultation", "is_approved": True},
-        {"name": "Dr. John Smith", "email": "john@hospital.com", "phone": "0723456789", "gender": "male", "specialty": "Pediatrics", "is_approved": True},
-        {"name": "Dr. Alice Kim", "email": "alice@hospital.com", "phone": "0734567890", "gender": "female", "specialty": "Dermatology", "is_approved": True},
-    ]
-    db = SessionLocal()
-    for d in doctors:
-        if not db.query(Doctor).filter(Doctor.email == d["email"]).first():
-            db.add(Doctor(name=d["name"], email=d["email"], phone=d["phone"], gender=d["gender"], specialty=d["specialty"], is_approved=d["is_approved"], created_at=datetime.utcnow()))
-    db.commit()
-    db.close()
+DOCTORS = [
+    {"name": "Dr. Jane Doe", "email": "jane@hospital.com", "phone": "0712345678", "gender": "female", "specialty": "General Consultation", "is_approved": True},
+    {"name": "Dr. John Smith", "email": "john@hospital.com", "phone": "0723456789", "gender": "male", "specialty": "Pediatrics", "is_approved": True},
+    {"name": "Dr. Alice Kim", "email": "alice@hospital.com", "phone": "0734567890", "gender": "female", "specialty": "Dermatology", "is_approved": True},
+]
 
-def seed_superuser():
-    db = SessionLocal()
-    superuser_email = "super@yourdomain.com"
-    if not db.query(User).filter(User.email == superuser_email).first():
-        superuser = User(
-            name="Super Admin",
-            email=superuser_email,
-            phone="0700000000",
-            password_hash=get_password_hash("12345"),
-            is_verified=True,
-            role="superuser"
-        )
-        db.add(superuser)
-        db.commit()
-        print("Superuser created.")
-    else:
-        print("Superuser already exists.")
-    db.close()
+# Each seeder is a single INSERT ... ON CONFLICT DO NOTHING on the shared connection
+
+def seed_services(conn):
+    upsert(conn, Service.__table__, prepare_services(SERVICES, conn, None), ("name",))
+
+def seed_doctors(conn):
+    upsert(conn, Doctor.__table__, prepare_doctors(DOCTORS, conn, None), ("email",))
+
+def seed_superuser(conn):
+    superuser = {
+        "name": "Super Admin",
+        "email": "super@yourdomain.com",
+        "phone": "0700000000",
+        "password": "12345",
+        "is_verified": True,
+        "role": "superuser",
+    }
+    result = upsert(conn, User.__table__, prepare_users([superuser], conn, None), ("email",))
+    print("Superuser created." if result.rowcount else "Superuser already exists.")
 
 if __name__ == "__main__":
     init_db()
-    seed_services()
-    seed_doctors()
-    seed_superuser()
+    with engine.begin() as conn:
+        seed_services(conn)
+        seed_doctors(conn)
+        seed_superuser(conn)
     print("Seeding complete.")
@@ -0,0 +1,154 @@
+# Production entry point
+#
+#   python -m app.serve --workers 4 --threads 40
+#
+# With gunicorn installed the app is preloaded in a master process and forked
+# into uvicorn workers, so imports and warmup are paid once; every worker then
+# drops the database connections it inherited and opens its own. Without
+# gunicorn, uvicorn's own supervisor spawns fresh worker processes.
+#
+# Sync route handlers run on anyio's worker threads; --threads sizes that pool
+# per worker, and the database pool is sized to match so threads do not queue
+# for connections. SIGTERM triggers a graceful shutdown: in-flight requests
+# finish, then the outbox relay, notification queue and media pool are drained
+# (see routes.on_shutdown) within --graceful-timeout.
+
+import argparse
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers():
+    return int(os.getenv("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+
+
+def _available(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def resolve_loop(choice):
+    if choice == "auto":
+        return "uvloop" if _available("uvloop") else "asyncio"
+    return choice
+
+
+def resolve_http(choice):
+    if choice == "auto":
+        return "httptools" if _available("httptools") else "h11"
+    return choice
+
+
+async def configure_threadpool():
+    """Startup hook: size the threadpool that runs sync routes (THREADPOOL_SIZE)."""
+    size = os.getenv("THREADPOOL_SIZE")
+    if size:
+        import anyio.to_thread
+        anyio.to_thread.current_default_thread_limiter().total_tokens = int(size)
+
+
+def _post_fork(server, worker):
+    from .__init__ import reset_after_fork
+    reset_after_fork()
+
+
+def run_gunicorn(options):
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {"loop": options.loop, "http": options.http, "lifespan": "on"}
+
+    class Application(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"{options.host}:{options.port}",
+                "workers": options.workers,
+                "worker_class": Worker,
+                "preload_app": options.preload,
+                "graceful_timeout": options.graceful_timeout,
+                "timeout": options.timeout,
+                "keepalive": options.keepalive,
+                "max_requests": options.max_requests,
+                "max_requests_jitter": options.max_requests // 10,
+                "post_fork": _post_fork,
+                "loglevel": options.log_level,
+                "accesslog": "-" if options.access_log else None,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from .main import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(options):
+    import uvicorn
+    uvicorn.run(
+        "app.main:app",
+        host=options.host,
+        port=options.port,
+        workers=options.workers,
+        loop=options.loop,
+        http=options.http,
+        timeout_graceful_shutdown=options.graceful_timeout,
+        timeout_keep_alive=options.keepalive,
+        limit_max_requests=options.max_requests or None,
+        log_level=options.log_level,
+        access_log=options.access_log,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the API with multiple worker processes")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=default_workers(), help="worker processes (WEB_CONCURRENCY)")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("THREADPOOL_SIZE", "40")),
+                        help="threads per worker for sync routes (THREADPOOL_SIZE)")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "uvicorn"], default=os.getenv("APP_SERVER", "auto"))
+    parser.add_argument("--loop", choices=["auto", "uvloop", "asyncio"], default=os.getenv("UVICORN_LOOP", "auto"))
+    parser.add_argument("--http", choices=["auto", "httptools", "h11"], default=os.getenv("UVICORN_HTTP", "auto"))
+    parser.add_argument("--no-preload", dest="preload", action="store_false", help="import the app in each worker instead of the master")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")))
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WORKER_TIMEOUT", "60")), help="gunicorn worker heartbeat timeout")
+    parser.add_argument("--keepalive", type=int, default=int(os.getenv("KEEPALIVE", "5")))
+    parser.add_argument("--max-requests", type=int, default=int(os.getenv("MAX_REQUESTS", "0")), help="recycle workers after N requests (0 = never)")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    parser.add_argument("--access-log", action="store_true")
+    options = parser.parse_args(argv)
+
+    options.loop = resolve_loop(options.loop)
+    options.http = resolve_http(options.http)
+    # Read by each worker: configure_threadpool sizes anyio's limiter, and the
+    # engine's pool grows with it (see app/__init__.py)
+    os.environ["THREADPOOL_SIZE"] = str(options.threads)
+    os.environ.setdefault("DB_POOL_SIZE", str(min(options.threads, 20)))
+    os.environ.setdefault("DB_MAX_OVERFLOW", str(max(options.threads - 20, 0)))
+
+    server = options.server
+    if server == "auto":
+        server = "gunicorn" if _available("gunicorn") else "uvicorn"
+    if server == "gunicorn" and options.preload:
+        # The preloading master pays bcrypt/JWT/client imports once for all workers
+        os.environ.setdefault("APP_WARMUP", "1")
+    logging.basicConfig(level=options.log_level.upper())
+    logger.info("Starting %s: %d workers x %d threads, loop=%s, http=%s",
+                server, options.workers, options.threads, options.loop, options.http)
+    if server == "gunicorn":
+        run_gunicorn(options)
+    else:
+        run_uvicorn(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+# Region-based horizontal sharding
+#
+# Patient-owned rows live on the shard of the patient's region: users, OTPs,
+# refresh tokens, appointments, notifications, and the outbox, rollups and
+# archives written alongside them. The catalogue (services, doctors,
+# certificates), the shard directory, idempotency keys, the audit log, message
+# threads and token revocations stay on the default shard (DATABASE_URL), as do
+# doctor and superuser accounts.
+#
+# SHARD_MAP, a JSON file path or inline JSON, turns sharding on:
+#
+#   {"shards": {"nairobi": "sqlite:///./shards/nairobi.db", "coast": "sqlite:///./shards/coast.db"},
+#    "regions": {"nairobi": "nairobi", "kiambu": "nairobi", "mombasa": "coast", "kilifi": "coast"}}
+#
+# Regions that are not listed map to the default shard. Without SHARD_MAP there
+# is one database and plain sessions, exactly as before.
+#
+# A request's session is pinned to the shard named in the caller's token (the
+# "shard" claim, set at login). Global tables are always read from and written
+# to the default shard. scatter() fans a query out to every shard for admin
+# lists. shard_directory maps each account to its shard and keeps emails and
+# phone numbers unique across shards.
+#
+#   python -m app.shards init                  # migrate every shard, rebuild the directory
+#   python -m app.shards rebalance [--dry-run] # move users whose region now maps elsewhere
+#   python -m app.shards move USER_ID SHARD    # move one user
+
+import argparse
+import functools
+import json
+import logging
+import os
+
+from sqlalchemy import create_engine, delete, inspect, insert, select, update
+from sqlalchemy.ext.horizontal_shard import ShardedSession, set_shard_id
+from sqlalchemy.orm import Mapper, sessionmaker as _sessionmaker
+from sqlalchemy.sql.util import find_tables
+
+from .ids import new_id
+from .models import ShardDirectory, User, UserRole
+
+logger = logging.getLogger(__name__)
+
+DEFAULT = "default"
+
+# Tables that exist once, on the default shard
+GLOBAL_TABLES = frozenset({
+    "services", "doctors", "doctor_certificates", "data_versions", "shard_directory", "idempotency_keys", "audit_log",
+    "patients", "consultation_requests", "assignments", "message_threads", "thread_members", "messages",
+    "token_revocations",
+})
+
+# Rows that move with a user, parents first: (table, column holding the user id)
+USER_TABLES = (
+    ("users", "id"),
+    ("otps", "user_id"),
+    ("refresh_tokens", "user_id"),
+    ("appointments", "user_id"),
+    ("notifications", "user_id"),
+    ("archive_segments", "user_id"),
+)
+
+# Execution option that makes a query run on every shard
+ALL_SHARDS = "all_shards"
+
+engines = {}
+regions = {}
+
+
+def load_map(spec=None):
+    """Parse SHARD_MAP into ({shard: url}, {region: shard}); both empty when unset."""
+    spec = os.getenv("SHARD_MAP", "") if spec is None else spec
+    if not spec:
+        return {}, {}
+    if spec.lstrip().startswith("{"):
+        config = json.loads(spec)
+    else:
+        with open(spec) as f:
+            config = json.load(f)
+    urls = config.get("shards", {})
+    mapping = {region.strip().lower(): shard for region, shard in config.get("regions", {}).items()}
+    unknown = set(mapping.values()) - set(urls) - {DEFAULT}
+    if unknown:
+        raise RuntimeError(f"SHARD_MAP maps regions to undefined shards: {sorted(unknown)}")
+    return urls, mapping
+
+
+def configure(default_engine, **engine_options):
+    """Create an engine per configured shard next to default_engine; returns {shard: engine}."""
+    urls, mapping = load_map()
+    engines.clear()
+    engines[DEFAULT] = default_engine
+    for name, url in urls.items():
+        if name != DEFAULT:
+            engines[name] = create_engine(url, **engine_options)
+    regions.clear()
+    regions.update(mapping)
+    return engines
+
+
+def is_sharded():
+    return len(engines) > 1
+
+
+def shard_for_region(region):
+    return regions.get((region or "").strip().lower(), DEFAULT)
+
+
+def _is_global(mapper):
+    return mapper.local_table.name in GLOBAL_TABLES
+
+
+class RoutedSession(ShardedSession):
+    """A session pinned to one shard (info["shard"]) that sends global tables to the default shard."""
+
+    def __init__(self, **kw):
+        super().__init__(
+            shard_chooser=self._choose_shard,
+            identity_chooser=self._choose_identity,
+            execute_chooser=self._choose_execute,
+            shards=engines,
+            **kw,
+        )
+
+    @property
+    def home(self):
+        return self.info.get("shard", DEFAULT)
+
+    def _for_clause(self, clause):
+        tables = {t.name for t in find_tables(clause, include_crud=True)} if clause is not None else set()
+        return DEFAULT if tables and tables <= GLOBAL_TABLES else self.home
+
+    def _choose_shard(self, mapper, instance, clause=None, **kw):
+        return DEFAULT if mapper is not None and _is_global(mapper) else self.home
+
+    def _choose_identity(self, mapper, primary_key, *, lazy_loaded_from, execution_options, bind_arguments, **kw):
+        if _is_global(mapper):
+            return [DEFAULT]
+        if execution_options.get(ALL_SHARDS):
+            return list(engines)
+        if lazy_loaded_from is not None and lazy_loaded_from.identity_token:
+            return [lazy_loaded_from.identity_token]
+        return [self.home]
+
+    def _choose_execute(self, orm_context):
+        if orm_context.execution_options.get(ALL_SHARDS):
+            return list(engines)
+        return [self._for_clause(orm_context.statement)]
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        if mapper is not None and not isinstance(mapper, Mapper):
+            mapper = inspect(mapper)
+        if shard_id is None and mapper is None and instance is None:
+            # Core statements and session.connection(): route by the tables involved
+            shard_id = self._for_clause(clause)
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+
+def sessionmaker(**kw):
+    """Session factory for the configured shards; a plain sessionmaker when there is only one."""
+    if not is_sharded():
+        return _sessionmaker(bind=engines[DEFAULT], **kw)
+    return _sessionmaker(class_=RoutedSession, **kw)
+
+
+def session_factories(session_local):
+    """(shard, factory) pairs for background workers (outbox relay, retention) that serve every shard."""
+    if not is_sharded():
+        return [(DEFAULT, session_local)]
+    return [(name, functools.partial(session_local.session_factory, info={"shard": name})) for name in engines]
+
+
+def bind(db, shard):
+    """Pin db to shard for the patient-owned tables."""
+    db.info["shard"] = shard if shard in engines else DEFAULT
+
+
+def shard_of(db):
+    return db.info.get("shard", DEFAULT)
+
+
+def route(db, authorization):
+    """Pin a request session to the shard named in its bearer token."""
+    if not isinstance(db, RoutedSession) or not authorization or not authorization.lower().startswith("bearer "):
+        return
+    from .utils import decode_access_token
+    payload = decode_access_token(authorization[7:]) or {}
+    bind(db, payload.get("shard") or DEFAULT)
+
+
+def claims(db):
+    """Extra access-token claims for a user loaded through db."""
+    return {"shard": shard_of(db)} if isinstance(db, RoutedSession) else {}
+
+
+def scatter(query):
+    """Run query on every shard and concatenate the rows (no cross-shard ordering)."""
+    if isinstance(query.session, RoutedSession):
+        return query.execution_options(**{ALL_SHARDS: True})
+    return query
+
+
+def on(query, shard):
+    """Run query on one shard, whatever shard the session is pinned to."""
+    if isinstance(query.session, RoutedSession):
+        return query.options(set_shard_id(shard))
+    return query
+
+
+def locate(db, email=None, phone=None, user_id=None):
+    """Pin db to the shard of the account with this email, phone or id; True if it moved."""
+    if not isinstance(db, RoutedSession):
+        return False
+    column, value = next(((c, v) for c, v in (
+        (ShardDirectory.email, email), (ShardDirectory.phone, phone), (ShardDirectory.user_id, user_id)) if v), (None, None))
+    if column is None:
+        return False
+    shard = db.query(ShardDirectory.shard).filter(column == value).scalar()
+    if shard is None or shard == shard_of(db):
+        return False
+    bind(db, shard)
+    return True
+
+
+def register(db, user):
+    """Record a new account in the directory; flushing it enforces cross-shard email/phone uniqueness."""
+    if not isinstance(db, RoutedSession):
+        return
+    if user.id is None:
+        user.id = new_id()
+    db.add(ShardDirectory(user_id=user.id, email=user.email, phone=user.phone, shard=shard_of(db)))
+
+
+def update_directory(db, user):
+    if not isinstance(db, RoutedSession):
+        return
+    entry = db.get(ShardDirectory, user.id)
+    if entry is None:
+        register(db, user)
+    else:
+        entry.email, entry.phone = user.email, user.phone
+
+
+# Maintenance
+
+def _directory_rows(engine, shard, user_id=None):
+    users = User.__table__
+    q = select(users.c.id, users.c.email, users.c.phone)
+    if user_id is not None:
+        q = q.where(users.c.id == user_id)
+    with engine.connect() as conn:
+        return [{"user_id": r.id, "email": r.email, "phone": r.phone, "shard": shard} for r in conn.execute(q)]
+
+
+def rebuild_directory():
+    """Rebuild shard_directory from the users table of every shard."""
+    rows = [row for name, eng in engines.items() for row in _directory_rows(eng, name)]
+    directory = ShardDirectory.__table__
+    with engines[DEFAULT].begin() as conn:
+        conn.execute(delete(directory))
+        if rows:
+            conn.execute(insert(directory), rows)
+    return len(rows)
+
+
+def move_user(user_id, source, target):
+    """Copy a user's rows to target, repoint the directory, then delete them from source."""
+    if source == target:
+        return 0
+    tables = User.metadata.tables
+    copied = 0
+    with engines[source].connect() as src, engines[target].begin() as dst:
+        for name, column in USER_TABLES:
+            table = tables[name]
+            rows = [dict(r) for r in src.execute(select(table).where(table.c[column] == user_id)).mappings()]
+            if rows:
+                dst.execute(insert(table), rows)
+                copied += len(rows)
+    directory = ShardDirectory.__table__
+    with engines[DEFAULT].begin() as conn:
+        if not conn.execute(update(directory).where(directory.c.user_id == user_id).values(shard=target)).rowcount:
+            conn.execute(insert(directory), _directory_rows(engines[target], target, user_id))
+    _delete_user_rows(engines[source], user_id)
+    return copied
+
+
+def _delete_user_rows(engine, user_id):
+    tables = User.metadata.tables
+    with engine.begin() as conn:
+        for name, column in reversed(USER_TABLES):
+            table = tables[name]
+            conn.execute(delete(table).where(table.c[column] == user_id))
+
+
+def rebalance(dry_run=False):
+    """Move every patient whose region maps to another shard; returns [(user_id, source, target)].
+
+    Also removes leftovers of interrupted moves (rows on a shard the directory
+    no longer points to). Run it with the outbox drained: events already queued
+    on the source shard are delivered there.
+    """
+    directory = ShardDirectory.__table__
+    with engines[DEFAULT].connect() as conn:
+        placed = dict(conn.execute(select(directory.c.user_id, directory.c.shard)).all())
+    moves = []
+    for source, eng in engines.items():
+        users = User.__table__
+        with eng.connect() as conn:
+            rows = conn.execute(select(users.c.id, users.c.role, users.c.region)).all()
+        for user_id, role, region in rows:
+            if placed.get(user_id, source) != source:
+                if not dry_run:
+                    _delete_user_rows(eng, user_id)  # already copied to its current shard
+                continue
+            target = shard_for_region(region) if role in (UserRole.patient, UserRole.patient.name) else DEFAULT
+            if target != source:
+                moves.append((user_id, source, target))
+    if not dry_run:
+        for user_id, source, target in moves:
+            move_user(user_id, source, target)
+    return moves
+
+
+def _drop_global_foreign_keys(engine):
+    # Rows on region shards reference doctors and services on the default shard,
+    # which the region database cannot check (SQLite does not enforce them anyway)
+    if engine.dialect.name == "sqlite":
+        return
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in inspector.get_table_names():
+            if table in GLOBAL_TABLES:
+                continue
+            for fk in inspector.get_foreign_keys(table):
+                if fk["referred_table"] in GLOBAL_TABLES and fk.get("name"):
+                    conn.exec_driver_sql(f'ALTER TABLE {table} DROP CONSTRAINT "{fk["name"]}"')
+
+
+def main():
+    from .__init__ import engines as configured, upgrade_schema
+
+    # Under python -m this module is __main__, not the app.shards the app configured
+    engines.update(configured)
+    regions.update(load_map()[1])
+
+    parser = argparse.ArgumentParser(description="Manage region shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="migrate every shard and rebuild the shard directory")
+    rebalance_cmd = commands.add_parser("rebalance", help="move users whose region maps to another shard")
+    rebalance_cmd.add_argument("--dry-run", action="store_true")
+    move_cmd = commands.add_parser("move", help="move one user to a shard")
+    move_cmd.add_argument("user_id")
+    move_cmd.add_argument("shard")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "init":
+        for name, eng in engines.items():
+            upgrade_schema(eng.url.render_as_string(hide_password=False))
+            if name != DEFAULT:
+                _drop_global_foreign_keys(eng)
+            print(f"{name}: at head")
+        print(f"directory: {rebuild_directory()} accounts")
+    elif args.command == "rebalance":
+        moves = rebalance(dry_run=args.dry_run)
+        for user_id, source, target in moves:
+            print(f"{user_id}: {source} -> {target}")
+        print(f"{len(moves)} users {'to move' if args.dry_run else 'moved'}")
+    else:
+        if args.shard not in engines:
+            parser.error(f"unknown shard {args.shard}")
+        with engines[DEFAULT].connect() as conn:
+            source = conn.execute(select(ShardDirectory.shard).where(ShardDirectory.user_id == args.user_id)).scalar()
+        if source is None:
+            parser.error("user is not in the shard directory (run init first)")
+        print(f"moved {move_user(args.user_id, source, args.shard)} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Delta sync for offline-first clients
+#
+# GET /sync returns the caller's appointments and notifications plus the
+# shared services and doctor lists. Without a token it returns everything, with
+# "reset": true. With the token from the previous response it returns only the
+# rows inserted, updated or deleted since then (tombstones are ids under
+# "deleted"). When nothing changed, the response is just a new token.
+#
+# The token is "<shared seq>.<shard>.<own seq>": two positions in the
+# sync_changes log (changelog.py). The first is on the default shard, for
+# shared rows. The second is on the user's shard, for their own rows. Seqs are
+# allocated at flush but become visible at commit, so a later seq can commit
+# before an earlier one. The token therefore only advances past entries older
+# than SYNC_SETTLE_SECONDS. Newer ones are sent again on the next sync, and
+# clients apply changes as upserts, so repeats are harmless. A token the log
+# can no longer serve gets a reset: the entries after it were pruned, or the
+# user moved shard. The log is pruned after RETENTION_SYNC_LOG_DAYS by
+# retention.py.
+
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import changelog, models, schemas, shards
+from .models import SyncChange
+from .routes import get_current_user, get_db, notification_queries
+
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "500"))  # log entries per scope per response
+SYNC_SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "10"))
+
+router = APIRouter()
+
+SCHEMAS = {
+    "services": schemas.ServiceOut,
+    "doctors": schemas.DoctorOut,
+    "appointments": schemas.AppointmentOut,
+    "notifications": schemas.NotificationOut,
+}
+
+
+def _visible(db, user, table_name):
+    """Queries for the rows of table_name that user's lists show (broadcast notifications are on another shard)."""
+    if table_name == "services":
+        return [db.query(models.Service)]
+    if table_name == "doctors":
+        q = db.query(models.Doctor)
+        # Same rule as GET /doctors
+        return [q if user.role == models.UserRole.superuser else q.filter(models.Doctor.is_approved == True)]
+    if table_name == "appointments":
+        return [db.query(models.Appointment).filter(models.Appointment.user_id == user.id)]
+    return notification_queries(db, user)
+
+
+def _dump(table_name, rows):
+    return jsonable_encoder(TypeAdapter(List[SCHEMAS[table_name]]).validate_python(rows, from_attributes=True))
+
+
+def _parse_token(token):
+    try:
+        shared, rest = token.split(".", 1)
+        shard, own = rest.rsplit(".", 1)
+        return int(shared), shard, int(own)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _settled_head(db, shard, cutoff):
+    """Highest seq on shard below which every entry is older than cutoff."""
+    unsettled = shards.on(db.query(func.min(SyncChange.seq)).filter(SyncChange.changed_at > cutoff), shard).scalar()
+    if unsettled is not None:
+        return unsettled - 1
+    return shards.on(db.query(func.max(SyncChange.seq)), shard).scalar() or 0
+
+
+def _read_log(db, shard, owner_id, after, cutoff):
+    """Entries after seq `after` for one owner (None = shared rows); returns (entries, new position, has_more).
+
+    Returns None when entries after `after` may have been pruned.
+    """
+    oldest = shards.on(db.query(func.min(SyncChange.seq)), shard).scalar()
+    if oldest is not None and after < oldest - 1:
+        return None
+    entries = shards.on(
+        db.query(SyncChange).filter(SyncChange.owner_id == owner_id, SyncChange.seq > after)
+        .order_by(SyncChange.seq).limit(SYNC_PAGE_SIZE), shard,
+    ).all()
+    position = after
+    for e in entries:
+        if e.changed_at > cutoff:
+            return entries, position, False
+        position = e.seq
+    return entries, position, len(entries) == SYNC_PAGE_SIZE
+
+
+def _apply(db, user, entries, changes):
+    latest = {}
+    for e in entries:  # in seq order, so the last entry per row wins
+        latest[(e.table_name, e.row_id)] = e.deleted
+    by_table = defaultdict(set)
+    for (table_name, row_id), deleted in latest.items():
+        if deleted:
+            changes[table_name]["deleted"].add(row_id)
+        else:
+            by_table[table_name].add(row_id)
+    for table_name, row_ids in by_table.items():
+        model = changelog.SYNCED_TABLES[table_name][0]
+        rows = [row for q in _visible(db, user, table_name) for row in q.filter(model.id.in_(row_ids))]
+        changes[table_name]["upserted"].extend(rows)
+        # Rows that are gone or no longer visible (e.g. a doctor who lost approval) become tombstones
+        changes[table_name]["deleted"].update(row_ids - {row.id for row in rows})
+
+
+def _snapshot(db, user):
+    return {table_name: {"upserted": _dump(table_name, [row for q in _visible(db, user, table_name) for row in q]), "deleted": []}
+            for table_name in SCHEMAS}
+
+
+@router.get("/sync")
+def sync(token: Optional[str] = None, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    shard = shards.shard_of(db)
+    cutoff = datetime.utcnow() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    parsed = _parse_token(token) if token else None
+    shared = own = None
+    if parsed is not None and parsed[1] == shard:
+        shared = _read_log(db, shards.DEFAULT, None, parsed[0], cutoff)
+        own = _read_log(db, shard, current_user.id, parsed[2], cutoff) if shared is not None else None
+
+    if shared is None or own is None:
+        # Take the positions before reading, so changes made during the read are sent again next time
+        positions = (_settled_head(db, shards.DEFAULT, cutoff), _settled_head(db, shard, cutoff))
+        return {"token": f"{positions[0]}.{shard}.{positions[1]}", "reset": True, "has_more": False,
+                "changes": _snapshot(db, current_user)}
+
+    changes = defaultdict(lambda: {"upserted": [], "deleted": set()})
+    _apply(db, current_user, shared[0] + own[0], changes)
+    return {
+        "token": f"{shared[1]}.{shard}.{own[1]}",
+        "reset": False,
+        "has_more": shared[2] or own[2],
+        "changes": {
+            table_name: {"upserted": _dump(table_name, c["upserted"]), "deleted": sorted(c["deleted"])}
+            for table_name, c in changes.items() if c["upserted"] or c["deleted"]
+        },
+    }
@@ -0,0 +1,244 @@
+# Refresh tokens and access token revocation
+#
+# Access tokens are short-lived JWTs (utils.ACCESS_TOKEN_MINUTES, default 15)
+# signed with the current JWT_KEYS key, whose id is in the "kid" header. Login
+# also returns a refresh token (REFRESH_TOKEN_DAYS, default 30). POST
+# /auth/refresh spends it and returns a new access token and a new refresh
+# token in the same family (the chain descended from one login). A refresh
+# token works once: presenting a spent one means a copy is in someone else's
+# hands, so all of the user's refresh and access tokens are revoked. Logout
+# revokes one family.
+#
+# Access tokens are revoked through token_revocations: one token by jti
+# (logout), or every token issued to a user before a moment (logout
+# everywhere, refresh token reuse, POST /admin/users/{id}/revoke-sessions).
+# Checking that table on every request would cost a query, so each worker keeps
+# a Bloom filter of the jtis and user ids listed there. The filter is brought up
+# to date from new rows every REVOCATION_SYNC_SECONDS. A token whose jti and
+# user are not in the filter is accepted without a query. Only a hit (a revoked
+# token, or a false positive about REVOCATION_FILTER_ERROR of the time) is
+# checked against the table. Revocations made by a worker are in its own filter
+# at once; other workers see them within REVOCATION_SYNC_SECONDS.
+#
+# A revocation row expires with the tokens it covers, at most one access token
+# lifetime after it was written, so the filter is rebuilt from the live rows
+# once per lifetime and stays small.
+
+import hashlib
+import math
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, update
+
+from . import audit, metrics, shards, utils
+from .ids import new_id
+from .models import RefreshToken, TokenRevocation, User
+
+REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+REVOCATION_FILTER_CAPACITY = int(os.getenv("REVOCATION_FILTER_CAPACITY", "100000"))  # entries before the filter grows
+REVOCATION_FILTER_ERROR = float(os.getenv("REVOCATION_FILTER_ERROR", "0.001"))  # false positive rate at capacity
+REVOCATION_SETTLE = timedelta(minutes=1)  # longest expected gap between a revocation's insert and its commit
+
+REVOCATION_CHECKS = metrics.register(metrics.Counter(
+    "token_revocation_checks_total",
+    "Access token revocation checks by outcome (filter miss, filter false positive, revoked).",
+    ("outcome",)))
+
+
+class BloomFilter:
+    """Set of strings with no false negatives and about error_rate false positives at capacity."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+def _key(jti=None, user_id=None):
+    # A row names one token (jti) or all of a user's earlier tokens (user_id alone)
+    return f"jti:{jti}" if jti else f"user:{user_id}"
+
+
+class RevocationFilter:
+    """This worker's view of token_revocations, as a Bloom filter."""
+
+    def __init__(self, capacity=REVOCATION_FILTER_CAPACITY, error_rate=REVOCATION_FILTER_ERROR):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        self.last_seq = 0
+        self.synced_at = 0.0
+        self.built_at = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, jti=None, user_id=None):
+        self.filter.add(_key(jti, user_id))
+
+    def might_be_revoked(self, jti, user_id):
+        return (jti is not None and _key(jti) in self.filter) or _key(user_id=user_id) in self.filter
+
+    def sync(self, db, now=None):
+        """Add rows written since the last sync, or rebuild from the live rows when due."""
+        now = now or time.monotonic()
+        wall = datetime.utcnow()
+        rebuild = now - self.built_at >= utils.ACCESS_TOKEN_MINUTES * 60 or self.filter.count >= self.filter.capacity
+        q = db.query(TokenRevocation.seq, TokenRevocation.jti, TokenRevocation.user_id) \
+            .filter(TokenRevocation.expires_at > wall)
+        if not rebuild:
+            # A seq below last_seq can still commit later; re-read recent rows to catch it
+            q = q.filter(or_(TokenRevocation.seq > self.last_seq, TokenRevocation.revoked_at > wall - REVOCATION_SETTLE))
+        rows = q.order_by(TokenRevocation.seq).all()
+        if rebuild:
+            target = BloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+            self.built_at = now
+        else:
+            target = self.filter
+        for seq, jti, user_id in rows:
+            key = _key(jti, user_id)
+            if key not in target:
+                target.add(key)
+            self.last_seq = max(self.last_seq, seq)
+        self.filter = target
+        self.synced_at = now
+
+    def refresh(self):
+        """sync() in a session of its own if REVOCATION_SYNC_SECONDS have passed; one thread at a time."""
+        if time.monotonic() - self.synced_at < REVOCATION_SYNC_SECONDS or not self._lock.acquire(blocking=False):
+            return
+        try:
+            from .__init__ import SessionLocal
+            db = SessionLocal.session_factory()
+            try:
+                self.sync(db)
+            finally:
+                db.close()
+        finally:
+            self._lock.release()
+
+
+revocations = RevocationFilter()
+
+
+def _issued_at(payload):
+    return datetime.utcfromtimestamp(payload.get("iat") or 0)
+
+
+def _revoked_exactly(db, payload):
+    jti, user_id = payload.get("jti"), payload.get("sub")
+    covers_user = and_(TokenRevocation.user_id == user_id, TokenRevocation.jti == None,
+                       TokenRevocation.revoked_at > _issued_at(payload))
+    condition = or_(TokenRevocation.jti == jti, covers_user) if jti else covers_user
+    return db.query(TokenRevocation.seq).filter(condition).first() is not None
+
+
+def is_revoked(db, payload):
+    """True if the (validly signed) access token payload has been revoked; db may be None."""
+    revocations.refresh()
+    if not revocations.might_be_revoked(payload.get("jti"), payload.get("sub")):
+        REVOCATION_CHECKS.inc(("miss",))
+        return False
+    if db is not None:
+        revoked = _revoked_exactly(db, payload)
+    else:
+        from .__init__ import SessionLocal
+        db = SessionLocal.session_factory()
+        try:
+            revoked = _revoked_exactly(db, payload)
+        finally:
+            db.close()
+    REVOCATION_CHECKS.inc(("revoked" if revoked else "false_positive",))
+    return revoked
+
+
+def revoke_token(db, payload):
+    """Revoke one access token (commit afterwards)."""
+    jti = payload.get("jti")
+    if not jti:
+        return
+    expires_at = datetime.utcfromtimestamp(payload.get("exp") or time.time())
+    db.add(TokenRevocation(jti=jti, user_id=payload.get("sub"), expires_at=expires_at))
+    revocations.add(jti=jti)
+
+
+def revoke_user(db, user_id):
+    """Revoke every access and refresh token issued to user_id so far (commit afterwards)."""
+    now = datetime.utcnow()
+    db.add(TokenRevocation(user_id=user_id, revoked_at=now, expires_at=now + timedelta(minutes=utils.ACCESS_TOKEN_MINUTES)))
+    db.execute(update(RefreshToken).where(RefreshToken.user_id == user_id, RefreshToken.revoked_at == None)
+               .values(revoked_at=now).execution_options(synchronize_session=False))
+    revocations.add(user_id=user_id)
+
+
+def _hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue(db, user, family_id=None):
+    """Access and refresh token pair for user (commit afterwards)."""
+    # The user id prefix routes a refresh to the user's shard
+    refresh_token = f"{user.id}.{secrets.token_urlsafe(32)}"
+    now = datetime.utcnow()
+    db.add(RefreshToken(user_id=user.id, family_id=family_id or new_id(), token_hash=_hash(refresh_token),
+                        created_at=now, expires_at=now + timedelta(days=REFRESH_TOKEN_DAYS)))
+    return {
+        "access_token": utils.create_access_token({"sub": user.id, **shards.claims(db)}),
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": utils.ACCESS_TOKEN_MINUTES * 60,
+    }
+
+
+def revoke_refresh(db, refresh_token, user_id):
+    """Revoke the family of one of user_id's refresh tokens, if it is theirs (commit afterwards)."""
+    token = db.query(RefreshToken).filter(RefreshToken.token_hash == _hash(refresh_token)).first()
+    if token is None or token.user_id != user_id:
+        return
+    db.execute(update(RefreshToken).where(RefreshToken.family_id == token.family_id, RefreshToken.revoked_at == None)
+               .values(revoked_at=datetime.utcnow()).execution_options(synchronize_session=False))
+
+
+def rotate(db, refresh_token):
+    """Spend refresh_token and return the next token pair; 401 if it is unknown, expired, revoked or spent."""
+    invalid = HTTPException(status_code=401, detail="Invalid refresh token")
+    user_id = refresh_token.partition(".")[0]
+    shards.locate(db, user_id=user_id)
+    token = db.query(RefreshToken).filter(RefreshToken.token_hash == _hash(refresh_token)).first()
+    now = datetime.utcnow()
+    if token is None or token.revoked_at is not None or token.expires_at <= now:
+        raise invalid
+    # Claim it; a second use (replayed copy or concurrent request) finds it spent
+    claimed = db.execute(update(RefreshToken).where(RefreshToken.id == token.id, RefreshToken.used_at == None)
+                         .values(used_at=now).execution_options(synchronize_session=False)).rowcount
+    user = db.get(User, token.user_id) if claimed else None
+    if user is None:
+        if not claimed:
+            revoke_user(db, token.user_id)
+            db.commit()
+            audit.record("auth.refresh_reuse", token.user_id, "user", token.user_id, family_id=token.family_id)
+        raise invalid
+    pair = issue(db, user, family_id=token.family_id)
+    db.commit()
+    return pair
@@ -2,38 +2,70 @@ import hashlib
 import hmac
 import os
 import random
+import secrets
 import string
-import jwt
+import time
 from datetime import datetime, timedelta
-import smtplib
-from email.mime.text import MIMEText
-import requests as http_requests
-from passlib.context import CryptContext
+from functools import lru_cache
+from . import notify
+from .metrics import timed
+
+# passlib/bcrypt and jwt are imported on first use so that
+# importing the app (and every worker cold start) does not pay for them.
 
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecretkey")
 ALGORITHM = "HS256"
+ACCESS_TOKEN_MINUTES = int(os.getenv("ACCESS_TOKEN_MINUTES", "15"))
+
+
+def _load_keys(spec):
+    """Parse JWT_KEYS="<kid>:<secret>,<kid>:<secret>"; the first key signs."""
+    keys = {}
+    for item in spec.split(","):
+        kid, sep, secret = item.strip().partition(":")
+        if kid and sep and secret:
+            keys[kid] = secret
+    return keys
+
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Key rotation: put the new key first (it signs from then on) and keep the old
+# one listed until the tokens it signed have expired, then drop it. Without
+# JWT_KEYS, SECRET_KEY is the only key.
+JWT_KEYS = _load_keys(os.getenv("JWT_KEYS", "")) or {"default": SECRET_KEY}
+SIGNING_KID = next(iter(JWT_KEYS))
+
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Password hashing
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def verify_password(password: str, hash_: str) -> bool:
-    return pwd_context.verify(password, hash_)
+    return get_pwd_context().verify(password, hash_)
 
 # JWT
 
-def create_access_token(data: dict, expires_delta: timedelta = timedelta(hours=1)):
+def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + expires_delta
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_MINUTES))
+    # iat and jti let single tokens, or everything issued before a moment, be revoked (tokens.py)
+    to_encode.update({"exp": expire, "iat": time.time(), "jti": secrets.token_urlsafe(12)})
+    import jwt
+    return jwt.encode(to_encode, JWT_KEYS[SIGNING_KID], algorithm=ALGORITHM, headers={"kid": SIGNING_KID})
 
 def decode_access_token(token: str):
+    import jwt
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        kid = jwt.get_unverified_header(token).get("kid")
+        # Tokens issued before kids were added were signed with the current key
+        key = JWT_KEYS.get(kid) if kid else JWT_KEYS[SIGNING_KID]
+        if key is None:
+            return None
+        return jwt.decode(token, key, algorithms=[ALGORITHM])
     except jwt.PyJWTError:
         return None
 
@@ -42,32 +74,16 @@ def decode_access_token(token: str):
 def generate_otp(length=6):
     return ''.join(random.choices(string.digits, k=length))
 
+# Delivery goes through the provider layer in notify.py (pooled SMTP sessions,
+# batched SMS, circuit breakers); these wrappers wait for the send to finish.
+
+@timed("smtp", "otp")
 def send_email_otp(email: str, code: str):
-    smtp_host = os.getenv("SMTP_HOST")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_pass = os.getenv("SMTP_PASS")
-    if not (smtp_host and smtp_user and smtp_pass):
-        print(f"[DEV] Email OTP to {email}: {code}")
-        return
-    msg = MIMEText(f"Your OTP code is: {code}")
-    msg["Subject"] = "Your OTP Code"
-    msg["From"] = smtp_user
-    msg["To"] = email
-    with smtplib.SMTP(smtp_host, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        server.sendmail(smtp_user, [email], msg.as_string())
+    notify.send_email(email, "Your OTP Code", f"Your OTP code is: {code}")
 
+@timed("sms", "otp")
 def send_sms_otp(phone: str, code: str):
-    # Example: Twilio or Africa's Talking
-    sms_api_url = os.getenv("SMS_API_URL")
-    sms_api_key = os.getenv("SMS_API_KEY")
-    if not (sms_api_url and sms_api_key):
-        print(f"[DEV] SMS OTP to {phone}: {code}")
-        return
-    # Example POST (customize for your provider)
-    http_requests.post(sms_api_url, json={"to": phone, "message": f"Your OTP code is: {code}", "apiKey": sms_api_key})
+    notify.send_sms(phone, f"Your OTP code is: {code}")
 
 def send_otp_stub(destination: str, code: str, type_: str):
     if type_ == "email":
@@ -75,21 +91,16 @@ def send_otp_stub(destination: str, code: str, type_: str):
     elif type_ == "phone":
         send_sms_otp(destination, code)
     else:
-        print(f"[DEV] OTP to {destination}: {code}")
+        raise ValueError(f"Unknown OTP type: {type_}")
 
+@timed("smtp", "notification")
 def send_notification_email(to_email: str, subject: str, message: str):
-    smtp_host = os.getenv("SMTP_HOST")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_pass = os.getenv("SMTP_PASS")
-    if not (smtp_host and smtp_user and smtp_pass):
-        print(f"[DEV] Notification email to {to_email}: {subject}\n{message}")
-        return
-    msg = MIMEText(message)
-    msg["Subject"] = subject
-    msg["From"] = smtp_user
-    msg["To"] = to_email
-    with smtplib.SMTP(smtp_host, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        server.sendmail(smtp_user, [to_email], msg.as_string())
+    notify.send_email(to_email, subject, message)
+
+@timed("smtp", "notification_batch")
+def send_notification_emails(messages):
+    """Queue (to_email, subject, message) tuples together, then wait for all of them."""
+    timeout = notify.get_notifier().settings.send_timeout
+    futures = [notify.send_email(to_email, subject, message, wait=False) for to_email, subject, message in messages]
+    for future in futures:
+        future.result(timeout)
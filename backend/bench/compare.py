@@ -0,0 +1,51 @@
+# Compare two load_test result files and flag latency/throughput regressions.
+#
+#   python -m bench.compare bench/results/base.json bench/results/head.json --threshold 10
+
+import argparse
+import json
+import sys
+
+
+def _delta(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare(base, head, threshold):
+    regressions = []
+    print(f"{'step':<20}{'p95 base':>12}{'p95 head':>12}{'Δ%':>8}{'rps base':>12}{'rps head':>12}{'Δ%':>8}")
+    for name in sorted(set(base["steps"]) | set(head["steps"])):
+        b = base["steps"].get(name)
+        h = head["steps"].get(name)
+        if not b or not h:
+            print(f"{name:<20}{'(missing in ' + ('base' if not b else 'head') + ')':>40}")
+            continue
+        p95 = _delta(b["p95_ms"], h["p95_ms"])
+        rps = _delta(b["rps"], h["rps"])
+        print(f"{name:<20}{b['p95_ms']:>12}{h['p95_ms']:>12}{p95:>8.1f}{b['rps']:>12}{h['rps']:>12}{rps:>8.1f}")
+        if p95 > threshold or rps < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed regression in percent")
+    args = parser.parse_args()
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    print(f"base {base['meta']['commit']} vs head {head['meta']['commit']}")
+    regressions = compare(base, head, args.threshold)
+    if regressions:
+        print(f"regressions above {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Synthetic data generator for benchmarks. Scales seed_demo up to millions of rows
+# using chunked executemany inserts instead of per-row ORM adds.
+#
+#   python -m bench.generate_data --database-url sqlite:///./bench.db --users 1000000
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from app.__init__ import create_schema
+from app.ids import new_id
+from app.models import User, Doctor, Service, Appointment, Notification, UserRole
+from app.utils import get_password_hash
+
+SPECIALTIES = ["General Consultation", "Pediatrics", "Dermatology", "Dental", "Mental Health", "Gynecology", "Cardiology", "Orthopedics"]
+BENCH_PASSWORD = "benchpass"
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(engine, table, rows, total, chunk_size, label):
+    start = time.perf_counter()
+    done = 0
+    for chunk in _chunks(rows, chunk_size):
+        with engine.begin() as conn:
+            conn.execute(table.insert(), chunk)
+        done += len(chunk)
+        print(f"\r{label}: {done}/{total}", end="", flush=True)
+    elapsed = time.perf_counter() - start
+    print(f"\r{label}: {done} rows in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} rows/s)")
+
+
+def generate(database_url, users, doctors, appointments, notifications, chunk_size=5000, seed=42):
+    rnd = random.Random(seed)
+    engine = create_engine(database_url)
+    create_schema(engine)
+    now = datetime.utcnow()
+    # bcrypt is deliberately slow; every generated account shares one hash
+    password_hash = get_password_hash(BENCH_PASSWORD)
+
+    service_ids = [new_id() for _ in SPECIALTIES]
+    _insert(engine, Service.__table__, (
+        {"id": sid, "name": name, "description": f"{name} (bench)", "price": rnd.choice([1000, 1200, 1500, 2000, 2500]), "created_at": now}
+        for sid, name in zip(service_ids, SPECIALTIES)
+    ), len(service_ids), chunk_size, "services")
+
+    doctor_ids = [new_id() for _ in range(doctors)]
+    _insert(engine, Doctor.__table__, (
+        {
+            "id": did, "name": f"Dr. Bench {i}", "email": f"doctor{i}@bench.example.com", "phone": f"071{i:09d}",
+            "gender": rnd.choice(["female", "male"]), "specialty": rnd.choice(SPECIALTIES),
+            "approval_status": "approved", "is_approved": True, "created_at": now - timedelta(days=rnd.randint(0, 365)),
+        }
+        for i, did in enumerate(doctor_ids)
+    ), doctors, chunk_size, "doctors")
+
+    user_ids = [new_id() for _ in range(users)]
+    _insert(engine, User.__table__, (
+        {
+            "id": uid, "name": f"Patient {i}", "email": f"patient{i}@bench.example.com", "phone": f"072{i:09d}",
+            "password_hash": password_hash, "is_verified": True, "role": UserRole.patient.name,
+            "created_at": now - timedelta(days=rnd.randint(0, 365)),
+        }
+        for i, uid in enumerate(user_ids)
+    ), users, chunk_size, "users")
+
+    _insert(engine, Appointment.__table__, (
+        {
+            "id": new_id(), "user_id": rnd.choice(user_ids), "doctor_id": rnd.choice(doctor_ids),
+            "service_id": rnd.choice(service_ids), "gender": rnd.choice(["female", "male"]),
+            "symptoms": "bench symptoms", "details": "bench details",
+            "status": rnd.choice(["pending", "confirmed", "completed"]),
+            "payment_status": rnd.choice(["pending", "paid", "failed"]),
+            "created_at": now - timedelta(minutes=rnd.randint(0, 525600)),
+        }
+        for _ in range(appointments)
+    ), appointments, chunk_size, "appointments")
+
+    _insert(engine, Notification.__table__, (
+        {
+            "id": new_id(), "user_id": rnd.choice(user_ids), "message": "Your appointment has been updated.",
+            "type": "appointment", "is_read": rnd.random() < 0.7,
+            "created_at": now - timedelta(minutes=rnd.randint(0, 525600)),
+        }
+        for _ in range(notifications)
+    ), notifications, chunk_size, "notifications")
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark data")
+    parser.add_argument("--database-url", default="sqlite:///./bench.db")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--doctors", type=int, default=2_000)
+    parser.add_argument("--appointments", type=int, default=300_000)
+    parser.add_argument("--notifications", type=int, default=500_000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generate(args.database_url, args.users, args.doctors, args.appointments, args.notifications, args.chunk_size, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Primary key benchmark: insert throughput and index size for uuid4 text keys
+# versus UUIDv7 binary keys, on a table shaped like appointments.
+#
+#   python -m bench.ids --rows 500000
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Index, MetaData, String, Table, create_engine, text
+
+from app.ids import CompactUUID, new_id
+from .load_test import RESULTS_DIR, git_commit
+
+STRATEGIES = {
+    "uuid4-text": (String, lambda: str(uuid.uuid4())),
+    "uuid7-binary": (CompactUUID, new_id),
+}
+
+
+def _table(metadata, id_type):
+    return Table(
+        "appointments", metadata,
+        Column("id", id_type, primary_key=True),
+        Column("user_id", id_type),
+        Column("status", String),
+        Column("created_at", DateTime),
+        Index("ix_user", "user_id"),
+    )
+
+
+def run_strategy(name, rows, chunk_size, users):
+    id_type, make_id = STRATEGIES[name]
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-ids-"), f"{name}.db")
+    engine = create_engine(f"sqlite:///{path}")
+    table = _table(MetaData(), id_type)
+    table.metadata.create_all(engine)
+    user_ids = [make_id() for _ in range(users)]
+    rnd = random.Random(1)
+    now = datetime.utcnow()
+
+    start = time.perf_counter()
+    for offset in range(0, rows, chunk_size):
+        chunk = [{"id": make_id(), "user_id": rnd.choice(user_ids), "status": "pending", "created_at": now}
+                 for _ in range(min(chunk_size, rows - offset))]
+        with engine.begin() as conn:
+            conn.execute(table.insert(), chunk)
+    elapsed = time.perf_counter() - start
+
+    with engine.connect() as conn:
+        page_size = conn.execute(text("PRAGMA page_size")).scalar()
+        pages = conn.execute(text("PRAGMA page_count")).scalar()
+        # Primary-key lookups in random order, a proxy for FK joins
+        sample = [r[0] for r in conn.execute(text("SELECT id FROM appointments ORDER BY random() LIMIT 2000"))]
+        lookup_start = time.perf_counter()
+        for key in sample:
+            conn.execute(text("SELECT status FROM appointments WHERE id = :id"), {"id": key}).first()
+        lookup_us = (time.perf_counter() - lookup_start) / max(len(sample), 1) * 1e6
+    engine.dispose()
+    os.remove(path)
+    return {
+        "rows_per_s": round(rows / elapsed),
+        "db_mb": round(page_size * pages / 1e6, 2),
+        "pk_lookup_us": round(lookup_us, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare primary key strategies")
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--output", help="result file (default: bench/results/ids_<timestamp>_<commit>.json)")
+    args = parser.parse_args()
+
+    results = {}
+    for name in STRATEGIES:
+        results[name] = run_strategy(name, args.rows, args.chunk_size, args.users)
+        r = results[name]
+        print(f"{name:<14} {r['rows_per_s']:>9} rows/s   {r['db_mb']:>8} MB   pk lookup {r['pk_lookup_us']:>6} us")
+
+    commit = git_commit()
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"ids_{datetime.utcnow():%Y%m%dT%H%M%S}_{commit}.json")
+    with open(output, "w") as f:
+        json.dump({"meta": {"commit": commit, "rows": args.rows, "users": args.users,
+                            "timestamp": datetime.utcnow().isoformat() + "Z"},
+                   "results": results}, f, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Scripted load scenario: signup -> login -> list doctors/services -> book -> pay -> poll notifications.
+# Reports p50/p95/p99 and RPS per step and writes the result as JSON for comparison across commits.
+#
+#   python -m bench.load_test --spawn --users 200 --concurrency 50
+#   python -m bench.load_test --base-url http://localhost:8000 --users 200
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+from . import stubs
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, name, coro):
+        start = time.perf_counter()
+        try:
+            resp = await coro
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            self.errors[name] += 1
+            return None
+        return resp
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+async def virtual_user(client, rec, polls):
+    tag = uuid.uuid4().hex[:12]
+    email = f"load-{tag}@bench.example.com"
+    password = "benchpass"
+    await rec.call("signup", client.post("/auth/signup", json={
+        "name": f"Load {tag}", "email": email, "phone": f"07{int(tag, 16) % 10**10:010d}", "password": password,
+    }))
+    resp = await rec.call("login", client.post("/auth/login", data={"username": email, "password": password}))
+    if resp is None:
+        return
+    headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+    doctors = await rec.call("list_doctors", client.get("/doctors", headers=headers))
+    services = await rec.call("list_services", client.get("/services", headers=headers))
+    if not doctors or not services or not doctors.json() or not services.json():
+        return
+    booked = await rec.call("book", client.post("/appointments", headers=headers, json={
+        "doctor_id": doctors.json()[0]["id"], "service_id": services.json()[0]["id"],
+        "gender": "female", "symptoms": "headache", "details": "load test",
+    }))
+    if booked is not None:
+        await rec.call("pay", client.post("/appointments/payment", headers=headers, json={
+            "appointment_id": booked.json()["id"], "phone_number": "254700000000",
+        }))
+    for _ in range(polls):
+        await rec.call("poll_notifications", client.get("/notifications/", headers=headers))
+
+
+async def run_scenario(base_url, users, concurrency, polls):
+    rec = Recorder()
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def guarded():
+            async with sem:
+                await virtual_user(client, rec, polls)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guarded() for _ in range(users)))
+        duration = time.perf_counter() - start
+    return rec, duration
+
+
+def summarize(rec, duration):
+    steps = {}
+    total = 0
+    for name, values in rec.latencies.items():
+        values.sort()
+        total += len(values)
+        steps[name] = {
+            "count": len(values),
+            "errors": rec.errors.get(name, 0),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "rps": round(len(values) / duration, 2),
+        }
+    everything = sorted(v for values in rec.latencies.values() for v in values)
+    overall = {
+        "requests": total,
+        "errors": sum(rec.errors.values()),
+        "duration_s": round(duration, 3),
+        "rps": round(total / duration, 2) if duration else 0,
+        "p50_ms": round((percentile(everything, 50) or 0) * 1000, 3),
+        "p95_ms": round((percentile(everything, 95) or 0) * 1000, 3),
+        "p99_ms": round((percentile(everything, 99) or 0) * 1000, 3),
+    }
+    return overall, steps
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def wait_until_ready(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{base_url}/services", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not become ready")
+
+
+def spawn_server(port, database_url, extra_env, server_args):
+    # Every virtual user shares 127.0.0.1, so per-IP rate limits would dominate the run
+    env = dict(os.environ, DATABASE_URL=database_url, RATE_LIMIT_ENABLED="0")
+    env.update(extra_env)
+    cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning", *server_args]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API load scenario")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--spawn", action="store_true", help="start stubs and a fresh app server for the run")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-arg", action="append", default=[], help="extra argument for the spawned uvicorn")
+    parser.add_argument("--seed-doctors", type=int, default=50)
+    parser.add_argument("--seed-users", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100, help="virtual users to run through the scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--polls", type=int, default=3, help="notification polls per virtual user")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", help="result file (default: bench/results/<timestamp>_<commit>.json)")
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    server = None
+    if args.spawn:
+        from .generate_data import generate
+
+        database_url = f"sqlite:///{tempfile.mkdtemp(prefix='bench-')}/bench.db"
+        generate(database_url, users=args.seed_users, doctors=args.seed_doctors, appointments=args.seed_users * 3, notifications=args.seed_users * 5)
+        env = stubs.stub_env(stubs.start_http_stub(), stubs.start_smtp_stub())
+        server = spawn_server(args.port, database_url, env, args.server_arg)
+        base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_ready(base_url)
+        rec, duration = asyncio.run(run_scenario(base_url, args.users, args.concurrency, args.polls))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    overall, steps = summarize(rec, duration)
+    commit = git_commit()
+    result = {
+        "meta": {
+            "commit": commit,
+            "label": args.label,
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "config": {"users": args.users, "concurrency": args.concurrency, "polls": args.polls,
+                       "spawn": args.spawn, "server_args": args.server_arg},
+            "stub_calls": dict(stubs.calls),
+        },
+        "overall": overall,
+        "steps": steps,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S}_{commit}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{'step':<20}{'count':>8}{'err':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}")
+    for name, s in steps.items():
+        print(f"{name:<20}{s['count']:>8}{s['errors']:>6}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['rps']:>10}")
+    print(f"overall: {overall['requests']} requests, {overall['errors']} errors, {overall['rps']} req/s, p95 {overall['p95_ms']} ms")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Compare server configurations (workers x threads x event loop/HTTP parser)
+# with the load_test scenario. Every configuration starts app.serve on its own
+# copy of one seeded database, behind the same provider stubs.
+#
+#   python -m bench.serve --workers 1 2 4 --threads 40 --loop asyncio uvloop --http h11 httptools
+#   python -m bench.serve --server uvicorn --workers 2 --users 100
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from . import stubs
+from .load_test import BACKEND_DIR, RESULTS_DIR, git_commit, run_scenario, summarize, wait_until_ready
+
+
+def spawn(port, database_url, extra_env, config, server):
+    env = dict(os.environ, DATABASE_URL=database_url, RATE_LIMIT_ENABLED="0")
+    env.update(extra_env)
+    cmd = [sys.executable, "-m", "app.serve", "--host", "127.0.0.1", "--port", str(port), "--server", server,
+           "--workers", str(config["workers"]), "--threads", str(config["threads"]),
+           "--loop", config["loop"], "--http", config["http"], "--log-level", "warning"]
+    # Own process group, so a master that ignores SIGTERM can be killed with its workers
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, start_new_session=True)
+
+
+def run_config(args, seed_db, env, config):
+    workdir = tempfile.mkdtemp(prefix="bench-serve-")
+    db_path = os.path.join(workdir, "bench.db")
+    shutil.copy(seed_db, db_path)
+    server = spawn(args.port, f"sqlite:///{db_path}", env, config, args.server)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_ready(base_url, timeout=60)
+        # A short warm-up pass so every worker has imported, connected and cached
+        asyncio.run(run_scenario(base_url, min(args.users, config["workers"] * 4), args.concurrency, 0))
+        rec, duration = asyncio.run(run_scenario(base_url, args.users, args.concurrency, args.polls))
+    finally:
+        server.terminate()
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            os.killpg(server.pid, signal.SIGKILL)
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    overall, steps = summarize(rec, duration)
+    return {"config": config, "overall": overall, "steps": steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare app.serve configurations")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, nargs="+", default=[40])
+    parser.add_argument("--loop", nargs="+", default=["asyncio", "uvloop"], choices=["asyncio", "uvloop"])
+    parser.add_argument("--http", nargs="+", default=["h11", "httptools"], choices=["h11", "httptools"])
+    parser.add_argument("--server", default="auto", choices=["auto", "gunicorn", "uvicorn"])
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--seed-doctors", type=int, default=50)
+    parser.add_argument("--seed-users", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100, help="virtual users per configuration")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--polls", type=int, default=3)
+    parser.add_argument("--output", help="result file (default: bench/results/serve_<timestamp>_<commit>.json)")
+    args = parser.parse_args()
+
+    from .generate_data import generate
+
+    seed_dir = tempfile.mkdtemp(prefix="bench-seed-")
+    seed_db = os.path.join(seed_dir, "seed.db")
+    generate(f"sqlite:///{seed_db}", users=args.seed_users, doctors=args.seed_doctors,
+             appointments=args.seed_users * 3, notifications=args.seed_users * 5)
+    env = stubs.stub_env(stubs.start_http_stub(), stubs.start_smtp_stub())
+
+    runs = []
+    try:
+        for workers, threads, loop, http in itertools.product(args.workers, args.threads, args.loop, args.http):
+            config = {"workers": workers, "threads": threads, "loop": loop, "http": http}
+            print(f"running {config} ...", flush=True)
+            runs.append(run_config(args, seed_db, env, config))
+    finally:
+        shutil.rmtree(seed_dir, ignore_errors=True)
+
+    commit = git_commit()
+    result = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "cpus": os.cpu_count(),
+            "config": {"server": args.server, "users": args.users, "concurrency": args.concurrency, "polls": args.polls},
+        },
+        "runs": runs,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"serve_{datetime.utcnow():%Y%m%dT%H%M%S}_{commit}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{'workers':>8}{'threads':>8}{'loop':>9}{'http':>11}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'err':>6}")
+    for run in sorted(runs, key=lambda r: -r["overall"]["rps"]):
+        c, o = run["config"], run["overall"]
+        print(f"{c['workers']:>8}{c['threads']:>8}{c['loop']:>9}{c['http']:>11}"
+              f"{o['rps']:>10}{o['p50_ms']:>10}{o['p95_ms']:>10}{o['p99_ms']:>10}{o['errors']:>6}")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
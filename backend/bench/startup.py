@@ -0,0 +1,71 @@
+# Cold-start benchmark: import time, startup (schema check) and first-request latency,
+# each measured in a fresh interpreter.
+#
+#   python -m bench.startup --runs 10
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from .load_test import BACKEND_DIR, RESULTS_DIR, git_commit
+
+_PROBE = """
+import json, time
+t0 = time.perf_counter()
+import app.main
+t1 = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app.main.app) as client:
+    t2 = time.perf_counter()
+    client.get("/services")
+    t3 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "startup_ms": (t2 - t1) * 1000, "first_request_ms": (t3 - t2) * 1000}))
+"""
+
+
+def run_probe(database_url, env_overrides):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONWARNINGS="ignore", **env_overrides)
+    out = subprocess.run([sys.executable, "-c", _PROBE], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold-start time")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE set for the probe, e.g. APP_WARMUP=1")
+    parser.add_argument("--output", help="result file (default: bench/results/startup_<timestamp>_<commit>.json)")
+    args = parser.parse_args()
+
+    from app.__init__ import create_schema
+    from sqlalchemy import create_engine
+
+    database_url = f"sqlite:///{tempfile.mkdtemp(prefix='bench-startup-')}/startup.db"
+    create_schema(create_engine(database_url))
+    overrides = dict(item.split("=", 1) for item in args.env)
+    samples = [run_probe(database_url, overrides) for _ in range(args.runs)]
+
+    summary = {}
+    for key in ("import_ms", "startup_ms", "first_request_ms"):
+        values = [s[key] for s in samples]
+        summary[key] = {"median": round(statistics.median(values), 2), "min": round(min(values), 2), "max": round(max(values), 2)}
+        print(f"{key:<18} median {summary[key]['median']:>8} ms   min {summary[key]['min']:>8} ms   max {summary[key]['max']:>8} ms")
+
+    commit = git_commit()
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"startup_{datetime.utcnow():%Y%m%dT%H%M%S}_{commit}.json")
+    with open(output, "w") as f:
+        json.dump({"meta": {"commit": commit, "runs": args.runs, "env": overrides,
+                            "timestamp": datetime.utcnow().isoformat() + "Z"},
+                   "summary": summary, "samples": samples}, f, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Local stand-ins for Daraja, the SMS gateway and the SMTP relay so load tests
+# never touch real providers. Each stub counts the calls it receives.
+
+import asyncio
+import json
+import os
+import subprocess
+import ssl
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+calls = Counter()
+
+
+class _HTTPStubHandler(BaseHTTPRequestHandler):
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/oauth/v1/generate"):
+            calls["daraja_oauth"] += 1
+            return self._reply({"access_token": "stub-token", "expires_in": "3599"})
+        self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) or b"{}"
+        if self.path == "/mpesa/stkpush/v1/processrequest":
+            calls["daraja_stk_push"] += 1
+            return self._reply({
+                "MerchantRequestID": "stub", "CheckoutRequestID": "ws_CO_stub",
+                "ResponseCode": "0", "ResponseDescription": "Success. Request accepted for processing",
+                "CustomerMessage": "Success. Request accepted for processing",
+            })
+        if self.path == "/sms":
+            calls["sms"] += 1
+            return self._reply({"status": "queued"})
+        if self.path == "/sms/bulk":
+            calls["sms_bulk"] += 1
+            calls["sms"] += len(json.loads(body).get("messages", []))
+            return self._reply({"status": "queued"})
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_stub(host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), _HTTPStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _self_signed_context(workdir):
+    cert = os.path.join(workdir, "stub.crt")
+    key = os.path.join(workdir, "stub.key")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+async def _smtp_session(reader, writer, tls_context):
+    writer.write(b"220 stub ESMTP\r\n")
+    await writer.drain()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        verb = line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+        if verb in ("EHLO", "HELO"):
+            writer.write(b"250-stub\r\n250-AUTH PLAIN LOGIN\r\n250 STARTTLS\r\n")
+        elif verb == "STARTTLS":
+            writer.write(b"220 Ready to start TLS\r\n")
+            await writer.drain()
+            await writer.start_tls(tls_context)
+            continue
+        elif verb == "AUTH":
+            writer.write(b"235 Authentication successful\r\n")
+        elif verb == "DATA":
+            writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            await writer.drain()
+            while (await reader.readline()) not in (b".\r\n", b""):
+                pass
+            calls["smtp"] += 1
+            writer.write(b"250 OK\r\n")
+        elif verb == "QUIT":
+            writer.write(b"221 Bye\r\n")
+            await writer.drain()
+            break
+        else:
+            writer.write(b"250 OK\r\n")
+        await writer.drain()
+    writer.close()
+
+
+def start_smtp_stub(host="127.0.0.1", port=0):
+    """Start an SMTP sink in a background loop; returns the bound port."""
+    tls_context = _self_signed_context(tempfile.mkdtemp(prefix="smtp-stub-"))
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    bound = {}
+
+    async def _serve():
+        server = await asyncio.start_server(lambda r, w: _smtp_session(r, w, tls_context), host, port)
+        bound["port"] = server.sockets[0].getsockname()[1]
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(target=loop.run_until_complete, args=(_serve(),), daemon=True).start()
+    ready.wait()
+    return bound["port"]
+
+
+def stub_env(http_server, smtp_port):
+    """Environment variables that point the app at the running stubs."""
+    base = f"http://{http_server.server_address[0]}:{http_server.server_address[1]}"
+    return {
+        "DARAJA_BASE_URL": base,
+        "DARAJA_CONSUMER_KEY": "stub",
+        "DARAJA_CONSUMER_SECRET": "stub",
+        "DARAJA_PASSKEY": "stub",
+        "SMS_API_URL": f"{base}/sms",
+        "SMS_API_KEY": "stub",
+        "SMS_BULK_API_URL": f"{base}/sms/bulk",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_USER": "stub@bench.example.com",
+        "SMTP_PASS": "stub",
+        "SMTP_VALIDATE_CERTS": "0",  # the stub uses a self-signed certificate
+    }
@@ -0,0 +1,23 @@
+// Checks signed file URLs from app/delivery.py (FILE_DELIVERY=signed):
+//   /files/<path>?expires=<unix time>&sig=<base64url HMAC-SHA256 of "<expires>:<path>">
+// Used from nginx.conf as: js_set $file_signature_ok file_signature.check;
+
+const crypto = require('crypto');
+const PREFIX = '/files/';
+
+function check(r) {
+    const secret = process.env.FILE_URL_SECRET;
+    const expires = r.args.expires;
+    const sig = r.args.sig;
+    if (!secret || !expires || !sig || !/^[0-9]+$/.test(expires) || Number(expires) < Date.now() / 1000) {
+        return '0';
+    }
+    if (!r.uri.startsWith(PREFIX)) {
+        return '0';
+    }
+    const path = r.uri.slice(PREFIX.length);
+    const expected = crypto.createHmac('sha256', secret).update(expires + ':' + path).digest('base64url');
+    return expected === sig ? '1' : '0';
+}
+
+export default { check };